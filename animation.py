@@ -0,0 +1,125 @@
+"""
+Incremental animation writer for latent walks: frames are encoded as
+they are added, to a GIF with Pillow or to a video through an ffmpeg
+pipe, so memory stays at one frame whatever the length of the clip.
+"""
+import os
+import tempfile
+import subprocess
+import numpy as np
+
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+from utils import images_to_uint8
+
+def ffmpeg_path():
+  """Path of the ffmpeg executable, or None if it is not installed."""
+  return which('ffmpeg')
+
+def animation_path(base):
+  """`base` with .mp4 when ffmpeg is available, .gif otherwise."""
+  return base + ('.mp4' if ffmpeg_path() else '.gif')
+
+class AnimationWriter(object):
+  """Writes frames to `path` as they are added.
+
+  .gif files are encoded with Pillow, one adaptive palette per frame; any
+  other extension, e.g. .mp4, is encoded by an ffmpeg process reading raw
+  frames from a pipe. Frames are uint8 or floats in [-1, 1], shaped
+  [height, width, channels] with 1, 3 or 4 channels, all the same size.
+
+  Args:
+    path: Output file.
+    fps: Frames per second.
+    loop: (optional) Loop a GIF forever. [True]
+  """
+  def __init__(self, path, fps, loop=True):
+    self.path = path
+    self.fps = float(fps)
+    self.loop = loop
+    self.frames = 0
+    self.shape = None
+    self.is_gif = os.path.splitext(path)[1].lower() == '.gif'
+    self._file = None
+    self._process = None
+    self._errors = None
+    # GIF durations are in centiseconds; rounding is carried to later frames
+    self._elapsed_ms = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def add(self, frames):
+    """Appends one [h, w, c] frame or a [n, h, w, c] batch of frames."""
+    frames = images_to_uint8(frames)
+    if frames.ndim == 3:
+      frames = frames[None]
+    for frame in frames:
+      if self.shape is None:
+        self.shape = frame.shape
+        self._open()
+      elif frame.shape != self.shape:
+        raise ValueError("Frame of shape {} after frames of shape {}".format(frame.shape, self.shape))
+      if self.is_gif:
+        self._add_gif(frame)
+      else:
+        self._process.stdin.write(np.ascontiguousarray(frame).tobytes())
+      self.frames += 1
+
+  def _open(self):
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    if self.is_gif:
+      self._file = open(self.path, 'wb')
+      return
+    ffmpeg = ffmpeg_path()
+    if ffmpeg is None:
+      raise IOError("ffmpeg is needed to write {}; write a .gif instead".format(self.path))
+    height, width, channels = self.shape
+    command = [ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', {1: 'gray', 3: 'rgb24', 4: 'rgba'}[channels],
+               '-s', '{}x{}'.format(width, height), '-r', str(self.fps), '-i', '-',
+               # yuv420p needs even sizes; most players need yuv420p
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p']
+    if self.path.lower().endswith('.mp4'):
+      command += ['-c:v', 'libx264']
+    # ffmpeg output goes to a file: an unread pipe would fill up and block
+    # ffmpeg, and with it this writer
+    self._errors = tempfile.TemporaryFile()
+    self._process = subprocess.Popen(command + [self.path], stdin=subprocess.PIPE, stderr=self._errors)
+
+  def _add_gif(self, frame):
+    from PIL import Image, GifImagePlugin
+    if frame.shape[2] == 1:
+      image = Image.fromarray(frame[:, :, 0], 'L')
+    else:
+      image = Image.fromarray(frame[:, :, :3]).convert('P', palette=Image.ADAPTIVE, colors=256)
+    target_ms = int(round((self.frames + 1) * 1000. / self.fps / 10.)) * 10
+    duration, self._elapsed_ms = target_ms - self._elapsed_ms, target_ms
+    if self.frames == 0:
+      header, _ = GifImagePlugin.getheader(image, info={'loop': 0} if self.loop else {})
+      for data in header:
+        self._file.write(data)
+    for data in GifImagePlugin.getdata(image, duration=duration, include_color_table=True):
+      self._file.write(data)
+
+  def close(self):
+    if self._file is not None:
+      # GIF trailer
+      self._file.write(b';')
+      self._file.close()
+      self._file = None
+    if self._process is not None:
+      self._process.stdin.close()
+      returncode, self._process = self._process.wait(), None
+      self._errors.seek(0)
+      errors, self._errors = self._errors.read(), None
+      if returncode != 0:
+        raise IOError("ffmpeg failed to write {}: {}".format(self.path, errors.decode('utf-8', 'replace')))
@@ -0,0 +1,95 @@
+"""
+Background writing of training artifacts: sample grids, GIFs and metric
+logs are encoded and written on worker threads instead of the training
+loop.
+"""
+import sys
+import time
+import threading
+from six.moves import queue
+
+from utils import save_images, make_gif
+
+def append_text(path, text):
+  with open(path, 'a') as f:
+    f.write(text)
+
+class ArtifactWriter(object):
+  """Runs writes on `num_threads` threads, each with a bounded queue.
+
+  Writes to the same path always go to the same thread, so appends to a
+  log land in order. When a thread's queue holds `max_queue` writes,
+  `submit` blocks until it has room; `wait_secs` adds up that time. An
+  error in a write is raised by the next `submit`, `flush` or `close`.
+
+  Args:
+    num_threads: Number of writer threads. [2]
+    max_queue: Writes queued per thread before `submit` blocks. [8]
+  """
+  def __init__(self, num_threads=2, max_queue=8):
+    self._queues = [queue.Queue(maxsize=max_queue) for _ in range(max(1, num_threads))]
+    self._errors = []
+    self._next = 0
+    self.wait_secs = 0.
+    self._threads = []
+    for tasks in self._queues:
+      thread = threading.Thread(target=self._run, args=(tasks,))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _run(self, tasks):
+    while True:
+      task = tasks.get()
+      try:
+        if task is None:
+          return
+        fn, args, kwargs = task
+        fn(*args, **kwargs)
+      except Exception:
+        self._errors.append(sys.exc_info()[1])
+      finally:
+        tasks.task_done()
+
+  def _raise_error(self):
+    if self._errors:
+      raise self._errors.pop(0)
+
+  def submit(self, fn, *args, **kwargs):
+    """Queues `fn(*args, **kwargs)`; a `key` keyword picks the thread by hash."""
+    key = kwargs.pop('key', None)
+    self._raise_error()
+    if key is None:
+      idx, self._next = self._next, (self._next + 1) % len(self._queues)
+    else:
+      idx = hash(key) % len(self._queues)
+    start_time = time.time()
+    self._queues[idx].put((fn, args, kwargs))
+    self.wait_secs += time.time() - start_time
+
+  def save_images(self, images, shape, path, column_size=None):
+    """`utils.save_images` in the background; `images` must not change afterwards."""
+    self.submit(save_images, images, shape, path, column_size=column_size, key=path)
+
+  def make_gif(self, images, fname, **kwargs):
+    """`utils.make_gif` in the background; `images` must not change afterwards."""
+    kwargs['key'] = fname
+    self.submit(make_gif, images, fname, **kwargs)
+
+  def append(self, path, text):
+    self.submit(append_text, path, text, key=path)
+
+  def flush(self):
+    """Blocks until every queued write has finished."""
+    for tasks in self._queues:
+      tasks.join()
+    self._raise_error()
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      for tasks in self._queues:
+        tasks.put(None)
+      for thread in self._threads:
+        thread.join()
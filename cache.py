@@ -0,0 +1,215 @@
+"""
+Bounded memory and disk cache of encoded images, for serving the same
+seeds and labels of one generator again without running it.
+"""
+import os
+import json
+import shutil
+import hashlib
+import threading
+import collections
+
+# Written into every namespace directory the cache makes; only those are removed
+MARKER_NAME = '.image_cache'
+
+class _LRU(object):
+  """Key -> size in bytes, least recently used first, with a byte total."""
+  def __init__(self):
+    self.sizes = collections.OrderedDict()
+    self.bytes = 0
+
+  def touch(self, key):
+    self.sizes[key] = self.sizes.pop(key)
+
+  def add(self, key, size):
+    self.discard(key)
+    self.sizes[key] = size
+    self.bytes += size
+
+  def discard(self, key):
+    if key in self.sizes:
+      self.bytes -= self.sizes.pop(key)
+
+  def oldest(self):
+    return next(iter(self.sizes))
+
+  def clear(self):
+    self.sizes.clear()
+    self.bytes = 0
+
+class ImageCache(object):
+  """LRU cache of encoded images, in memory and optionally on disk.
+
+  Entries belong to one generator, named by `bind(step, config)`; binding
+  a different checkpoint step or config drops every entry of the previous
+  one, in memory and on disk. On disk only the directories the cache made
+  are removed, so anything else in `disk_dir` is left alone. Within a
+  generator, keys are (seed, label, format) tuples. Each tier evicts least
+  recently used entries to stay within its byte limit. A disk hit is
+  copied back into memory.
+
+  Args:
+    memory_bytes: Byte limit of the in-memory tier; 0 disables it.
+    disk_dir: (optional) Directory of the on-disk tier. [None]
+    disk_bytes: (optional) Byte limit of the on-disk tier. [1 << 30]
+  """
+  def __init__(self, memory_bytes, disk_dir=None, disk_bytes=1 << 30):
+    self.memory_bytes = memory_bytes
+    self.disk_dir = disk_dir
+    self.disk_bytes = disk_bytes
+    self.namespace = None
+    self._lock = threading.Lock()
+    self._memory = {}
+    self._memory_lru = _LRU()
+    self._disk_lru = _LRU()
+    self.counts = collections.Counter()
+
+  @staticmethod
+  def namespace_of(step, config):
+    data = json.dumps({'step': step, 'config': config}, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+  def bind(self, step, config):
+    """Serves entries of checkpoint `step` with model `config` (a JSON-able dict)."""
+    namespace = self.namespace_of(step, config)
+    with self._lock:
+      if namespace == self.namespace:
+        return
+      if self.namespace is not None:
+        self.counts['invalidations'] += 1
+      self.namespace = namespace
+      self._memory.clear()
+      self._memory_lru.clear()
+      self._disk_lru.clear()
+      if self.disk_dir:
+        self._bind_disk()
+
+  def _bind_disk(self):
+    if not os.path.exists(self.disk_dir):
+      os.makedirs(self.disk_dir)
+    for name in os.listdir(self.disk_dir):
+      path = os.path.join(self.disk_dir, name)
+      if name != self.namespace and os.path.exists(os.path.join(path, MARKER_NAME)):
+        shutil.rmtree(path, ignore_errors=True)
+    directory = os.path.join(self.disk_dir, self.namespace)
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    open(os.path.join(directory, MARKER_NAME), 'a').close()
+    # Entries from a previous run of the same generator, oldest access first
+    entries = []
+    for name in os.listdir(directory):
+      path = os.path.join(directory, name)
+      if name == MARKER_NAME:
+        continue
+      if name.endswith('.tmp'):
+        os.remove(path)
+        continue
+      stat = os.stat(path)
+      entries.append((stat.st_atime, name, stat.st_size))
+    for _, name, size in sorted(entries):
+      self._disk_lru.add(name, size)
+
+  def _file_name(self, key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.' + str(key[-1])
+
+  def get(self, key):
+    """Encoded bytes for `key`, or None."""
+    with self._lock:
+      if key in self._memory:
+        self._memory_lru.touch(key)
+        self.counts['memory_hits'] += 1
+        return self._memory[key]
+      name = self._file_name(key)
+      if not self.disk_dir or name not in self._disk_lru.sizes:
+        self.counts['misses'] += 1
+        return None
+      namespace = self.namespace
+    # Files are read outside the lock so memory hits never wait for the disk
+    path = os.path.join(self.disk_dir, namespace, name)
+    try:
+      with open(path, 'rb') as f:
+        value = f.read()
+      os.utime(path, None)
+    except (IOError, OSError):
+      with self._lock:
+        if namespace == self.namespace:
+          self._disk_lru.discard(name)
+        self.counts['misses'] += 1
+      return None
+    with self._lock:
+      if namespace == self.namespace:
+        if name in self._disk_lru.sizes:
+          self._disk_lru.touch(name)
+        self._put_memory(key, value)
+      self.counts['disk_hits'] += 1
+    return value
+
+  def put(self, key, value, namespace=None):
+    """Caches `value`, unless `namespace` is given and no longer the bound one."""
+    with self._lock:
+      if self.namespace is None:
+        raise ValueError("bind() the cache to a generator first")
+      if namespace is not None and namespace != self.namespace:
+        self.counts['stale_puts'] += 1
+        return
+      namespace = self.namespace
+      self._put_memory(key, value)
+    if self.disk_dir and len(value) <= self.disk_bytes:
+      self._put_disk(namespace, key, value)
+
+  def _put_memory(self, key, value):
+    if len(value) > self.memory_bytes:
+      return
+    self._memory[key] = value
+    self._memory_lru.add(key, len(value))
+    while self._memory_lru.bytes > self.memory_bytes:
+      oldest = self._memory_lru.oldest()
+      self._memory_lru.discard(oldest)
+      del self._memory[oldest]
+      self.counts['memory_evictions'] += 1
+
+  def _put_disk(self, namespace, key, value):
+    """Writes and evicts files outside the lock; only the LRU update holds it."""
+    name = self._file_name(key)
+    directory = os.path.join(self.disk_dir, namespace)
+    # Written under a temporary name, one per thread, so readers never see
+    # part of a file and concurrent writers of one key never share a file
+    tmp_path = os.path.join(directory, '{}.{}.tmp'.format(name, threading.current_thread().ident))
+    try:
+      with open(tmp_path, 'wb') as f:
+        f.write(value)
+      os.rename(tmp_path, os.path.join(directory, name))
+    except (IOError, OSError):
+      # The namespace was dropped by a concurrent bind()
+      return
+    evicted = []
+    with self._lock:
+      if namespace != self.namespace:
+        return
+      self._disk_lru.add(name, len(value))
+      while self._disk_lru.bytes > self.disk_bytes:
+        oldest = self._disk_lru.oldest()
+        self._disk_lru.discard(oldest)
+        evicted.append(oldest)
+        self.counts['disk_evictions'] += 1
+    for oldest in evicted:
+      try:
+        os.remove(os.path.join(directory, oldest))
+      except OSError:
+        pass
+
+  def stats(self):
+    """Hit and miss counters, hit rate, and entries and bytes per tier."""
+    with self._lock:
+      counts = dict(self.counts)
+      lookups = sum(counts.get(name, 0) for name in ('memory_hits', 'disk_hits', 'misses'))
+      hits = counts.get('memory_hits', 0) + counts.get('disk_hits', 0)
+      return {
+        'counts': counts,
+        'hit_rate': hits / float(lookups) if lookups else None,
+        'namespace': self.namespace,
+        'memory_entries': len(self._memory), 'memory_bytes': self._memory_lru.bytes,
+        'memory_limit_bytes': self.memory_bytes,
+        'disk_entries': len(self._disk_lru.sizes), 'disk_bytes': self._disk_lru.bytes,
+        'disk_limit_bytes': self.disk_bytes if self.disk_dir else 0,
+      }
@@ -0,0 +1,159 @@
+"""
+Checkpointing for DCGAN that keeps disk writes off the training loop:
+variables are copied out in one `sess.run` and saved by a background
+thread, on a step and wall-clock cadence.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import tensorflow as tf
+
+class CheckpointSchedule(object):
+  """Decides when a checkpoint is due.
+
+  A checkpoint is due every `every_steps` steps or every `every_secs`
+  seconds, whichever comes first; 0 turns either off. `due` restarts both
+  clocks when it returns True.
+
+  Args:
+    every_steps: Steps between checkpoints, 0 to disable. [0]
+    every_secs: Seconds between checkpoints, 0 to disable. [0]
+    step: Step the clocks start from, e.g. the restored one. [0]
+  """
+  def __init__(self, every_steps=0, every_secs=0, step=0):
+    self.every_steps = every_steps
+    self.every_secs = every_secs
+    self.last_step = step
+    self.last_time = time.time()
+
+  def due(self, step):
+    now = time.time()
+    if ((self.every_steps and step - self.last_step >= self.every_steps) or
+        (self.every_secs and now - self.last_time >= self.every_secs)):
+      self.last_step, self.last_time = step, now
+      return True
+    return False
+
+class AsyncCheckpointer(object):
+  """Saves checkpoints of a graph's variables from a background thread.
+
+  `save` only fetches the variable values; the writer thread assigns them
+  to copies of the variables in a private graph and saves those with a
+  tf.train.Saver under the original names, so the checkpoints restore into
+  the training graph as usual. At most one snapshot waits for the writer;
+  a newer one replaces it rather than making training wait.
+
+  Retention is the Saver's: the newest `max_to_keep` checkpoints, plus
+  one every `keep_every_hours` that is never deleted.
+
+  Args:
+    checkpoint_dir: Directory for the checkpoints.
+    model_name: File name prefix of the checkpoints.
+    var_list: (optional) Variables to save. If None, all global variables [None]
+    max_to_keep: Number of recent checkpoints kept. [5]
+    keep_every_hours: Hours between checkpoints kept for good. [10000]
+  """
+  def __init__(self, checkpoint_dir, model_name, var_list=None,
+               max_to_keep=5, keep_every_hours=10000.):
+    self.checkpoint_dir = checkpoint_dir
+    self.save_path = os.path.join(checkpoint_dir, model_name)
+    self.max_to_keep = max_to_keep
+    self.keep_every_hours = keep_every_hours
+    self.variables = var_list if var_list is not None else tf.global_variables()
+    self._specs = [(var.op.name, var.dtype.base_dtype, var.get_shape()) for var in self.variables]
+
+    self._cond = threading.Condition()
+    self._pending = None
+    self._writing = False
+    self._closed = False
+    self._error = None
+    self._sess = None
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def save(self, sess, step, extra=None):
+    """Snapshots the variables at `step` and queues them for writing.
+
+    Args:
+      sess: Session holding the variables.
+      step: Global step appended to the checkpoint name.
+      extra: (optional) Dict of file name -> JSON value, written next to
+        the checkpoint once it is on disk. [None]
+    """
+    if self._error is not None:
+      raise self._error
+    values = sess.run(self.variables)
+    with self._cond:
+      if self._pending is not None:
+        print(" [!] Checkpoint at step {} was not written yet, replacing it".format(self._pending[0]))
+      self._pending = (step, values, extra)
+      self._cond.notify_all()
+
+  def _build(self):
+    graph = tf.Graph()
+    with graph.as_default():
+      self._placeholders, variables = [], {}
+      for name, dtype, shape in self._specs:
+        placeholder = tf.placeholder(dtype, shape)
+        self._placeholders.append(placeholder)
+        variables[name] = tf.Variable(placeholder, trainable=False)
+      self._assign = [var.initializer for var in variables.values()]
+      self._saver = tf.train.Saver(variables, max_to_keep=self.max_to_keep,
+                                   keep_checkpoint_every_n_hours=self.keep_every_hours)
+    self._sess = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    # Keep counting retention from the checkpoints of earlier runs
+    state = tf.train.get_checkpoint_state(self.checkpoint_dir)
+    if state is not None:
+      self._saver.recover_last_checkpoints(list(state.all_model_checkpoint_paths))
+
+  def _write(self, step, values, extra):
+    if not os.path.exists(self.checkpoint_dir):
+      os.makedirs(self.checkpoint_dir)
+    self._sess.run(self._assign, feed_dict=dict(zip(self._placeholders, values)))
+    self._saver.save(self._sess, self.save_path, global_step=step, write_meta_graph=False)
+    for name, value in (extra or {}).items():
+      with open(os.path.join(self.checkpoint_dir, name), 'w') as f:
+        json.dump(value, f)
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while self._pending is None and not self._closed:
+          self._cond.wait()
+        if self._pending is None:
+          break
+        item, self._pending = self._pending, None
+        self._writing = True
+      try:
+        if self._sess is None:
+          self._build()
+        self._write(*item)
+      except Exception:
+        self._error = sys.exc_info()[1]
+      finally:
+        with self._cond:
+          self._writing = False
+          self._cond.notify_all()
+    if self._sess is not None:
+      self._sess.close()
+
+  def flush(self):
+    """Blocks until the queued checkpoint is on disk."""
+    with self._cond:
+      while self._pending is not None or self._writing:
+        self._cond.wait()
+    if self._error is not None:
+      raise self._error
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      with self._cond:
+        self._closed = True
+        self._cond.notify_all()
+      self._thread.join()
@@ -0,0 +1,539 @@
+"""
+Input pipeline for DCGAN: background batch prefetching and a preprocessed
+memory-mapped cache for image datasets.
+"""
+from __future__ import division
+import os
+import sys
+import json
+import shutil
+import hashlib
+import threading
+import multiprocessing
+import six
+import numpy as np
+import scipy.misc
+from PIL import Image
+from functools import partial
+from six.moves import queue, xrange
+
+from utils import resize_batch, transform_batch
+
+CACHE_VERSION = 2
+
+def load_image_batch(paths, input_height, input_width,
+                     resize_height=64, resize_width=64,
+                     crop=True, grayscale=False, random_flip=False):
+  """Decodes `paths` and transforms them into one float32 batch."""
+  images = [imread_uint8(path, grayscale) for path in paths]
+  c_dim = images[0].shape[-1]
+  # The one array made per batch: it is queued while the next one loads
+  batch = np.empty((len(images), resize_height, resize_width, c_dim), dtype=np.float32)
+  if all(image.shape == images[0].shape for image in images):
+    return transform_batch(images, input_height, input_width,
+                           resize_height, resize_width, crop=crop,
+                           random_flip=random_flip, out=batch)
+
+  # Mixed sizes: same transform, one image at a time into the batch
+  for idx, image in enumerate(images):
+    transform_batch(image[None], input_height, input_width,
+                    resize_height, resize_width, crop=crop,
+                    random_flip=random_flip, out=batch[idx:idx + 1])
+  return batch
+
+def _throttled(items, semaphore):
+  for item in items:
+    semaphore.acquire()
+    yield item
+
+class BatchPrefetcher(object):
+  """Loads batches on background workers into a bounded queue.
+
+  Each element of `batches` is passed to `load_fn` on a worker and the
+  results are yielded in the order of `batches` by iterating over the
+  prefetcher. At most `queue_size` batches are loading or loaded ahead of
+  the consumer; workers wait until the training loop takes one.
+
+  Args:
+    load_fn: Function mapping a batch spec (e.g. a list of paths) to a batch.
+      Must be picklable when `use_processes` is set.
+    batches: Sequence of batch specs for one pass.
+    queue_size: Number of loaded batches kept ahead of the consumer. [8]
+    num_workers: Number of loader threads or processes. [4]
+    use_processes: Decode in a process pool instead of threads. [False]
+  """
+  def __init__(self, load_fn, batches, queue_size=8, num_workers=4,
+               use_processes=False):
+    self.load_fn = load_fn
+    self.batches = list(batches)
+    self.queue_size = max(1, queue_size)
+    self.num_workers = max(1, min(num_workers, len(self.batches) or 1))
+    self.use_processes = use_processes
+
+    # Outstanding slots bound loading + queued + reordering batches
+    self._slots = threading.Semaphore(self.queue_size)
+    self._queue = queue.Queue()
+    self._stop = threading.Event()
+    self._pool = None
+    self._threads = []
+    self._start()
+
+  def __len__(self):
+    return len(self.batches)
+
+  def _start(self):
+    if self.use_processes:
+      self._pool = multiprocessing.Pool(self.num_workers)
+      thread = threading.Thread(target=self._pool_feeder)
+      self._threads.append(thread)
+    else:
+      self._tasks = queue.Queue()
+      for seq, batch in enumerate(self.batches):
+        self._tasks.put((seq, batch))
+      for _ in xrange(self.num_workers):
+        self._threads.append(threading.Thread(target=self._thread_worker))
+
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  def _thread_worker(self):
+    try:
+      while True:
+        self._slots.acquire()
+        if self._stop.is_set():
+          return
+        try:
+          seq, batch = self._tasks.get_nowait()
+        except queue.Empty:
+          self._slots.release()
+          break
+        self._queue.put((seq, self.load_fn(batch)))
+    except Exception:
+      self._queue.put((None, sys.exc_info()))
+      return
+    self._queue.put((None, None))
+
+  def _pool_feeder(self):
+    try:
+      results = self._pool.imap(
+          self.load_fn, _throttled(self.batches, self._slots))
+      for seq, result in enumerate(results):
+        if self._stop.is_set():
+          return
+        self._queue.put((seq, result))
+    except Exception:
+      self._queue.put((None, sys.exc_info()))
+      return
+    self._queue.put((None, None))
+
+  def __iter__(self):
+    finished = 0
+    next_seq = 0
+    pending = {}
+    try:
+      while next_seq < len(self.batches):
+        if next_seq in pending:
+          self._slots.release()
+          yield pending.pop(next_seq)
+          next_seq += 1
+          continue
+        if finished == len(self._threads):
+          break
+        seq, item = self._queue.get()
+        if seq is None:
+          if item is not None:
+            # Keeps the worker's traceback, which a plain raise drops on Python 2
+            six.reraise(*item)
+          finished += 1
+        else:
+          pending[seq] = item
+    finally:
+      self.close()
+
+  def close(self):
+    """Stops the workers and drops any batches still queued."""
+    if self._stop.is_set():
+      return
+    self._stop.set()
+    # Wake workers waiting for a slot so they can exit
+    for _ in xrange(self.num_workers):
+      self._slots.release()
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool = None
+    while True:
+      try:
+        self._queue.get_nowait()
+      except queue.Empty:
+        break
+
+
+class EpochSampler(object):
+  """Index batches that cover a dataset exactly once per epoch.
+
+  Every epoch draws a fresh permutation (without replacement) from
+  `seed` and the epoch number, so all shards agree on it without
+  communicating. Shard k of N takes every N-th index of that permutation,
+  which keeps shards disjoint. The position within the epoch is tracked by
+  `step` and can be saved with `state_dict` and restored from a checkpoint.
+
+  Args:
+    num_examples: Size of the index space.
+    batch_size: Number of indices per batch.
+    last_batch: What to do with a short final batch [keep, drop, pad].
+      `pad` tops it up with indices from the start of the same epoch and
+      gives every shard the same number of full batches; a shard past the
+      end of a dataset smaller than `num_shards` takes them from the
+      whole epoch. [keep]
+    num_shards: Number of disjoint shards, e.g. data-parallel workers. [1]
+    shard_index: Shard served by this sampler. [0]
+    shuffle: Draw a new permutation every epoch. [True]
+    seed: (optional) Seed shared by all shards. If None, a random one [None]
+  """
+  def __init__(self, num_examples, batch_size, last_batch='keep',
+               num_shards=1, shard_index=0, shuffle=True, seed=None):
+    if last_batch not in ('keep', 'drop', 'pad'):
+      raise ValueError("last_batch must be one of keep, drop, pad, got {}".format(last_batch))
+    if not 0 <= shard_index < num_shards:
+      raise ValueError("shard_index {} out of range for {} shards".format(shard_index, num_shards))
+    self.num_examples = int(num_examples)
+    self.batch_size = batch_size
+    self.last_batch = last_batch
+    self.num_shards = num_shards
+    self.shard_index = shard_index
+    self.shuffle = shuffle
+    self.seed = np.random.randint(2**31 - 1) if seed is None else seed
+    self.epoch = 0
+    self.batch = 0
+
+  def __len__(self):
+    """Number of batches per epoch for this shard."""
+    if self.last_batch == 'pad':
+      shard_size = -(-self.num_examples // self.num_shards)
+    else:
+      shard_size = max(0, (self.num_examples - self.shard_index + self.num_shards - 1) // self.num_shards)
+    if self.last_batch == 'drop':
+      return shard_size // self.batch_size
+    return -(-shard_size // self.batch_size)
+
+  def epoch_indices(self, epoch):
+    """This shard's indices for `epoch`, before batching."""
+    if self.shuffle:
+      order = np.random.RandomState([self.seed, epoch]).permutation(self.num_examples)
+    else:
+      order = np.arange(self.num_examples)
+    indices = order[self.shard_index::self.num_shards]
+    if self.last_batch == 'pad':
+      size = len(self) * self.batch_size
+      # A shard with no indices of its own, when num_examples < num_shards
+      source = indices if len(indices) else order
+      indices = np.resize(source, size) if len(source) else source
+    return indices
+
+  def remaining_batches(self):
+    """Index arrays for the rest of the current epoch, from `batch` on."""
+    indices = self.epoch_indices(self.epoch)
+    return [indices[idx*self.batch_size:(idx+1)*self.batch_size]
+            for idx in xrange(self.batch, len(self))]
+
+  def step(self):
+    """Marks one batch as consumed, moving to the next epoch at the end."""
+    self.batch += 1
+    if self.batch >= len(self):
+      self.epoch += 1
+      self.batch = 0
+
+  def state_dict(self):
+    return {'seed': int(self.seed), 'epoch': self.epoch, 'batch': self.batch,
+            'num_examples': self.num_examples, 'num_shards': self.num_shards}
+
+  def load_state_dict(self, state):
+    if (state.get('num_examples') != self.num_examples or
+        state.get('num_shards') != self.num_shards):
+      print(" [!] Sampler state is for a different dataset or shard count, ignoring it")
+      return
+    self.seed = state['seed']
+    self.epoch = state['epoch']
+    self.batch = state['batch']
+
+class ClassIndex(object):
+  """Example indices grouped by class, stored flat for O(1) lookups.
+
+  `indices[starts[c]:starts[c] + counts[c]]` are the examples of class c.
+  """
+  def __init__(self, labels, num_classes):
+    labels = np.asarray(labels)
+    if labels.ndim == 2:
+      labels = np.argmax(labels, axis=1)
+    self.num_classes = num_classes
+    self.indices = np.argsort(labels, kind='mergesort')
+    self.counts = np.bincount(labels, minlength=num_classes)
+    self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+
+  def __len__(self):
+    return len(self.indices)
+
+  def sample(self, classes, rng=np.random):
+    """One random example of each entry in `classes`, with replacement."""
+    offsets = (rng.random_sample(len(classes)) * self.counts[classes]).astype(np.int64)
+    return self.indices[self.starts[classes] + offsets]
+
+class ClassSampler(object):
+  """Draws label-stratified batches for conditional training.
+
+  Classes are drawn from `class_probs` and an example of each drawn class
+  is looked up in a precomputed `ClassIndex`, so a batch costs O(batch)
+  regardless of dataset size. Epochs have as many batches as an
+  `EpochSampler` would, so the rest of the training loop is unchanged.
+
+  Args:
+    class_index: `ClassIndex` of the training labels.
+    batch_size: Number of indices per batch.
+    mode: `balanced` gives every non-empty class equal weight, `weighted`
+      uses `weights`. [balanced]
+    weights: (optional) Relative weight per class for `weighted` mode [None]
+    seed: (optional) Seed for the class and example draws [None]
+  """
+  def __init__(self, class_index, batch_size, mode='balanced', weights=None, seed=None):
+    if mode not in ('balanced', 'weighted'):
+      raise ValueError("mode must be balanced or weighted, got {}".format(mode))
+    self.class_index = class_index
+    self.batch_size = batch_size
+    self.mode = mode
+    self.seed = np.random.randint(2**31 - 1) if seed is None else seed
+    self.epoch = 0
+    self.batch = 0
+
+    if mode == 'balanced':
+      weights = np.ones(class_index.num_classes)
+    elif weights is None or len(weights) != class_index.num_classes:
+      raise ValueError("weighted mode needs one weight per class ({})".format(class_index.num_classes))
+    weights = np.asarray(weights, dtype=np.float64) * (class_index.counts > 0)
+    if weights.sum() <= 0:
+      raise ValueError("class weights select no examples")
+    self.class_probs = weights / weights.sum()
+
+  def __len__(self):
+    return -(-len(self.class_index) // self.batch_size)
+
+  def remaining_batches(self):
+    """Index arrays for the rest of the current epoch, from `batch` on."""
+    rng = np.random.RandomState([self.seed, self.epoch])
+    classes = rng.choice(self.class_index.num_classes,
+                         size=len(self) * self.batch_size, p=self.class_probs)
+    indices = self.class_index.sample(classes, rng).reshape(len(self), self.batch_size)
+    return list(indices[self.batch:])
+
+  def grid_classes(self, num_samples):
+    """Class of each row in a sample grid, in the training proportions.
+
+    Rows are split by largest remainder and grouped by class, so balanced
+    sampling over all classes gives the same number of rows per class.
+    """
+    quota = self.class_probs * num_samples
+    counts = np.floor(quota).astype(np.int64)
+    remainder = num_samples - counts.sum()
+    counts[np.argsort(counts - quota, kind='mergesort')[:remainder]] += 1
+    return np.repeat(np.arange(self.class_index.num_classes), counts)
+
+  def step(self):
+    self.batch += 1
+    if self.batch >= len(self):
+      self.epoch += 1
+      self.batch = 0
+
+  def state_dict(self):
+    return {'seed': int(self.seed), 'epoch': self.epoch, 'batch': self.batch,
+            'num_examples': len(self.class_index), 'mode': self.mode}
+
+  def load_state_dict(self, state):
+    if state.get('num_examples') != len(self.class_index) or state.get('mode') != self.mode:
+      print(" [!] Sampler state is for a different dataset or sampling mode, ignoring it")
+      return
+    self.seed = state['seed']
+    self.epoch = state['epoch']
+    self.batch = state['batch']
+
+def read_idx(path):
+  """Memory-maps a uint8 IDX file (the MNIST format) without copying it."""
+  with open(path, 'rb') as f:
+    magic = bytearray(f.read(4))
+    if magic[0] != 0 or magic[1] != 0 or magic[2] != 0x08:
+      raise ValueError('{} is not a uint8 IDX file'.format(path))
+    ndim = magic[3]
+    shape = tuple(int(d) for d in np.frombuffer(f.read(4 * ndim), dtype='>u4'))
+  return np.memmap(path, dtype=np.uint8, mode='r', offset=4 + 4 * ndim, shape=shape)
+
+def load_uint8_image(path, input_height, input_width,
+                     resize_height=64, resize_width=64,
+                     crop=True, grayscale=False):
+  """Same crop and resize as `load_image_batch`, rounded to HxWxC uint8."""
+  image = imread_uint8(path, grayscale)
+  pixels = resize_batch(image[None], input_height, input_width,
+                        resize_height, resize_width, crop=crop)[0]
+  # Resized pixels are weighted means, so they stay within [0, 255]
+  pixels += .5
+  return pixels.astype(np.uint8)
+
+def normalize_batch(images):
+  """Maps uint8 pixels to float32 in [-1, 1], like `utils.transform`."""
+  return images.astype(np.float32) * np.float32(1/127.5) - np.float32(1.)
+
+def load_cached_batch(indices, images, labels=None, random_flip=False):
+  # Sorted reads keep memmap access sequential within the batch
+  indices = np.sort(indices)
+  if random_flip:
+    _, h, w, _ = images.shape
+    batch_images = transform_batch(images[indices], h, w, h, w, crop=False,
+                                   random_flip=True)
+  else:
+    batch_images = normalize_batch(images[indices])
+  if labels is None:
+    return batch_images, None
+  return batch_images, labels[indices]
+
+def imread_uint8(path, grayscale=False):
+  """Decodes `path` as stored, HxWxC uint8 without rescaling."""
+  if grayscale:
+    image = np.asarray(Image.open(path).convert('L'), dtype=np.uint8)
+  else:
+    image = np.asarray(scipy.misc.imread(path), dtype=np.uint8)
+  if image.ndim == 2:
+    image = image[:, :, None]
+  return image
+
+def read_channels(path):
+  """Channel count `scipy.misc.imread` will produce, from the header only."""
+  image = Image.open(path)
+  if image.mode == 'P':
+    return 4 if 'transparency' in image.info else 3
+  if image.mode in ('1', 'L', 'I', 'F'):
+    return 1
+  return len(image.getbands())
+
+def _load_chunk(chunk, load_fn):
+  rows, paths = chunk
+  return rows, np.stack([load_fn(path) for path in paths])
+
+def load_images_parallel(paths, out, load_fn, rows=None, num_workers=None,
+                         chunk_size=64, use_processes=True):
+  """Decodes `paths` on a process pool straight into the preallocated `out`.
+
+  Args:
+    paths: Image files to decode.
+    out: Array (or memmap) with one row per destination image.
+    load_fn: Picklable function mapping a path to an HxWxC array.
+    rows: (optional) Row of `out` for each path. If None, path i goes to row i [None]
+    num_workers: (optional) Number of decoding processes. If None, one per CPU [None]
+    chunk_size: Number of images decoded per task. [64]
+  """
+  num_workers = num_workers or multiprocessing.cpu_count()
+  rows = np.arange(len(paths)) if rows is None else np.asarray(rows)
+  chunks = [(rows[start:start + chunk_size], paths[start:start + chunk_size])
+            for start in xrange(0, len(paths), chunk_size)]
+  prefetcher = BatchPrefetcher(partial(_load_chunk, load_fn=load_fn), chunks,
+                               queue_size=2 * num_workers,
+                               num_workers=num_workers,
+                               use_processes=use_processes)
+  for chunk_rows, chunk in prefetcher:
+    out[chunk_rows] = chunk
+  return out
+
+def image_cache_key(paths, **settings):
+  """Hashes preprocessing `settings` and the size/mtime of every source file."""
+  key = hashlib.sha1()
+  key.update(json.dumps([CACHE_VERSION, sorted(settings.items())]).encode('utf-8'))
+  for path in paths:
+    stat = os.stat(path)
+    key.update(('%s:%d:%r\n' % (path, stat.st_size, stat.st_mtime)).encode('utf-8'))
+  return key.hexdigest()[:16]
+
+def build_image_cache(cache_path, paths, labels=None, settings=None,
+                      num_workers=None, **image_kwargs):
+  """Decodes `paths` once into `cache_path`/images.npy as uint8.
+
+  Writes images.npy, an optional labels.npy and manifest.json into a
+  temporary directory that is renamed into place when complete, so an
+  interrupted build never leaves a partial cache behind.
+  """
+  tmp_path = '%s.tmp%d' % (cache_path, os.getpid())
+  if os.path.exists(tmp_path):
+    shutil.rmtree(tmp_path)
+  os.makedirs(tmp_path)
+
+  c_dim = 1 if image_kwargs.get('grayscale') else read_channels(paths[0])
+  shape = (image_kwargs['resize_height'], image_kwargs['resize_width'], c_dim)
+  images = np.lib.format.open_memmap(
+      os.path.join(tmp_path, 'images.npy'), mode='w+', dtype=np.uint8,
+      shape=(len(paths),) + shape)
+
+  load_images_parallel(paths, images, partial(load_uint8_image, **image_kwargs),
+                       num_workers=num_workers)
+  images.flush()
+  del images
+
+  if labels is not None:
+    np.save(os.path.join(tmp_path, 'labels.npy'), np.asarray(labels))
+
+  manifest = {
+    'version': CACHE_VERSION,
+    'count': len(paths),
+    'shape': list(shape),
+    'dtype': 'uint8',
+    'settings': settings or {},
+    'labels': labels is not None,
+    'files': list(paths),
+  }
+  with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+    json.dump(manifest, f)
+
+  if os.path.exists(cache_path):
+    shutil.rmtree(cache_path)
+  os.rename(tmp_path, cache_path)
+
+def load_image_cache(cache_path):
+  """Opens a cache written by `build_image_cache` without reading it.
+
+  Returns:
+    (images, labels, manifest) where `images` is a read-only uint8 memmap and
+    `labels` is None when the cache has no labels.
+  """
+  with open(os.path.join(cache_path, 'manifest.json')) as f:
+    manifest = json.load(f)
+  images = np.load(os.path.join(cache_path, 'images.npy'), mmap_mode='r')
+  labels = None
+  if manifest['labels']:
+    labels = np.load(os.path.join(cache_path, 'labels.npy'), mmap_mode='r')
+  return images, labels, manifest
+
+def cached_image_dataset(cache_dir, paths, dataset_name, input_fname_pattern,
+                         input_height, input_width, resize_height, resize_width,
+                         crop, grayscale, labels=None, num_workers=None):
+  """Returns (images, labels) from the cache, building it on first use."""
+  settings = {
+    'dataset_name': dataset_name,
+    'input_fname_pattern': input_fname_pattern,
+    'input_height': input_height,
+    'input_width': input_width,
+    'resize_height': resize_height,
+    'resize_width': resize_width,
+    'crop': crop,
+    'grayscale': grayscale,
+  }
+  key = image_cache_key(paths, **settings)
+  cache_path = os.path.join(cache_dir, '{}_{}'.format(
+      dataset_name.replace('/', '_'), key))
+
+  if not os.path.exists(os.path.join(cache_path, 'manifest.json')):
+    print(" [*] Building image cache {}".format(cache_path))
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    build_image_cache(cache_path, paths, labels=labels, settings=settings,
+                      num_workers=num_workers,
+                      input_height=input_height, input_width=input_width,
+                      resize_height=resize_height, resize_width=resize_width,
+                      crop=crop, grayscale=grayscale)
+
+  images, labels, _ = load_image_cache(cache_path)
+  return images, labels
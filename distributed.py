@@ -0,0 +1,75 @@
+"""
+Between-graph replicated training for DCGAN: cluster setup, placement of
+the G and D variables on parameter servers, and worker start-up.
+
+Every worker builds the same graph; variables live on the `ps` job and
+each worker applies its own updates to them asynchronously.
+"""
+import time
+import tensorflow as tf
+
+def parse_hosts(hosts):
+  """List of host:port from a comma separated flag value."""
+  return [host.strip() for host in hosts.split(',') if host.strip()]
+
+def create_cluster(ps_hosts, worker_hosts):
+  if not ps_hosts or not worker_hosts:
+    raise ValueError("A cluster needs at least one ps and one worker host")
+  return tf.train.ClusterSpec({'ps': ps_hosts, 'worker': worker_hosts})
+
+class GanPsStrategy(object):
+  """Chooses the parameter server task of each variable.
+
+  D and G are updated one after the other, so with two or more ps tasks
+  the generator layers go round robin over the first half and the
+  discriminator layers over the rest. Variables are grouped by layer
+  (`generator/g_h0_lin/...`), which keeps optimizer slots on the task of
+  their variable. Anything else, e.g. the global step, goes to task 0.
+
+  Args:
+    num_tasks: Number of tasks in the ps job.
+  """
+  def __init__(self, num_tasks):
+    half = max(1, num_tasks // 2)
+    self.tasks = {
+      'generator': list(range(half)),
+      'discriminator': list(range(num_tasks - half, num_tasks)),
+    }
+    self.layers = {}
+
+  def __call__(self, op):
+    names = op.name.split('/')
+    tasks = self.tasks.get(names[0])
+    if tasks is None or len(names) < 2:
+      return 0
+    layer = '/'.join(names[:2])
+    if layer not in self.layers:
+      count = sum(1 for name in self.layers if name.startswith(names[0] + '/'))
+      self.layers[layer] = tasks[count % len(tasks)]
+    return self.layers[layer]
+
+def replica_device_setter(cluster, task_index):
+  """Device function putting ops on this worker and variables on the ps job."""
+  return tf.train.replica_device_setter(
+      worker_device='/job:worker/task:{}'.format(task_index),
+      cluster=cluster,
+      ps_strategy=GanPsStrategy(cluster.num_tasks('ps')))
+
+class StartBarrier(object):
+  """Holds the other workers until the chief has set up the variables.
+
+  The flag lives on the parameter servers outside every collection, so
+  neither `global_variables_initializer` nor the Saver touches it. The
+  chief initializes it after all other variables were initialized or
+  restored from a checkpoint.
+  """
+  def __init__(self):
+    self.flag = tf.Variable(True, trainable=False, collections=[], name='start_barrier')
+    self._ready = tf.is_variable_initialized(self.flag)
+
+  def release(self, sess):
+    sess.run(self.flag.initializer)
+
+  def wait(self, sess, poll_secs=1.):
+    while not sess.run(self._ready):
+      time.sleep(poll_secs)
@@ -0,0 +1,220 @@
+"""
+Export of a trained DCGAN generator as a frozen inference graph.
+
+Only the `create_generator` path of the configured model is built. Each
+`g_bn*` batch norm is folded, with its moving averages, into the linear
+or deconv2d layer before it, and every weight becomes a constant, so
+sampling needs no checkpoint, dataset or discriminator.
+"""
+import os
+import re
+import json
+import time
+import numpy as np
+import tensorflow as tf
+
+GRAPH_NAME = 'generator.pb'
+SIGNATURE_NAME = 'generator.json'
+
+def latest_checkpoint(checkpoint_dir):
+  """(path, step) of the newest checkpoint in `checkpoint_dir`."""
+  state = tf.train.get_checkpoint_state(checkpoint_dir)
+  if not state or not state.model_checkpoint_path:
+    raise IOError("No checkpoint found in {}".format(checkpoint_dir))
+  path = os.path.join(checkpoint_dir, os.path.basename(state.model_checkpoint_path))
+  return path, int(re.search(r'(\d+)$', path).group(1))
+
+def read_generator_weights(checkpoint_path):
+  """Dict of variable name -> array for the generator variables of a checkpoint."""
+  reader = tf.train.NewCheckpointReader(checkpoint_path)
+  return dict((name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map()
+              if name.startswith('generator/'))
+
+def fold_batch_norms(weights, epsilon=1e-5):
+  """Folds every generator/g_bnK into the layer g_hK or g_hK_lin before it.
+
+  With s = gamma / sqrt(moving_variance + epsilon), the batch norm of
+  x = W v + b is (s W) v + s (b - moving_mean) + beta. For a linear layer
+  reshaped into a feature map before its batch norm, as `g_h0_lin` is, s
+  is tiled over the spatial positions; channels are the fastest axis.
+
+  Returns:
+    New dict without the batch norm variables.
+  """
+  folded = dict(weights)
+  for name in sorted(weights):
+    match = re.match(r'^generator/(g_bn(\d+))/gamma$', name)
+    if not match:
+      continue
+    bn, index = 'generator/' + match.group(1), match.group(2)
+    scale = weights[bn + '/gamma'] / np.sqrt(weights[bn + '/moving_variance'] + epsilon)
+    shift = weights[bn + '/beta'] - weights[bn + '/moving_mean'] * scale
+
+    if 'generator/g_h{}_lin/Matrix'.format(index) in weights:
+      layer = 'generator/g_h{}_lin'.format(index)
+      matrix, bias = layer + '/Matrix', layer + '/bias'
+      reps = weights[matrix].shape[1] // len(scale)
+      scale, shift = np.tile(scale, reps), np.tile(shift, reps)
+      folded[matrix] = weights[matrix] * scale[None, :]
+      folded[bias] = weights[bias] * scale + shift
+    else:
+      # deconv2d filters are [height, width, output_channels, in_channels]
+      layer = 'generator/g_h{}'.format(index)
+      w, biases = layer + '/w', layer + '/biases'
+      folded[w] = weights[w] * scale[None, None, :, None]
+      folded[biases] = weights[biases] * scale + shift
+
+    for var in ('gamma', 'beta', 'moving_mean', 'moving_variance'):
+      del folded['{}/{}'.format(bn, var)]
+  return folded
+
+def _folded_norm(x, train=False):
+  """Stands in for a g_bn layer already folded into the layer before it."""
+  return x
+
+def _constant_getter(values):
+  def getter(get_variable, name, *args, **kwargs):
+    if name not in values:
+      raise KeyError("{} is not in the exported weights".format(name))
+    return tf.constant(values[name], name=name.split('/')[-1])
+  return getter
+
+def _generator_inputs(gen):
+  z = tf.placeholder(tf.float32, [None, gen.z_dim], name='z')
+  y = tf.placeholder(tf.float32, [None, gen.y_dim], name='y') if gen.y_dim else None
+  return z, y
+
+def build_frozen_generator(gen, folded):
+  """Graph of the generator with folded weights as constants, for any batch size.
+
+  Returns:
+    (graph, z, y, output); y is None without labels.
+  """
+  for idx in range(4):
+    setattr(gen, 'g_bn{}'.format(idx), _folded_norm)
+  graph = tf.Graph()
+  with graph.as_default():
+    z, y = _generator_inputs(gen)
+    with tf.variable_scope(tf.get_variable_scope(), custom_getter=_constant_getter(folded)):
+      output = tf.identity(gen.create_generator(z, y, train=False), name='G')
+  return graph, z, y, output
+
+def build_reference_generator(gen):
+  """Graph of the generator as trained, with variables, as `DCGAN.sampler` builds it."""
+  graph = tf.Graph()
+  with graph.as_default():
+    z, y = _generator_inputs(gen)
+    output = gen.create_generator(z, y, train=False)
+  return graph, z, y, output
+
+def _count_ops(graph, output):
+  graph_def = tf.graph_util.extract_sub_graph(graph.as_graph_def(), [output.op.name])
+  return len(graph_def.node)
+
+def generator_config(weights, y_dim=None):
+  """(z_dim, c_dim) of the generator whose variables are `weights`."""
+  z_dim = weights['generator/g_h0_lin/Matrix'].shape[0] - (y_dim or 0)
+  # The output layer is the deconv2d with the highest index
+  last = max((name for name in weights if re.match(r'^generator/g_h\d+/w$', name)),
+             key=lambda name: int(re.search(r'g_h(\d+)', name).group(1)))
+  return z_dim, weights[last].shape[2]
+
+def export_generator(export_dir, checkpoint_dir, imsize, dataset_name, batch_size,
+                     y_dim=None, model="fc", check_size=64):
+  """Writes generator.pb and generator.json for the latest checkpoint of a run.
+
+  The run is found like `DCGAN.load` does, from `dataset_name`,
+  `batch_size` and `imsize`. The folded graph is checked against the
+  checkpoint's generator on random inputs before it is written.
+
+  Args:
+    export_dir: Output directory.
+    checkpoint_dir: Checkpoint root passed to training.
+    imsize: Output height and width.
+    dataset_name: Dataset the run trained on.
+    batch_size: Training batch size.
+    y_dim: (optional) Label dimension of a conditional generator. [None]
+    model: (optional) Generator architecture [fc, cond]. [fc]
+    check_size: (optional) Number of random inputs the folded graph is checked on. [64]
+  """
+  # The training stack is only needed here, not to load an export
+  from model import DCGAN
+
+  gen = DCGAN.generator_only(None, imsize, c_dim=None, y_dim=y_dim, model=model,
+                             dataset_name=dataset_name, batch_size=batch_size)
+  checkpoint_path, step = latest_checkpoint(os.path.join(checkpoint_dir, gen.model_dir))
+  weights = read_generator_weights(checkpoint_path)
+  gen.z_dim, gen.c_dim = generator_config(weights, y_dim)
+
+  ref_graph, ref_z, ref_y, ref_output = build_reference_generator(gen)
+  with ref_graph.as_default():
+    saver = tf.train.Saver(dict((var.op.name, var) for var in tf.global_variables()))
+  folded = fold_batch_norms(weights)
+  graph, z, y, output = build_frozen_generator(
+      DCGAN.generator_only(None, imsize, gen.c_dim, y_dim=y_dim, z_dim=gen.z_dim, model=model),
+      folded)
+
+  # The folded graph has to match the trained one in inference mode
+  rng = np.random.RandomState(0)
+  batch_z = rng.uniform(-1, 1, [check_size, gen.z_dim]).astype(np.float32)
+  batch_y = np.eye(y_dim, dtype=np.float32)[rng.randint(y_dim, size=check_size)] if y_dim else None
+  with tf.Session(graph=ref_graph) as sess:
+    saver.restore(sess, checkpoint_path)
+    expected = sess.run(ref_output, {ref_z: batch_z, ref_y: batch_y} if y_dim else {ref_z: batch_z})
+  with tf.Session(graph=graph) as sess:
+    actual = sess.run(output, {z: batch_z, y: batch_y} if y_dim else {z: batch_z})
+  max_error = float(np.abs(actual - expected).max())
+
+  if not os.path.exists(export_dir):
+    os.makedirs(export_dir)
+  tf.train.write_graph(graph.as_graph_def(), export_dir, GRAPH_NAME, as_text=False)
+  signature = {
+    'step': step, 'model': model, 'imsize': imsize, 'c_dim': int(gen.c_dim),
+    'z_dim': int(gen.z_dim), 'y_dim': y_dim,
+    'inputs': {'z': z.name, 'y': y.name if y is not None else None},
+    'output': output.name,
+    'ops': _count_ops(graph, output), 'reference_ops': _count_ops(ref_graph, ref_output),
+    'max_abs_error': max_error,
+  }
+  with open(os.path.join(export_dir, SIGNATURE_NAME), 'w') as f:
+    json.dump(signature, f, indent=2)
+  print(" [*] Exported the generator of step {} to {}: {} ops instead of {}, max abs error {:.2e}".format(
+      step, export_dir, signature['ops'], signature['reference_ops'], max_error))
+  return signature
+
+class FrozenGenerator(object):
+  """Samples from a generator written by `export_generator`.
+
+  Loading parses one GraphDef; there are no variables to restore.
+
+  Args:
+    export_dir: Directory with generator.pb and generator.json.
+    config: (optional) tf.ConfigProto of the session. [None]
+  """
+  def __init__(self, export_dir, config=None):
+    start_time = time.time()
+    with open(os.path.join(export_dir, SIGNATURE_NAME)) as f:
+      self.signature = json.load(f)
+    graph_def = tf.GraphDef()
+    with open(os.path.join(export_dir, GRAPH_NAME), 'rb') as f:
+      graph_def.ParseFromString(f.read())
+
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      tf.import_graph_def(graph_def, name='')
+    inputs = self.signature['inputs']
+    self.z = self.graph.get_tensor_by_name(inputs['z'])
+    self.y = self.graph.get_tensor_by_name(inputs['y']) if inputs['y'] else None
+    self.output = self.graph.get_tensor_by_name(self.signature['output'])
+    self.sess = tf.Session(graph=self.graph, config=config)
+    self.load_time = time.time() - start_time
+
+  def sample(self, z, y=None):
+    """Images in [-1, 1] for latent vectors `z` and, if conditional, one-hot `y`."""
+    feed_dict = {self.z: z}
+    if self.y is not None:
+      feed_dict[self.y] = y
+    return self.sess.run(self.output, feed_dict)
+
+  def close(self):
+    self.sess.close()
@@ -0,0 +1,219 @@
+"""
+Bulk generation of images from an exported DCGAN generator, e.g. for
+dataset augmentation.
+
+    $ python generate.py --export_dir export/mnist --out_dir generated/mnist --num_images 1000000
+
+Image i has seed `seed_start + i`, so it matches `/sample?seed=...` of
+`web/app.py` on the same export. Images are split into shards of
+`--shard_size`. A shard is either a folder of PNGs with an index.csv of
+file, seed and label, or one .npz holding uint8 `images`, `seeds` and
+`labels`. index.json lists the finished shards. Rerunning the same
+command skips them, so an interrupted run resumes where it stopped. The
+sampler runs large batches on the main thread, and a pool of threads
+encodes and writes them.
+"""
+
+from __future__ import print_function
+import os
+import json
+import time
+import shutil
+import argparse
+import collections
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from export import FrozenGenerator
+from serving import seeded_z, to_uint8
+
+INDEX_NAME = 'index.json'
+
+parser = argparse.ArgumentParser(description='Generate images in bulk from an exported DCGAN generator.')
+parser.add_argument('--export_dir', type=str, required=True,
+           help='directory written by main.py --export_dir')
+parser.add_argument('--out_dir', type=str, required=True,
+           help='directory for the shards and their index')
+parser.add_argument('--num_images', type=int, required=True, help='number of images to generate')
+parser.add_argument('--seed_start', type=int, default=0, help='seed of the first image [0]')
+parser.add_argument('--class_weights', type=str, default='',
+           help='comma separated weight per class of a conditional generator; uniform if empty []')
+parser.add_argument('--format', type=str, default='npz', choices=['npz', 'png'],
+           help='npz shards or folders of PNGs [npz]')
+parser.add_argument('--shard_size', type=int, default=10000, help='images per shard [10000]')
+parser.add_argument('--batch_size', type=int, default=1024, help='images per sampler run [1024]')
+parser.add_argument('--workers', type=int, default=4, help='threads encoding and writing images [4]')
+parser.add_argument('--report_every', type=float, default=10., help='seconds between progress lines [10]')
+
+def shard_plan(num_images, shard_size):
+  """(shard index, first image, count) of every shard."""
+  return [(idx, start, min(shard_size, num_images - start))
+          for idx, start in enumerate(range(0, num_images, shard_size))]
+
+def shard_labels(weights, count, seed):
+  """Labels of one shard, in the proportions of `weights`, shuffled by `seed`.
+
+  Class counts are rounded so they sum to `count`, so every shard has the
+  class mix of the whole run.
+  """
+  weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+  counts = np.floor(weights * count).astype(np.int64)
+  # Hand the rounding remainder to the classes with the largest fractions
+  remainder = np.argsort(-(weights * count - counts))[:count - counts.sum()]
+  counts[remainder] += 1
+  labels = np.repeat(np.arange(len(weights)), counts)
+  np.random.RandomState(seed).shuffle(labels)
+  return labels
+
+def write_pngs(directory, pixels, seeds, labels):
+  """Writes one PNG per image; returns the index.csv rows."""
+  from PIL import Image
+  rows = []
+  for image, seed, label in zip(pixels, seeds, labels):
+    name = '{}.png'.format(seed)
+    Image.fromarray(np.squeeze(image, axis=2) if image.shape[2] == 1 else image).save(
+        os.path.join(directory, name))
+    rows.append('{},{},{}\n'.format(name, seed, '' if label < 0 else label))
+  return rows
+
+def write_npz(path, pixels, seeds, labels):
+  # np.savez adds .npz to names without it
+  with open(path, 'wb') as f:
+    np.savez(f, images=pixels, seeds=seeds, labels=labels)
+
+def read_index(out_dir, config):
+  """Finished shards of an earlier run with the same config, by shard index."""
+  path = os.path.join(out_dir, INDEX_NAME)
+  if not os.path.exists(path):
+    return {}
+  with open(path) as f:
+    index = json.load(f)
+  if index['config'] != config:
+    raise ValueError("{} was written with a different config:\n{}\nUse another --out_dir".format(
+        path, json.dumps(index['config'], indent=2, sort_keys=True)))
+  return dict((shard['shard'], shard) for shard in index['shards'])
+
+def write_index(out_dir, config, shards):
+  path = os.path.join(out_dir, INDEX_NAME)
+  with open(path + '.tmp', 'w') as f:
+    json.dump({'config': config, 'images': sum(shard['count'] for shard in shards.values()),
+               'shards': [shards[idx] for idx in sorted(shards)]}, f, indent=2)
+  os.rename(path + '.tmp', path)
+
+def main():
+  args = parser.parse_args()
+  generator = FrozenGenerator(args.export_dir)
+  signature = generator.signature
+  y_dim = signature['y_dim']
+  weights = None
+  if y_dim:
+    weights = [float(w) for w in args.class_weights.split(',')] if args.class_weights else [1.] * y_dim
+    if len(weights) != y_dim:
+      raise ValueError("--class_weights needs {} weights, got {}".format(y_dim, len(weights)))
+  elif args.class_weights:
+    raise ValueError("The generator takes no labels")
+
+  # Everything that decides which image goes where
+  config = {'step': signature['step'], 'model': signature['model'], 'imsize': signature['imsize'],
+            'quantization': signature.get('quantization'), 'num_images': args.num_images,
+            'seed_start': args.seed_start, 'class_weights': weights, 'format': args.format,
+            'shard_size': args.shard_size}
+  if not os.path.exists(args.out_dir):
+    os.makedirs(args.out_dir)
+  done = read_index(args.out_dir, config)
+  plan = [shard for shard in shard_plan(args.num_images, args.shard_size) if shard[0] not in done]
+  if done:
+    print(" [*] Resuming: {} of {} shards already written".format(len(done), len(done) + len(plan)))
+
+  pool = ThreadPool(args.workers)
+  input_pool = ThreadPool(1)
+  # Bounds the batches held in memory while the writers catch up
+  max_pending = 2 * args.workers
+  pending_writes = collections.deque()
+  pending_shards = collections.deque()
+
+  def finish_shards(block):
+    while pending_shards and (block or all(result.ready() for result in pending_shards[0][-1])):
+      (idx, start, count), tmp_path, path, class_counts, results = pending_shards.popleft()
+      rows = [row for result in results for row in (result.get() or [])]
+      if args.format == 'png':
+        with open(os.path.join(tmp_path, 'index.csv'), 'w') as f:
+          f.write('file,seed,label\n')
+          f.writelines(rows)
+      if os.path.exists(path):
+        # Left over from a run interrupted between the rename and the index
+        if os.path.isdir(path):
+          shutil.rmtree(path)
+        else:
+          os.remove(path)
+      os.rename(tmp_path, path)
+      done[idx] = {'shard': idx, 'path': os.path.basename(path), 'start': start, 'count': count,
+                   'first_seed': args.seed_start + start, 'class_counts': class_counts}
+      write_index(args.out_dir, config, done)
+
+  start_time = last_report = time.time()
+  sample_secs, generated = 0., 0
+  total = sum(count for _, _, count in plan)
+  try:
+    for idx, start, count in plan:
+      name = 'shard-{:05d}'.format(idx) + ('.npz' if args.format == 'npz' else '')
+      path = os.path.join(args.out_dir, name)
+      tmp_path = path + '.tmp'
+      if args.format == 'png':
+        if os.path.exists(tmp_path):
+          shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+      seeds = np.arange(args.seed_start + start, args.seed_start + start + count, dtype=np.int64)
+      labels = shard_labels(weights, count, args.seed_start + idx) if y_dim else -np.ones(count, np.int64)
+      class_counts = dict((str(c), int(n)) for c, n in zip(*np.unique(labels, return_counts=True))) if y_dim else None
+
+      results, shard_pixels = [], []
+      # z of the next batch is drawn while the sampler runs this one
+      next_z = input_pool.apply_async(seeded_z, (seeds[:args.batch_size], signature['z_dim']))
+      for offset in range(0, count, args.batch_size):
+        batch_seeds, batch_labels = seeds[offset:offset + args.batch_size], labels[offset:offset + args.batch_size]
+        z = next_z.get()
+        if offset + args.batch_size < count:
+          next_z = input_pool.apply_async(
+              seeded_z, (seeds[offset + args.batch_size:offset + 2 * args.batch_size], signature['z_dim']))
+        y = np.eye(y_dim, dtype=np.float32)[batch_labels] if y_dim else None
+        sample_start = time.time()
+        pixels = to_uint8(generator.sample(z, y))
+        sample_secs += time.time() - sample_start
+        generated += len(pixels)
+
+        if args.format == 'png':
+          result = pool.apply_async(write_pngs, (tmp_path, pixels, batch_seeds, batch_labels))
+          results.append(result)
+          pending_writes.append(result)
+        else:
+          shard_pixels.append(pixels)
+        while len(pending_writes) > max_pending:
+          pending_writes.popleft().wait()
+        finish_shards(block=False)
+
+        if time.time() - last_report >= args.report_every:
+          last_report = time.time()
+          print(" [*] {}/{} images, {:.1f} images/sec".format(
+              generated, total, generated / (last_report - start_time)))
+
+      if args.format == 'npz':
+        result = pool.apply_async(write_npz, (tmp_path, np.concatenate(shard_pixels), seeds, labels))
+        results.append(result)
+        pending_writes.append(result)
+      pending_shards.append(((idx, start, count), tmp_path, path, class_counts, results))
+    finish_shards(block=True)
+  finally:
+    input_pool.close()
+    pool.close()
+    pool.join()
+    generator.close()
+
+  elapsed = time.time() - start_time
+  print(" [*] Wrote {} images in {:.1f}s: {:.1f} images/sec, {:.1f} images/sec in the sampler alone".format(
+      generated, elapsed, generated / max(elapsed, 1e-9), generated / max(sample_secs, 1e-9)))
+  print(" [*] Index: {}".format(os.path.join(args.out_dir, INDEX_NAME)))
+
+if __name__ == '__main__':
+  main()
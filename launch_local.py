@@ -0,0 +1,118 @@
+"""
+Runs DCGAN training as a local cluster, with one process per parameter
+server and worker on localhost, and reports throughput against a single
+process trained on the same flags.
+
+    $ python launch_local.py --workers 2,4 -- --dataset mnist --epoch 3
+
+Every run gets its own checkpoint, sample and log directories under
+`--run_dir`, so runs do not resume from each other. Throughput is read
+from the `images_per_sec` column of the per-worker metrics logs; the first
+epoch of each worker is skipped as warm-up when there are later ones.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import csv
+import time
+import argparse
+import subprocess
+from glob import glob
+
+parser = argparse.ArgumentParser(description='Measure distributed DCGAN throughput on localhost.')
+parser.add_argument('--workers', type=str, default='2',
+           help='comma separated worker counts to run [2]')
+parser.add_argument('--num_ps', type=int, default=1,
+           help='number of parameter servers per cluster [1]')
+parser.add_argument('--base_port', type=int, default=2222,
+           help='first port used by the cluster processes [2222]')
+parser.add_argument('--run_dir', type=str, default='scaling',
+           help='directory for the checkpoints, samples and logs of every run [scaling]')
+parser.add_argument('--skip_single', action='store_true',
+           help='do not run the single process baseline')
+parser.add_argument('main_args', nargs=argparse.REMAINDER,
+           help='flags passed to main.py, after --')
+
+def run_flags(run_dir):
+  return ['--train',
+          '--checkpoint_dir', os.path.join(run_dir, 'checkpoint'),
+          '--sample_dir', os.path.join(run_dir, 'samples'),
+          '--log_dir', os.path.join(run_dir, 'logs'),
+          '--metrics_format', 'csv']
+
+def spawn(args, log_path):
+  log = open(log_path, 'w')
+  return subprocess.Popen([sys.executable, 'main.py'] + args, stdout=log, stderr=subprocess.STDOUT)
+
+def run_single(run_dir, main_args):
+  proc = spawn(main_args + run_flags(run_dir), os.path.join(run_dir, 'single.log'))
+  if proc.wait() != 0:
+    raise RuntimeError("single process run failed, see {}".format(run_dir))
+
+def run_cluster(run_dir, num_workers, num_ps, base_port, main_args):
+  hosts = ['localhost:{}'.format(base_port + i) for i in range(num_ps + num_workers)]
+  cluster_flags = ['--ps_hosts', ','.join(hosts[:num_ps]),
+                   '--worker_hosts', ','.join(hosts[num_ps:])]
+  args = main_args + run_flags(run_dir) + cluster_flags
+
+  ps = [spawn(args + ['--job_name', 'ps', '--task_index', str(idx)],
+              os.path.join(run_dir, 'ps{}.log'.format(idx))) for idx in range(num_ps)]
+  try:
+    workers = [spawn(args + ['--job_name', 'worker', '--task_index', str(idx)],
+                     os.path.join(run_dir, 'worker{}.log'.format(idx))) for idx in range(num_workers)]
+    codes = [proc.wait() for proc in workers]
+  finally:
+    # Parameter servers serve until they are stopped
+    for proc in ps:
+      proc.terminate()
+      proc.wait()
+  if any(codes):
+    raise RuntimeError("a worker failed, see the logs in {}".format(run_dir))
+
+def images_per_sec(run_dir):
+  """Sum over the workers of their mean images/sec after warm-up."""
+  total = 0.
+  for path in glob(os.path.join(run_dir, 'samples', 'metrics*.csv')):
+    with open(path) as f:
+      rates = [float(row['images_per_sec']) for row in csv.DictReader(f)]
+    if len(rates) > 1:
+      rates = rates[1:]
+    if rates:
+      total += sum(rates) / len(rates)
+  return total
+
+def main():
+  args = parser.parse_args()
+  main_args = [arg for arg in args.main_args if arg != '--']
+  worker_counts = [int(n) for n in args.workers.split(',') if n]
+
+  runs = [] if args.skip_single else [('single', 1, None)]
+  runs += [('{} workers'.format(n), n, n) for n in worker_counts]
+
+  results = []
+  for name, num_processes, num_workers in runs:
+    run_dir = os.path.join(args.run_dir, name.replace(' ', '_'))
+    if not os.path.exists(run_dir):
+      os.makedirs(run_dir)
+    print("Running {}...".format(name))
+    start_time = time.time()
+    if num_workers is None:
+      run_single(run_dir, main_args)
+    else:
+      run_cluster(run_dir, num_workers, args.num_ps, args.base_port, main_args)
+    results.append((name, num_processes, images_per_sec(run_dir), time.time() - start_time))
+
+  baseline = results[0][2] if not args.skip_single else None
+  print("")
+  print("{:<12} {:>12} {:>9} {:>11} {:>10}".format('run', 'images/sec', 'speedup', 'efficiency', 'wall (s)'))
+  for name, num_processes, rate, wall in results:
+    if baseline:
+      speedup = rate / baseline
+      print("{:<12} {:>12.1f} {:>8.2f}x {:>10.0f}% {:>10.1f}".format(
+          name, rate, speedup, 100. * speedup / num_processes, wall))
+    else:
+      print("{:<12} {:>12.1f} {:>9} {:>11} {:>10.1f}".format(name, rate, '-', '-', wall))
+
+if __name__ == '__main__':
+  main()
@@ -4,6 +4,9 @@ import numpy as np
 
 from model import DCGAN
 from utils import pp, visualize, to_json, show_all_variables
+from distributed import parse_hosts, create_cluster, replica_device_setter
+from export import export_generator
+from artifacts import ArtifactWriter
 
 import tensorflow as tf
 
@@ -11,20 +14,53 @@ flags = tf.app.flags
 flags.DEFINE_integer("epoch", 25, "Epoch to train [25]")
 flags.DEFINE_float("learning_rate", 0.0002, "Learning rate of for adam [0.0002]")
 flags.DEFINE_float("beta1", 0.5, "Momentum term of adam [0.5]")
+flags.DEFINE_integer("num_towers", 1, "Number of data-parallel copies of G and D, each on a slice of the batch [1]")
+flags.DEFINE_string("tower_device", "cpu", "Device type of the towers; cpu towers get one CPU device group each [cpu, gpu]")
+flags.DEFINE_integer("g_steps", 2, "Number of G updates per D update [2]")
 flags.DEFINE_integer("train_size", np.inf, "The size of train images [np.inf]")
 flags.DEFINE_integer("batch_size", 64, "The size of batch images [64]")
 flags.DEFINE_integer("input_height", 108, "The size of image to use (will be center cropped). [108]")
 flags.DEFINE_integer("input_width", None, "The size of image to use (will be center cropped). If None, same value as input_height [None]")
 flags.DEFINE_integer("output_height", 64, "The size of the output images to produce [64]")
 flags.DEFINE_integer("output_width", None, "The size of the output images to produce. If None, same value as output_height [None]")
+flags.DEFINE_integer("z_dim", 100, "Dimension of the generator's input noise z [100]")
 flags.DEFINE_string("dataset", "celebA", "The name of dataset [celebA, mnist, lsun]")
 flags.DEFINE_string("input_fname_pattern", "*.jpg", "Glob pattern of filename of input images [*]")
 flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name to save the checkpoints [checkpoint]")
 flags.DEFINE_string("sample_dir", "samples", "Directory name to save the image samples [samples]")
+flags.DEFINE_string("log_dir", "logs", "Directory name to save the TensorBoard summaries [logs]")
+flags.DEFINE_integer("scalar_summary_every", 100, "Write loss summaries every N steps, 0 to disable [100]")
+flags.DEFINE_integer("histogram_summary_every", 500, "Write z and D output histograms every N steps, 0 to disable [500]")
+flags.DEFINE_integer("image_summary_every", 1000, "Write generated image summaries every N steps, 0 to disable [1000]")
+flags.DEFINE_string("metrics_format", "csv", "Format of the per-epoch loss log in sample_dir [csv, jsonl]")
+flags.DEFINE_integer("metrics_flush_every", 10, "Number of epochs of losses buffered before writing the log [10]")
+flags.DEFINE_integer("artifact_threads", 2, "Number of threads encoding and writing samples, GIFs and metric logs in the background [2]")
+flags.DEFINE_integer("artifact_queue_size", 8, "Number of writes queued per artifact thread before the caller waits [8]")
 flags.DEFINE_boolean("train", False, "True for training, False for testing [False]")
 flags.DEFINE_boolean("crop", False, "True for training, False for testing [False]")
 flags.DEFINE_boolean("visualize", False, "True for visualizing, False for nothing [False]")
 flags.DEFINE_integer("generate_test_images", 100, "Number of images to generate during test. [100]")
+flags.DEFINE_integer("prefetch_queue_size", 8, "Number of decoded batches to keep ready for image folder datasets [8]")
+flags.DEFINE_integer("prefetch_workers", 4, "Number of workers decoding image folder batches [4]")
+flags.DEFINE_boolean("prefetch_processes", False, "True to decode batches in worker processes instead of threads [False]")
+flags.DEFINE_string("class_sampling", "none", "How conditional batches pick labels [none, balanced, weighted] [none]")
+flags.DEFINE_string("class_weights", "", "Comma separated weight per class for --class_sampling=weighted []")
+flags.DEFINE_integer("load_workers", None, "Number of processes decoding images at load time. If None, one per CPU [None]")
+flags.DEFINE_boolean("random_flip", False, "True to mirror image folder batches at random [False]")
+flags.DEFINE_string("cache_dir", None, "Directory for the preprocessed image cache of image folder datasets. If None, no cache is used [None]")
+flags.DEFINE_boolean("profile", False, "True to time each phase of the training loop and write percentiles to log_dir [False]")
+flags.DEFINE_string("trace_steps", "", "Comma separated steps to trace into Chrome timelines and per-layer op costs in log_dir []")
+flags.DEFINE_boolean("memory_report", True, "True to record memory use per stage to memory.jsonl in log_dir [True]")
+flags.DEFINE_integer("checkpoint_every_steps", 0, "Save a checkpoint every N steps, 0 to disable [0]")
+flags.DEFINE_integer("checkpoint_every_secs", 600, "Save a checkpoint every N seconds, 0 to disable [600]")
+flags.DEFINE_integer("keep_checkpoints", 5, "Number of most recent checkpoints to keep [5]")
+flags.DEFINE_float("keep_checkpoint_every_hours", 10000., "Also keep one checkpoint for good every N hours [10000]")
+flags.DEFINE_string("export_dir", None, "Directory to export the latest checkpoint's generator to as a frozen graph, instead of training or testing. If None, no export [None]")
+flags.DEFINE_integer("shuffle_seed", None, "Seed of the per-epoch shuffles. If None, a random one, or 0 in a cluster [None]")
+flags.DEFINE_string("job_name", "", "Role of this process in a cluster, empty for a single process [ps, worker]")
+flags.DEFINE_integer("task_index", 0, "Index of this process within its job; worker 0 is the chief [0]")
+flags.DEFINE_string("ps_hosts", "", "Comma separated host:port list of the parameter servers []")
+flags.DEFINE_string("worker_hosts", "", "Comma separated host:port list of the workers []")
 FLAGS = flags.FLAGS
 
 def main(_):
@@ -40,42 +76,64 @@ def main(_):
   if not os.path.exists(FLAGS.sample_dir):
     os.makedirs(FLAGS.sample_dir)
 
+  if FLAGS.export_dir:
+    # Only the generator is built; no dataset is loaded
+    export_generator(FLAGS.export_dir, FLAGS.checkpoint_dir,
+                     imsize=FLAGS.output_height, dataset_name=FLAGS.dataset,
+                     batch_size=FLAGS.batch_size,
+                     y_dim=10 if FLAGS.dataset == 'mnist' else None)
+    return
+
+  cluster, server = None, None
+  if FLAGS.job_name:
+    if FLAGS.num_towers > 1:
+      raise ValueError("--num_towers is not supported together with --job_name")
+    cluster = create_cluster(parse_hosts(FLAGS.ps_hosts), parse_hosts(FLAGS.worker_hosts))
+    server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index)
+    if FLAGS.job_name == 'ps':
+      server.join()
+      return
+    if not FLAGS.train:
+      raise ValueError("Cluster jobs only train; run test mode as a single process")
+
+  tower_devices = None
+  if FLAGS.num_towers > 1:
+    tower_devices = ['/{}:{}'.format(FLAGS.tower_device, i) for i in range(FLAGS.num_towers)]
+
   #gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.333)
-  run_config = tf.ConfigProto()
+  run_config = tf.ConfigProto(allow_soft_placement=True)
   run_config.gpu_options.allow_growth=True
+  if tower_devices and FLAGS.tower_device == 'cpu':
+    run_config.device_count['CPU'] = FLAGS.num_towers
 
-  with tf.Session(config=run_config) as sess:
+  # Workers only talk to the parameter servers, never to each other
+  target, device_fn = '', None
+  if cluster is not None:
+    run_config.device_filters.extend(['/job:ps', '/job:worker/task:{}'.format(FLAGS.task_index)])
+    target, device_fn = server.target, replica_device_setter(cluster, FLAGS.task_index)
+
+  with tf.device(device_fn), tf.Session(target, config=run_config) as sess:
+    dcgan_kwargs = dict(
+        input_width=FLAGS.input_width,
+        input_height=FLAGS.input_height,
+        imsize=FLAGS.output_height,
+        batch_size=FLAGS.batch_size,
+        sample_num=FLAGS.batch_size,
+        z_dim=FLAGS.z_dim,
+        dataset_name=FLAGS.dataset,
+        input_fname_pattern=FLAGS.input_fname_pattern,
+        crop=FLAGS.crop,
+        checkpoint_dir=FLAGS.checkpoint_dir,
+        sample_dir=FLAGS.sample_dir,
+        load_workers=FLAGS.load_workers,
+        tower_devices=tower_devices,
+        cluster=cluster,
+        task_index=FLAGS.task_index,
+        memory_report=FLAGS.memory_report)
     if FLAGS.dataset == 'mnist':
-      dcgan = DCGAN(
-          sess,
-          input_width=FLAGS.input_width,
-          input_height=FLAGS.input_height,
-          output_width=FLAGS.output_width,
-          output_height=FLAGS.output_height,
-          batch_size=FLAGS.batch_size,
-          sample_num=FLAGS.batch_size,
-          y_dim=10,
-          z_dim=FLAGS.generate_test_images,
-          dataset_name=FLAGS.dataset,
-          input_fname_pattern=FLAGS.input_fname_pattern,
-          crop=FLAGS.crop,
-          checkpoint_dir=FLAGS.checkpoint_dir,
-          sample_dir=FLAGS.sample_dir)
+      dcgan = DCGAN(sess, y_dim=10, **dcgan_kwargs)
     else:
-      dcgan = DCGAN(
-          sess,
-          input_width=FLAGS.input_width,
-          input_height=FLAGS.input_height,
-          output_width=FLAGS.output_width,
-          output_height=FLAGS.output_height,
-          batch_size=FLAGS.batch_size,
-          sample_num=FLAGS.batch_size,
-          z_dim=FLAGS.generate_test_images,
-          dataset_name=FLAGS.dataset,
-          input_fname_pattern=FLAGS.input_fname_pattern,
-          crop=FLAGS.crop,
-          checkpoint_dir=FLAGS.checkpoint_dir,
-          sample_dir=FLAGS.sample_dir)
+      dcgan = DCGAN(sess, cache_dir=FLAGS.cache_dir, **dcgan_kwargs)
 
     show_all_variables()
 
@@ -92,9 +150,16 @@ def main(_):
     #                 [dcgan.h3_w, dcgan.h3_b, dcgan.g_bn3],
     #                 [dcgan.h4_w, dcgan.h4_b, None])
 
+    if not dcgan.is_chief:
+      return
+
     # Below is codes for visualization
     OPTION = 1
-    visualize(sess, dcgan, FLAGS, OPTION)
+    artifacts = ArtifactWriter(FLAGS.artifact_threads, FLAGS.artifact_queue_size)
+    try:
+      visualize(sess, dcgan, FLAGS, OPTION, writer=artifacts)
+    finally:
+      artifacts.close()
 
 if __name__ == '__main__':
   tf.app.run()
@@ -0,0 +1,148 @@
+"""
+Memory accounting for DCGAN runs: resident set size, NumPy dataset arrays
+and TensorFlow allocator stats at each stage of a run, e.g. data loading,
+graph construction and training steps.
+"""
+import os
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+from summaries import MetricsLog
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+def peak_rss_bytes():
+  """Peak resident set size of this process, or None if unknown."""
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+def rss_bytes():
+  """Current resident set size of this process, or None if unknown."""
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError):
+    return None
+
+def array_bytes(arrays):
+  """Size, shape and dtype of each NumPy array in a dict; other values are skipped.
+
+  Memory-mapped arrays are flagged, since only their touched pages count
+  towards the resident set.
+  """
+  sizes = {}
+  for name, array in arrays.items():
+    if isinstance(array, np.ndarray):
+      sizes[name] = {'bytes': int(array.nbytes), 'shape': list(array.shape),
+                     'dtype': str(array.dtype), 'memmap': isinstance(array, np.memmap)}
+  return sizes
+
+def _format_bytes(size):
+  if size is None:
+    return '?'
+  for unit in ('B', 'KB', 'MB', 'GB'):
+    if abs(size) < 1024. or unit == 'GB':
+      return '{:.1f} {}'.format(size, unit)
+    size /= 1024.
+
+class MemoryReport(object):
+  """Memory use of a run, one record per stage.
+
+  `record` costs a `getrusage` call and a read of /proc/self/statm, plus
+  one `sess.run` of the allocator stat ops when a session is given. Only
+  records made before `open` are kept, until it writes them once the run
+  directory is known, e.g. the data load and graph construction in
+  `DCGAN.__init__`; later ones go straight to the file.
+
+  Args:
+    enabled: Take records. [True]
+  """
+  fields = ['stage', 'step', 'time', 'rss_bytes', 'peak_rss_bytes', 'rss_delta_bytes', 'arrays', 'tf']
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    # Records waiting for `open`, and every stage printed so far
+    self.records = []
+    self._printed = set()
+    self.log = None
+    self._tf_ops = None
+    self._last_rss = None
+
+  def tf_stats(self, sess):
+    """Bytes in use, peak bytes in use and limit of the TF allocator, if available."""
+    if self._tf_ops is None:
+      try:
+        from tensorflow.contrib.memory_stats import BytesInUse, MaxBytesInUse, BytesLimit
+        # The GPU allocator when there is one; soft placement falls back to CPU
+        with tf.device('/gpu:0'):
+          self._tf_ops = {'bytes_in_use': BytesInUse(), 'max_bytes_in_use': MaxBytesInUse(),
+                          'bytes_limit': BytesLimit()}
+      except Exception:
+        self._tf_ops = {}
+    if not self._tf_ops:
+      return None
+    try:
+      values = sess.run(self._tf_ops)
+    except Exception:
+      self._tf_ops = {}
+      return None
+    return dict((name, int(value)) for name, value in values.items())
+
+  def record(self, stage, step=None, arrays=None, sess=None):
+    """Records memory use after `stage`.
+
+    Args:
+      stage: Name of the stage that just finished.
+      step: (optional) Training step. [None]
+      arrays: (optional) Dict of name -> NumPy array to account for. [None]
+      sess: (optional) Session for TF allocator stats. [None]
+    """
+    if not self.enabled:
+      return
+    rss = rss_bytes()
+    row = {'stage': stage, 'step': step, 'time': time.time(), 'rss_bytes': rss,
+           'peak_rss_bytes': peak_rss_bytes()}
+    if rss is not None and self._last_rss is not None:
+      row['rss_delta_bytes'] = rss - self._last_rss
+    self._last_rss = rss
+    if arrays:
+      row['arrays'] = array_bytes(arrays)
+    if sess is not None:
+      row['tf'] = self.tf_stats(sess)
+
+    if self.log is not None:
+      self.log.write(row)
+    else:
+      self.records.append(row)
+    # Repeated stages, e.g. every epoch, go to the file only
+    if stage in self._printed:
+      return
+    self._printed.add(stage)
+    print(" [*] Memory after {}: rss {}, peak rss {}{}".format(
+        stage if step is None else '{} {}'.format(stage, step),
+        _format_bytes(rss), _format_bytes(row['peak_rss_bytes']),
+        '' if row.get('tf') is None else ', tf {}'.format(_format_bytes(row['tf']['max_bytes_in_use']))))
+
+  def open(self, path):
+    """Starts writing records to the JSON lines file `path`, earlier ones first."""
+    if not self.enabled:
+      return
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    self.log = MetricsLog(path, self.fields, fmt='jsonl', flush_every=1)
+    for row in self.records:
+      self.log.write(row)
+    self.records = []
+
+  def close(self):
+    if self.log is not None:
+      self.log.close()
+      self.log = None
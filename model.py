@@ -2,6 +2,7 @@ from __future__ import division
 import os
 import time
 import math
+import json
 from glob import glob
 import tensorflow as tf
 import numpy as np
@@ -9,9 +10,18 @@ from six.moves import xrange
 import scipy.misc
 from ops import *
 from utils import *
+from summaries import AsyncSummaryWriter, SummarySchedule, RunningMeans, MetricsLog
+from distributed import StartBarrier
+from checkpoints import AsyncCheckpointer, CheckpointSchedule
+from profiling import PhaseTimer, StepTracer
+from memory import MemoryReport
+from artifacts import ArtifactWriter
+from data import (BatchPrefetcher, EpochSampler, ClassIndex, ClassSampler,
+                  load_image_batch, load_cached_batch, cached_image_dataset,
+                  read_idx, read_channels, imread_uint8, load_images_parallel)
 import matplotlib.pyplot as plt 
 import csv
-from sklearn.preprocessing import OneHotEncoder
+from functools import partial
 def conv_out_size_same(size, stride):
   return int(math.ceil(float(size) / float(stride)))
 
@@ -21,7 +31,9 @@ class DCGAN(object):
          y_dim=None, z_dim=100, gf_dim=64, df_dim=64,
          gfc_dim=2048, dfc_dim=1024, c_dim=3, dataset_name='default',
          input_fname_pattern='*.jpg', checkpoint_dir=None, sample_dir=None, imsize= 28,
-        gen_activation_function=tf.nn.tanh, model="fc", wgan=False):
+        gen_activation_function=tf.nn.tanh, model="fc", wgan=False,
+        input_height=None, input_width=None, cache_dir=None, load_workers=None,
+        tower_devices=None, cluster=None, task_index=0, memory_report=True):
     """
 
     Args:
@@ -35,13 +47,31 @@ class DCGAN(object):
       dfc_dim: (optional) Dimension of discrim units for fully connected layer. [1024]
       c_dim: (optional) Dimension of image color. For grayscale input, set to 1. [3]
       model: (optional) Fully connected or convolutional [fc, cond]
+      input_height: (optional) Center crop height for image folders. If None, same value as imsize [None]
+      input_width: (optional) Center crop width for image folders. If None, same value as input_height [None]
+      cache_dir: (optional) Directory for a preprocessed uint8 copy of image folders. If None, images are decoded every batch [None]
+      load_workers: (optional) Number of processes decoding images at load time. If None, one per CPU [None]
+      tower_devices: (optional) Devices for data-parallel copies of G and D, e.g. ['/cpu:0', '/cpu:1']. If None, one copy on the default device [None]
+      cluster: (optional) tf.train.ClusterSpec for between-graph replicated training. The graph must be built under `distributed.replica_device_setter` [None]
+      task_index: (optional) Index of this worker in the cluster; worker 0 is the chief [0]
+      memory_report: (optional) Record memory use after data loading, graph construction and training stages [True]
     """
     self.model = model
+    self.wgan = wgan
+    self.crop = crop
     self.sess = sess
     self.gen_activation_function = gen_activation_function
     self.batch_size = batch_size
+    self.tower_devices = tower_devices or [None]
+    self.cluster = cluster
+    self.task_index = task_index
+    self.is_chief = task_index == 0
+    self.num_workers = cluster.num_tasks('worker') if cluster is not None else 1
+    self.memory = MemoryReport(memory_report)
     
     self.imsize = imsize
+    self.input_height = input_height or imsize
+    self.input_width = input_width or self.input_height
 
     self.y_dim = y_dim
     self.z_dim = z_dim
@@ -80,33 +110,72 @@ class DCGAN(object):
       self.data = glob(os.path.join("./data", self.dataset_name, self.input_fname_pattern))
       selected = [199, 196, 210, 238, 240, 239, 237, 224, 378, 377, 370, 364, 390, 376, 438, 454, 450, 449,
                   291, 317, 335, 402, 423, 466, 479, 518, 529, 581, 609, 655, 646, 743, 754, 753, 735, 749]
-      self.data_X = np.zeros((802,self.imsize, self.imsize, c_dim))
+      self.c_dim = read_channels(self.data[0])
       #print self.data_y[0:6] * np.arange(1,19)
       self.data_y = self.data_y#[selected]
       
-      for path in self.data:
-        i = int(path.split("/")[-1].split(".")[0]) -1 
-        im = imread(path)
-        self.data_X[i] = im / 255
+      # Files are named by pokedex number; uint8 rows, scaled per batch
+      rows = [int(path.split("/")[-1].split(".")[0]) - 1 for path in self.data]
+      self.data_X = np.zeros((802, self.imsize, self.imsize, self.c_dim), dtype=np.uint8)
+      load_images_parallel(self.data, self.data_X, imread_uint8, rows=rows,
+                           num_workers=load_workers)
       self.data_X = self.data_X#[selected]
-      
-      imreadImg = imread(self.data[0])
-      if len(imreadImg.shape) >= 3: #check if image is a non-grayscale image by checking channel number
-        self.c_dim = imread(self.data[0]).shape[-1]
-      else:
-        self.c_dim = 1
     else:
-      self.data = glob(os.path.join("./data", self.dataset_name, self.input_fname_pattern))
-
-      imreadImg = imread(self.data[0])
-      if len(imreadImg.shape) >= 3: #check if image is a non-grayscale image by checking channel number
-        self.c_dim = imread(self.data[0]).shape[-1]
-      else:
-        self.c_dim = 1
+      self.data = sorted(glob(os.path.join("./data", self.dataset_name, self.input_fname_pattern)))
+      self.c_dim = read_channels(self.data[0])
+
+      # Preprocessed uint8 images, memory-mapped from cache_dir
+      self.data_X = None
+      if cache_dir:
+        self.data_X, _ = cached_image_dataset(
+            cache_dir, self.data, self.dataset_name, self.input_fname_pattern,
+            input_height=self.input_height, input_width=self.input_width,
+            resize_height=self.imsize, resize_width=self.imsize,
+            crop=self.crop, grayscale=(self.c_dim == 1),
+            num_workers=load_workers)
 
     self.grayscale = (self.c_dim == 1)
 
+    # Per-class example lists for label-stratified batches
+    self.class_index = None
+    if self.y_dim and getattr(self, 'data_y', None) is not None:
+      self.class_index = ClassIndex(self.data_y, self.y_dim)
+
+    self.memory.record('data_load', arrays={
+        'data_X': getattr(self, 'data_X', None),
+        'data_y': getattr(self, 'data_y', None),
+        'class_index': self.class_index.indices if self.class_index is not None else None})
+
     self.build_model()
+    self.memory.record('build_model')
+
+  @classmethod
+  def generator_only(cls, sess, imsize, c_dim, y_dim=None, z_dim=100, gf_dim=64, gfc_dim=2048,
+                     model="fc", gen_activation_function=tf.nn.tanh, dataset_name='default',
+                     batch_size=64):
+    """A DCGAN with just what `create_generator` needs, for inference and export.
+
+    Nothing is loaded and no graph is built, so there is no dataset and no
+    discriminator; `model_dir` still names the training run's checkpoints.
+    """
+    self = cls.__new__(cls)
+    self.sess = sess
+    self.model = model
+    self.imsize = imsize
+    self.c_dim = c_dim
+    self.y_dim = y_dim
+    self.z_dim = z_dim
+    self.gf_dim = gf_dim
+    self.gfc_dim = gfc_dim
+    self.gen_activation_function = gen_activation_function
+    self.dataset_name = dataset_name
+    self.batch_size = batch_size
+
+    self.g_bn0 = batch_norm(name='g_bn0')
+    self.g_bn1 = batch_norm(name='g_bn1')
+    self.g_bn2 = batch_norm(name='g_bn2')
+    self.g_bn3 = batch_norm(name='g_bn3')
+    return self
 
   def build_model(self):
     if self.y_dim:
@@ -126,21 +195,30 @@ class DCGAN(object):
       tf.float32, [None, self.z_dim], name='z')
     self.z_sum = histogram_summary("z", self.z)
 
-    self.G                  = self.generator(self.z, self.y)
-    self.D, self.D_logits   = self.discriminator(inputs, self.y, reuse=False)
+    # One generator/discriminator copy per tower, each on a slice of the batch
+    tower_G, tower_D, tower_D_ = [], [], []
+    self.tower_d_losses, self.tower_g_losses = [], []
+    for idx, (device, t_inputs, t_z, t_y) in enumerate(self.tower_inputs(inputs, self.z, self.y)):
+      with tower_scope(idx, device):
+        G                 = self.create_generator(t_z, t_y, reuse=idx > 0)
+        D, D_logits       = self.discriminator(t_inputs, t_y, reuse=idx > 0)
+        D_, D_logits_     = self.discriminator(G, t_y, reuse=True)
+        d_loss, g_loss    = self.gan_losses(D_logits, D_logits_)
+      tower_G.append(G)
+      tower_D.append((D, D_logits))
+      tower_D_.append((D_, D_logits_))
+      self.tower_d_losses.append(d_loss)
+      self.tower_g_losses.append(g_loss)
+
+    self.G                  = concat_towers(tower_G)
+    self.D, self.D_logits   = [concat_towers(t) for t in zip(*tower_D)]
     self.sampler            = self.sampler(self.z, self.y)
-    self.D_, self.D_logits_ = self.discriminator(self.G, self.y, reuse=True)
+    self.D_, self.D_logits_ = [concat_towers(t) for t in zip(*tower_D_)]
     
     self.d_sum = histogram_summary("d", self.D)
     self.d__sum = histogram_summary("d_", self.D_)
     self.G_sum = image_summary("G", self.G)
 
-    def sigmoid_cross_entropy_with_logits(x, y):
-      try:
-        return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, labels=y)
-      except:
-        return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, targets=y)
-
     self.d_loss_real = tf.reduce_mean(
       sigmoid_cross_entropy_with_logits(self.D_logits, tf.ones_like(self.D)))
     self.d_loss_fake = tf.reduce_mean(
@@ -153,14 +231,9 @@ class DCGAN(object):
     self.d_loss_real_sum = scalar_summary("d_loss_real", self.d_loss_real)
     self.d_loss_fake_sum = scalar_summary("d_loss_fake", self.d_loss_fake)
                           
-    
-    if wgan:
-      self.d_loss = tf.reduce_mean(self.D_logits) - tf.reduce_mean(self.D_logits_)
-      self.g_loss = tf.reduce_mean(self.D_logits_)
-    else:
-      self.g_loss = tf.reduce_mean(
-        sigmoid_cross_entropy_with_logits(self.D_logits_, tf.ones_like(self.D_)))      
-      self.d_loss = self.d_loss_real + self.d_loss_fake
+    # Towers get equal slices, so the mean of their losses is the batch loss
+    self.d_loss = average_towers(self.tower_d_losses)
+    self.g_loss = average_towers(self.tower_g_losses)
       
     self.g_loss_sum = scalar_summary("g_loss", self.g_loss)
     self.d_loss_sum = scalar_summary("d_loss", self.d_loss)
@@ -170,31 +243,134 @@ class DCGAN(object):
     self.d_vars = [var for var in t_vars if 'd_' in var.name]
     self.g_vars = [var for var in t_vars if 'g_' in var.name]
 
-    self.saver = tf.train.Saver()
-
-  def train(self, config):
-    d_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-              .minimize(self.d_loss, var_list=self.d_vars)
-    g_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-              .minimize(self.g_loss, var_list=self.g_vars)
-    
-    tf.global_variables_initializer().run()
+    self.checkpointer = None
 
-    # 
-    self.g_sum = merge_summary([self.z_sum, self.d__sum,
-      self.G_sum, self.d_loss_fake_sum, self.g_loss_sum])
-
-    self.d_sum = merge_summary(
-        [self.z_sum, self.d_sum, self.d_loss_real_sum, self.d_loss_sum])
-    
+  @property
+  def tower_batch_size(self):
+    return self.batch_size // len(self.tower_devices)
+
+  def tower_inputs(self, inputs, z, y=None):
+    """(device, inputs, z, y) for each tower, splitting the batch evenly."""
+    num_towers = len(self.tower_devices)
+    if num_towers == 1:
+      return [(None, inputs, z, y)]
+    if self.batch_size % num_towers:
+      raise ValueError("batch_size {} is not divisible by {} towers".format(
+          self.batch_size, num_towers))
+    inputs, z = split(inputs, num_towers, 0), split(z, num_towers, 0)
+    y = split(y, num_towers, 0) if y is not None else [None] * num_towers
+    return list(zip(self.tower_devices, inputs, z, y))
+
+  def gan_losses(self, D_logits, D_logits_):
+    """(d_loss, g_loss) from discriminator logits on real and fake images."""
+    if self.wgan:
+      return tf.reduce_mean(D_logits) - tf.reduce_mean(D_logits_), tf.reduce_mean(D_logits_)
+    d_loss_real = tf.reduce_mean(
+      sigmoid_cross_entropy_with_logits(D_logits, tf.ones_like(D_logits)))
+    d_loss_fake = tf.reduce_mean(
+      sigmoid_cross_entropy_with_logits(D_logits_, tf.zeros_like(D_logits_)))
+    g_loss = tf.reduce_mean(
+      sigmoid_cross_entropy_with_logits(D_logits_, tf.ones_like(D_logits_)))
+    return d_loss_real + d_loss_fake, g_loss
+
+  def generator_loss(self, z, y=None):
+    """G loss of a new generator/discriminator pass on the shared variables."""
+    G = self.create_generator(z, y, reuse=True)
+    _, D_logits_ = self.discriminator(G, y, reuse=True)
+    if self.wgan:
+      return tf.reduce_mean(D_logits_)
+    return tf.reduce_mean(
+      sigmoid_cross_entropy_with_logits(D_logits_, tf.ones_like(D_logits_)))
+
+  def build_train_op(self, config):
+    """Builds one op for a D update followed by `config.g_steps` G updates.
+
+    As with separate `sess.run` calls, every G update needs the G loss
+    computed with the variables written by the update before it, so each
+    gets its own generator/discriminator pass that reads them afterwards.
+    """
+    d_optimizer = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+    g_optimizer = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+    towers = self.tower_inputs(self.inputs, self.z, self.y)
+
+    # With several towers, each computes gradients on its own slice and the
+    # optimizers apply their average
+    tower_grads = []
+    for idx, (device, _, _, _) in enumerate(towers):
+      with tower_scope(idx, device):
+        tower_grads.append(d_optimizer.compute_gradients(
+            self.tower_d_losses[idx], var_list=self.d_vars,
+            colocate_gradients_with_ops=True))
+    d_optim = d_optimizer.apply_gradients(average_gradients(tower_grads))
+
+    step, g_loss = d_optim, self.g_loss
+    for _ in xrange(config.g_steps):
+      with tf.control_dependencies([step]):
+        tower_grads, g_losses = [], []
+        for idx, (device, _, t_z, t_y) in enumerate(towers):
+          with tower_scope(idx, device):
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=fresh_read_getter):
+              g_losses.append(self.generator_loss(t_z, t_y))
+            tower_grads.append(g_optimizer.compute_gradients(
+                g_losses[-1], var_list=self.g_vars,
+                colocate_gradients_with_ops=True))
+        step = g_optimizer.apply_gradients(average_gradients(tower_grads))
+        g_loss = average_towers(g_losses)
+
+    self.global_step = None
+    if self.cluster is not None:
+      # Workers share one step count on the parameter servers; the train op
+      # returns its value after this step
+      self.global_step = tf.Variable(0, trainable=False, name='global_step')
+      self.start_barrier = StartBarrier()
+      with tf.control_dependencies([step]):
+        step = tf.assign_add(self.global_step, 1)
+
+    # Losses of this step: D terms before the D update; G the loss the last
+    # G update took its gradients from, so before that update is applied
+    self.step_losses = [self.d_loss_fake, self.d_loss_real, g_loss,
+                        self.accuracy_real, self.accuracy_fake, self.d_loss]
+    return step
 
-    sample_z = np.random.uniform(-1, 1, size=(self.sample_num*self.y_dim , self.z_dim))
+  def train(self, config):
+    train_op = self.build_train_op(config)
     
-    samples = [[j] for j in range(self.y_dim) for i in range(self.sample_num)]
-    oh = OneHotEncoder()
-    oh.fit(samples)
+    # In a cluster the chief sets up the shared variables for everyone
+    if self.is_chief:
+      tf.global_variables_initializer().run()
+
+    profile_prefix = '' if self.is_chief else 'worker{}-'.format(self.task_index)
+    self.memory.open(os.path.join(config.log_dir, self.model_dir,
+                                  '{}memory.jsonl'.format(profile_prefix)))
+    self.memory.record('optimizer_setup', sess=self.sess)
+
+    # Each kind of summary is fetched only every so many steps
+    self.summaries = SummarySchedule({
+      'scalar': (config.scalar_summary_every,
+                 [self.d_loss_real_sum, self.d_loss_fake_sum, self.d_loss_sum, self.g_loss_sum]),
+      'histogram': (config.histogram_summary_every, [self.z_sum, self.d_sum, self.d__sum]),
+      'image': (config.image_summary_every, [self.G_sum]),
+    })
+    self.summary_writer = None
+    if not self.is_chief:
+      self.summaries = SummarySchedule({})
+    if self.summaries:
+      self.summary_writer = AsyncSummaryWriter(
+          os.path.join(config.log_dir, self.model_dir), self.sess.graph)
+
+    self.batch_sampler = self.create_batch_sampler(config)
+
+    sample_z = np.random.uniform(-1, 1, size=(self.sample_size, self.z_dim))
+    sample_feed_dict = {self.z: sample_z, self.keep_prob: 1.0}
     
-    sample_labels = oh.transform(samples).toarray()
+    if self.y_dim:
+      # The grid follows the class distribution used for training batches
+      if isinstance(self.batch_sampler, ClassSampler):
+        sample_classes = self.batch_sampler.grid_classes(self.sample_size)
+      else:
+        sample_classes = np.repeat(np.arange(self.y_dim), self.sample_num)
+      sample_labels = np.eye(self.y_dim, dtype=np.float32)[sample_classes]
+      sample_feed_dict[self.y] = sample_labels
 
     # Load sample data
     '''
@@ -221,108 +397,152 @@ class DCGAN(object):
     counter = 1
     start_time = time.time()
     # Load checkpoint
-    could_load, checkpoint_counter = self.load(self.checkpoint_dir)
+    could_load = False
+    if self.is_chief:
+      could_load, checkpoint_counter = self.load(self.checkpoint_dir)
+      if could_load:
+        counter = checkpoint_counter
+        print(" [*] Load SUCCESS")
+      else:
+        print(" [!] Load failed...")
+
+    if self.cluster is not None:
+      if self.is_chief:
+        self.sess.run(self.global_step.assign(counter))
+        self.start_barrier.release(self.sess)
+      else:
+        print(" [*] Waiting for the chief to initialize the variables...")
+        self.start_barrier.wait(self.sess)
+        counter = self.sess.run(self.global_step)
+        # Resume at the chief's position; every shard has the same length
+        could_load = counter > 1
+
     if could_load:
-      counter = checkpoint_counter
-      print(" [*] Load SUCCESS")
-    else:
-      print(" [!] Load failed...")
+      self.load_sampler_state(self.checkpoint_dir, counter)
+
+    # Checkpoints cover the optimizer slots too and are written in the background
+    if self.is_chief:
+      self.checkpointer = AsyncCheckpointer(
+          os.path.join(config.checkpoint_dir, self.model_dir), "DCGAN.model",
+          max_to_keep=config.keep_checkpoints,
+          keep_every_hours=config.keep_checkpoint_every_hours)
+    checkpoint_schedule = CheckpointSchedule(
+        config.checkpoint_every_steps, config.checkpoint_every_secs, step=counter)
+
+    # Per-epoch means of the losses the training step already fetches
+    epoch_means = RunningMeans(['d_loss_fake', 'd_loss_real', 'g_loss',
+                                'acc_real', 'acc_fake', 'd_loss'])
+    # Samples and metric logs are encoded and written off the training thread
+    artifacts = ArtifactWriter(config.artifact_threads, config.artifact_queue_size)
+    metrics_name = 'metrics' if self.is_chief else 'metrics-worker{}'.format(self.task_index)
+    metrics_log = MetricsLog(
+        os.path.join(config.sample_dir, '{}.{}'.format(metrics_name, config.metrics_format)),
+        ['epoch', 'step', 'time', 'images_per_sec'] + epoch_means.names,
+        fmt=config.metrics_format, flush_every=config.metrics_flush_every, writer=artifacts)
+
+    # Optional phase timers and step traces, written next to the summaries
+    profile_dir = os.path.join(config.log_dir, self.model_dir)
+    timer = PhaseTimer(config.profile)
+    tracer = StepTracer([int(step) for step in config.trace_steps.split(',') if step],
+                        profile_dir, prefix=profile_prefix)
 
     # Start training
-    for epoch in xrange(config.epoch):
-      
-      if config.dataset == 'mnist':
-        batch_idxs = min(len(self.data_X), config.train_size) // self.batch_size
-      else:      
-        self.data = glob(os.path.join(
-          "./data", config.dataset, self.input_fname_pattern))
-        batch_idxs = min(len(self.data), config.train_size) // self.batch_size
-
-      for idx in xrange(0, batch_idxs):
-        # Set batch X and Y
-        if config.dataset == 'pokemon/64x64x3':
-          random_idxs = np.random.randint(0,len(self.data_X), self.batch_size)
-          batch_labels = self.data_y[random_idxs]
-          batch_images = self.data_X[random_idxs]
-        if config.dataset == 'mnist':
-          batch_images = self.data_X[idx*config.batch_size:(idx+1)*config.batch_size]
-          batch_labels = self.data_y[idx*config.batch_size:(idx+1)*config.batch_size]
-        if False:
-          random_idxs = np.random.randint(0,len(self.data_X), self.batch_size)
-          batch = self.data_X[random_idxs]
-          #self.data_X[idx*config.batch_size:(idx+1)*config.batch_size]
-          if self.grayscale:
-            batch_images = np.array(batch).astype(np.float32)[:, :, :, None]
-          else:
-            batch_images = np.array(batch).astype(np.float32)
-
-        batch_z = np.random.uniform(-1, 1, [self.batch_size, self.z_dim]).astype(np.float32)
-        
-              
-
-        # Update D network
-        _, summary_str = self.sess.run([d_optim, self.d_sum],
-            feed_dict={ self.inputs: batch_images, self.z: batch_z, self.y: batch_labels,self.keep_prob: 0.5 })
-
-        # Update G network
-        _, summary_str = self.sess.run([g_optim, self.g_sum],
-            feed_dict={ self.z: batch_z, self.y:batch_labels, self.keep_prob: 0.5 })
-        g_loss = 2
-#        while g_loss > 0.9:
-        # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
-        _, summary_str, g_loss = self.sess.run([g_optim, self.g_sum, self.g_loss],
-                feed_dict={ self.z: batch_z, self.y: batch_labels, self.keep_prob: 0.5 })
-
-        counter += 1
-
-      if epoch % 10 == 0:
-        # Gather statistics 
-        errD_fake, errD_real, errG, acc_real, acc_fake, d_loss = self.sess.run(
-          [self.d_loss_fake, self.d_loss_real , self.g_loss, self.accuracy_real, self.accuracy_fake, self.d_loss],
-          feed_dict={self.inputs: batch_images, self.y: batch_labels, self.z: batch_z, self.keep_prob: 1.0}
-          )
-        print d_loss
-        print "Epoch:{:4d}, time:{:6.1f}, d_real_loss:{:1.4f}, d_fake_loss:{:1.4f}, g_loss:{:2.4f}, acc_real:{:0.3f}, acc_fake:{:0.3f}" \
-          .format(epoch, time.time() - start_time, errD_real, errD_fake, errG, acc_real, acc_fake)
-        
+    try:
+      first_epoch = self.batch_sampler.epoch
+      for epoch in xrange(first_epoch, config.epoch):
+        epoch_start_time = time.time()
+
+        for idx, (batch_images, batch_labels) in enumerate(timer.iterate('data', self.epoch_batches(config))):
+          with timer.phase('feed'):
+            batch_z = np.random.uniform(-1, 1, [self.batch_size, self.z_dim]).astype(np.float32)
+          
+            feed_dict = {self.inputs: batch_images, self.z: batch_z, self.keep_prob: 0.5}
+            if self.y_dim:
+              feed_dict[self.y] = batch_labels
+
+          # Update D, then G g_steps times (twice by default, to make sure
+          # that d_loss does not go to zero; different from paper)
+          summary_ops = self.summaries.fetches(counter)
+          run_options, run_metadata = tracer.trace(counter)
+          with timer.phase('step'):
+            step_value, step_losses, summary_strs = self.sess.run(
+                [train_op, self.step_losses, summary_ops], feed_dict=feed_dict,
+                options=run_options, run_metadata=run_metadata)
+          if run_metadata is not None:
+            tracer.export(counter, run_metadata)
+          with timer.phase('summary'):
+            for summary_str in summary_strs:
+              self.summary_writer.add_summary(summary_str, counter)
+          epoch_means.update(step_losses)
+
+          counter = step_value if self.global_step is not None else counter + 1
+          self.batch_sampler.step()
+
+          # The first run allocates most of the session's buffers
+          if epoch_means.count == 1 and epoch == first_epoch:
+            self.memory.record('first_step', step=counter, sess=self.sess)
+
+          if self.is_chief and checkpoint_schedule.due(counter):
+            with timer.phase('checkpoint'):
+              self.save(config.checkpoint_dir, counter)
 
         # Save losses
-        f = open('{}/curve.txt'.format(config.sample_dir), 'a')
-        f.write("{},{},{},{},{},{}\n".format(errG, errD_fake, errD_real, acc_real, acc_fake, d_loss) ) 
-        f.close()
-
-        if epoch % 100 == 0:
-          self.save(config.checkpoint_dir, counter)
-
-        if config.dataset == 'mnist' or True:
-          samples, = self.sess.run(
-            [self.sampler],
-            feed_dict={
-                self.z: sample_z,
-                self.y: sample_labels,
-                self.keep_prob: 1.0
-            }
-          )      
-          save_images(samples, image_manifold_size(samples.shape[0]),
-                './{}/train_{:02d}.png'.format(config.sample_dir, epoch), column_size=self.sample_num)
-          print("Sample saved") 
-        else:
-          try:
-            samples, d_loss, g_loss = self.sess.run(
-              [self.sampler, self.d_loss, self.g_loss],
-              feed_dict={
-                  self.z: sample_z,
-                  self.inputs: sample_inputs,
-              },
-            )
+        means = epoch_means.means()
+        images_per_sec = epoch_means.count * self.batch_size / max(time.time() - epoch_start_time, 1e-6)
+        epoch_means.reset()
+        with timer.phase('metrics'):
+          metrics_log.write(dict(means, epoch=epoch, step=counter, time=time.time() - start_time,
+                                 images_per_sec=images_per_sec))
+          self.memory.record('epoch', step=counter, sess=self.sess)
+
+        if epoch % 10 == 0:
+          print("Epoch:{:4d}, time:{:6.1f}, d_real_loss:{:1.4f}, d_fake_loss:{:1.4f}, g_loss:{:2.4f}, acc_real:{:0.3f}, acc_fake:{:0.3f}, d_loss:{:1.4f}"
+            .format(epoch, time.time() - start_time, means['d_loss_real'], means['d_loss_fake'],
+                    means['g_loss'], means['acc_real'], means['acc_fake'], means['d_loss']))
+
+          # Only the chief writes samples
+          if not self.is_chief:
+            continue
+
+          if config.dataset == 'mnist' or True:
+            with timer.phase('sample'):
+              samples, = self.sess.run([self.sampler], feed_dict=sample_feed_dict)
+              artifacts.save_images(samples, image_manifold_size(samples.shape[0]),
+                    './{}/train_{:02d}.png'.format(config.sample_dir, epoch), column_size=self.sample_num)
+            print("Sample queued")
+          else:
+            try:
+              samples, d_loss, g_loss = self.sess.run(
+                [self.sampler, self.d_loss, self.g_loss],
+                feed_dict={
+                    self.z: sample_z,
+                    self.inputs: sample_inputs,
+                },
+              )
             
-            print "Max value:" , samples.max()
-            print "Min value:", samples.min()
-            save_images(samples, image_manifold_size(samples.shape[0]),
-                  './{}/train_{:02d}.png'.format(config.sample_dir, epoch))
-            print("[Sample] d_loss: %.8f, g_loss: %.8f" % (d_loss, g_loss)) 
-          except:
-            print("one pic error!...")
+              print "Max value:" , samples.max()
+              print "Min value:", samples.min()
+              artifacts.save_images(samples, image_manifold_size(samples.shape[0]),
+                    './{}/train_{:02d}.png'.format(config.sample_dir, epoch))
+              print("[Sample] d_loss: %.8f, g_loss: %.8f" % (d_loss, g_loss)) 
+            except:
+              print("one pic error!...")
+
+      # Final checkpoint, written before close returns
+      if self.is_chief:
+        self.save(config.checkpoint_dir, counter)
+    finally:
+      self.memory.close()
+      if self.summary_writer is not None:
+        self.summary_writer.close()
+      if self.checkpointer is not None:
+        self.checkpointer.close()
+      if timer.enabled:
+        print(timer.format_summary())
+        timer.write(os.path.join(profile_dir, '{}phase_times.txt'.format(profile_prefix)))
+      # Queued samples and log lines are written before training returns
+      metrics_log.close()
+      artifacts.close()
 
 
   def discriminator(self, image, y=None, reuse=False):
@@ -335,7 +555,7 @@ class DCGAN(object):
         h1 = lrelu(self.d_bn1(conv2d(h0, self.df_dim*2, name='d_h1_conv')))
         h2 = lrelu(self.d_bn2(conv2d(h1, self.df_dim*4, name='d_h2_conv')))
         h3 = lrelu(self.d_bn3(conv2d(h2, self.df_dim*8, name='d_h3_conv')))
-        h4 = linear(tf.reshape(h3, [self.batch_size, -1]), 1, 'd_h4_lin')
+        h4 = linear(tf.reshape(h3, [-1, int(np.prod(h3.get_shape().as_list()[1:]))]), 1, 'd_h4_lin')
 
         return tf.nn.sigmoid(h4), h4
       else:
@@ -356,25 +576,25 @@ class DCGAN(object):
         
         return tf.nn.sigmoid(h3), h3
   
-  def create_generator(self, z, size, y=None, reuse=False):
+  def create_generator(self, z, y=None, reuse=False, train=True):
     with tf.variable_scope("generator") as scope:
       if reuse:
         scope.reuse_variables()
       if self.model=='fc' and self.y_dim:
-        return self.create_cond_fcgan_generator(z,size,y)
+        return self.create_cond_fcgan_generator(z, y, train)
       elif self.model=='cond' and self.y_dim:
-        return self.create_cond_dcgan_generator(z, size, y)
+        return self.create_cond_dcgan_generator(z, y, train)
       else:
-        return self.create_dcgan_generator(z, size, y)
+        return self.create_dcgan_generator(z, y, train)
 
-  def create_cond_fcgan_generator(self, z, size, y):
+  def create_cond_fcgan_generator(self, z, y, train=True):
     # Input sizes
     s_h, s_w = self.imsize, self.imsize
     s_h2, s_h4 = int(s_h/2), int(s_h/4)
     s_w2, s_w4 = int(s_w/2), int(s_w/4)
 
 
-    yb = tf.reshape(y, [size, 1, 1, self.y_dim])
+    yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
     # shape: [batch_size, y_dim + z_dim]
     z = concat([z, y], 1)
 
@@ -385,26 +605,26 @@ class DCGAN(object):
       scope="g_h0_lin"
     )
     # Relu
-    h0 = tf.nn.relu(self.g_bn0(h0))
+    h0 = tf.nn.relu(self.g_bn0(h0, train=train))
     # Concatenate
     # From 1024 -> 1042
     h0 = concat([h0, y], 1)
 
     # FC 2 
     h1 = tf.nn.relu(self.g_bn1(
-        linear(h0, self.gf_dim*2*s_h4*s_w4, 'g_h1_lin')))
-    h1 = tf.reshape(h1, [size, s_h4, s_w4, self.gf_dim * 2])
+        linear(h0, self.gf_dim*2*s_h4*s_w4, 'g_h1_lin'), train=train))
+    h1 = tf.reshape(h1, [-1, s_h4, s_w4, self.gf_dim * 2])
     
     h1 = conv_cond_concat(h1, yb)
     # FC 3 
     h2 = tf.nn.relu(self.g_bn2(deconv2d(h1,
-        [size, s_h2, s_w2, self.gf_dim * 2], name='g_h2')))
+        [None, s_h2, s_w2, self.gf_dim * 2], name='g_h2'), train=train))
     h2 = conv_cond_concat(h2, yb)
-    h3 = deconv2d(h2, [size, s_h, s_w, self.c_dim], name='g_h3')
+    h3 = deconv2d(h2, [None, s_h, s_w, self.c_dim], name='g_h3')
 
     return self.gen_activation_function(h3)
 
-  def create_cond_dcgan_generator(self, z, size, y=None):
+  def create_cond_dcgan_generator(self, z, y=None, train=True):
     s_h, s_w = self.imsize, self.imsize
 
     # Define input sizes for convolutions
@@ -413,7 +633,7 @@ class DCGAN(object):
     s_h8, s_w8 = conv_out_size_same(s_h4, 2), conv_out_size_same(s_w4, 2)
     s_h16, s_w16 = conv_out_size_same(s_h8, 2), conv_out_size_same(s_w8, 2)
 
-    yb = tf.reshape(y, [size, 1, 1, self.y_dim])
+    yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
     z = concat([z, y], 1)
 
     # project `z` and reshape
@@ -424,38 +644,38 @@ class DCGAN(object):
         with_w=True)
 
     self.h0 = tf.reshape(
-        self.z_, [size, s_h16, s_w16, self.gf_dim * 8])
+        self.z_, [-1, s_h16, s_w16, self.gf_dim * 8])
     # Batch normalize and relu
-    h0 = lrelu(self.g_bn0(self.h0))
+    h0 = lrelu(self.g_bn0(self.h0, train=train))
 
     h0 = conv_cond_concat(h0, yb)
     # Deconvolution layer 1
     self.h1, self.h1_w, self.h1_b = deconv2d(
         input_=h0,
-        output_shape= [size, s_h8, s_w8, self.gf_dim*4],
+        output_shape= [None, s_h8, s_w8, self.gf_dim*4],
         name='g_h1', with_w=True)
     # Batch normalize and relu
-    h1 = lrelu(self.g_bn1(self.h1))
+    h1 = lrelu(self.g_bn1(self.h1, train=train))
     
     h1 = conv_cond_concat(h1, yb)
 
     # Deconvolution layer 2
     h2, self.h2_w, self.h2_b = deconv2d(
         input_=h1, 
-        output_shape=[size, s_h4, s_w4, self.gf_dim*2],
+        output_shape=[None, s_h4, s_w4, self.gf_dim*2],
         name='g_h2',
         with_w=True)
     # Batch normalize and relu
-    h2 = lrelu(self.g_bn2(h2))
+    h2 = lrelu(self.g_bn2(h2, train=train))
     
 #    h2 = tf.layers.dropout(h2, rate=self.keep_prob)
     h2 = conv_cond_concat(h2, yb)
 
     # Deconvolution layer 3 
     h3, self.h3_w, self.h3_b = deconv2d(
-        h2, [size, s_h2, s_w2, self.gf_dim*1], name='g_h3', with_w=True)
+        h2, [None, s_h2, s_w2, self.gf_dim*1], name='g_h3', with_w=True)
     # Batch normalize and relu
-    h3 = lrelu(self.g_bn3(h3))
+    h3 = lrelu(self.g_bn3(h3, train=train))
     
 #    h3 = tf.layers.dropout(h3, rate=self.keep_prob)
     h3 = conv_cond_concat(h3, yb)
@@ -463,14 +683,14 @@ class DCGAN(object):
     # Deconvolution layer 4 
     h4, self.h4_w, self.h4_b = deconv2d(
         input_=h3,
-        output_shape=[size, s_h, s_w, self.c_dim],
+        output_shape=[None, s_h, s_w, self.c_dim],
         name='g_h4', with_w=True)
     
     # Return tanh, no batch normalization
     return self.gen_activation_function(h4)      
     
 
-  def create_dcgan_generator(self,z, size, y=None):
+  def create_dcgan_generator(self,z, y=None, train=True):
     s_h, s_w = self.imsize, self.imsize
 
     # Define input sizes for convolutions
@@ -489,71 +709,138 @@ class DCGAN(object):
     self.h0 = tf.reshape(
         self.z_, [-1, s_h16, s_w16, self.gf_dim * 8])
     # Batch normalize and relu
-    h0 = tf.nn.relu(self.g_bn0(self.h0))
+    h0 = tf.nn.relu(self.g_bn0(self.h0, train=train))
 
     # Deconvolution layer 1
     self.h1, self.h1_w, self.h1_b = deconv2d(
         input_=h0,
-        output_shape= [size, s_h8, s_w8, self.gf_dim*4],
+        output_shape= [None, s_h8, s_w8, self.gf_dim*4],
         name='g_h1', with_w=True)
     # Batch normalize and relu
-    h1 = tf.nn.relu(self.g_bn1(self.h1))
+    h1 = tf.nn.relu(self.g_bn1(self.h1, train=train))
 
     # Deconvolution layer 2
     h2, self.h2_w, self.h2_b = deconv2d(
         input_=h1, 
-        output_shape=[size, s_h4, s_w4, self.gf_dim*2],
+        output_shape=[None, s_h4, s_w4, self.gf_dim*2],
         name='g_h2',
         with_w=True)
     # Batch normalize and relu
 
-    h2 = tf.nn.relu(self.g_bn2(h2))
+    h2 = tf.nn.relu(self.g_bn2(h2, train=train))
     
     # Deconvolution layer 3 
     h3, self.h3_w, self.h3_b = deconv2d(
-        h2, [size, s_h2, s_w2, self.gf_dim*1], name='g_h3', with_w=True)
+        h2, [None, s_h2, s_w2, self.gf_dim*1], name='g_h3', with_w=True)
     # Batch normalize and relu
-    h3 = tf.nn.relu(self.g_bn3(h3))
+    h3 = tf.nn.relu(self.g_bn3(h3, train=train))
 
     # Deconvolution layer 4 
     h4, self.h4_w, self.h4_b = deconv2d(
         input_=h3,
-        output_shape=[size, s_h, s_w, self.c_dim],
+        output_shape=[None, s_h, s_w, self.c_dim],
         name='g_h4', with_w=True)
     
     # Return tanh, no batch normalization
     return self.gen_activation_function(h4)
 
   def generator(self, z, y=None):
-    return self.create_generator(z,self.batch_size,y)
+    return self.create_generator(z, y)
 
   def sampler(self, z, y=None):
-    return self.create_generator(z, self.sample_num * self.y_dim, y, reuse=True)
+    """Generator for any number of rows, with batch norm on its moving averages.
 
-  def load_mnist(self):
-    data_dir = os.path.join("./data", self.dataset_name)
-    
-    fd = open(os.path.join(data_dir,'train-images-idx3-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    trX = loaded[16:].reshape((60000,28,28,1)).astype(np.float)
+    Each image depends only on its own z (and y), so one graph serves any
+    batch size, including single images.
+    """
+    return self.create_generator(z, y, reuse=True, train=False)
 
-    fd = open(os.path.join(data_dir,'train-labels-idx1-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    trY = loaded[8:].reshape((60000)).astype(np.float)
+  @property
+  def sample_size(self):
+    # One row of `sample_num` images per class, or a square grid without labels
+    return self.sample_num * (self.y_dim or self.sample_num)
 
-    fd = open(os.path.join(data_dir,'t10k-images-idx3-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    teX = loaded[16:].reshape((10000,28,28,1)).astype(np.float)
+  @property
+  def num_examples(self):
+    if self.data_X is not None:
+      return len(self.data_X)
+    return len(self.data)
+
+  def create_batch_sampler(self, config):
+    if config.class_sampling == 'none':
+      # Every epoch visits each example once; the graph needs full batches.
+      # Workers of a cluster take disjoint shards of the same permutation
+      seed = config.shuffle_seed
+      if seed is None and self.cluster is not None:
+        seed = 0
+      return EpochSampler(
+          min(self.num_examples, config.train_size), self.batch_size, last_batch='pad',
+          num_shards=self.num_workers, shard_index=self.task_index, seed=seed)
+
+    if self.class_index is None:
+      raise ValueError("--class_sampling={} needs a labelled dataset and y_dim".format(
+          config.class_sampling))
+    weights = None
+    if config.class_weights:
+      weights = [float(w) for w in config.class_weights.split(',')]
+    return ClassSampler(self.class_index, self.batch_size,
+                        mode=config.class_sampling, weights=weights)
+
+  def epoch_batches(self, config):
+    """Yields (images, labels) for the batches left in the sampler's epoch."""
+    batches = self.batch_sampler.remaining_batches()
+    if config.dataset in ('mnist', 'pokemon/64x64x3'):
+      for batch_idxs in batches:
+        batch_idxs = np.sort(batch_idxs)
+        yield (self.data_X[batch_idxs].astype(np.float32) * np.float32(1/255.),
+               self.data_y[batch_idxs])
+    elif self.data_X is not None:
+      # Cached datasets slice the memmap; threads avoid pickling it
+      prefetcher = BatchPrefetcher(partial(load_cached_batch, images=self.data_X,
+                                           random_flip=config.random_flip), batches,
+                                   queue_size=config.prefetch_queue_size,
+                                   num_workers=config.prefetch_workers)
+      try:
+        for batch_images, _ in prefetcher:
+          yield batch_images, None
+      finally:
+        prefetcher.close()
+    else:
+      batches = [[self.data[i] for i in batch_idxs] for batch_idxs in batches]
+      load_fn = partial(load_image_batch,
+                        input_height=self.input_height,
+                        input_width=self.input_width,
+                        resize_height=self.imsize,
+                        resize_width=self.imsize,
+                        crop=self.crop,
+                        grayscale=self.grayscale,
+                        random_flip=config.random_flip)
+      prefetcher = BatchPrefetcher(load_fn, batches,
+                                   queue_size=config.prefetch_queue_size,
+                                   num_workers=config.prefetch_workers,
+                                   use_processes=config.prefetch_processes)
+      try:
+        for batch_images in prefetcher:
+          yield batch_images, None
+      finally:
+        prefetcher.close()
 
-    fd = open(os.path.join(data_dir,'t10k-labels-idx1-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    teY = loaded[8:].reshape((10000)).astype(np.float)
+  def load_mnist(self):
+    """Returns uint8 images (N, 28, 28, 1) and float32 one-hot labels.
 
-    trY = np.asarray(trY)
-    teY = np.asarray(teY)
+    Images stay as raw uint8 bytes; `epoch_batches` scales each batch to
+    float32 in [0, 1].
+    """
+    data_dir = os.path.join("./data", self.dataset_name)
     
-    X = np.concatenate((trX, teX), axis=0)
-    y = np.concatenate((trY, teY), axis=0).astype(np.int)
+    trX = read_idx(os.path.join(data_dir,'train-images-idx3-ubyte'))
+    trY = read_idx(os.path.join(data_dir,'train-labels-idx1-ubyte'))
+    teX = read_idx(os.path.join(data_dir,'t10k-images-idx3-ubyte'))
+    teY = read_idx(os.path.join(data_dir,'t10k-labels-idx1-ubyte'))
+
+    # The only copy: 70000*28*28 bytes, read straight from the memmaps
+    X = np.concatenate((trX, teX), axis=0)[:, :, :, None]
+    y = np.concatenate((trY, teY), axis=0)
     
     seed = 547
     np.random.seed(seed)
@@ -561,11 +848,9 @@ class DCGAN(object):
     np.random.seed(seed)
     np.random.shuffle(y)
     
-    y_vec = np.zeros((len(y), self.y_dim), dtype=np.float)
-    for i, label in enumerate(y):
-      y_vec[i,y[i]] = 1.0
+    y_vec = np.eye(self.y_dim, dtype=np.float32)[y]
     
-    return X/255.,y_vec
+    return X, y_vec
 
   def load_pokemon_y(self):
     y = [0]*802
@@ -592,15 +877,28 @@ class DCGAN(object):
         self.imsize, self.imsize)
       
   def save(self, checkpoint_dir, step):
-    model_name = "DCGAN.model"
-    checkpoint_dir = os.path.join(checkpoint_dir, self.model_dir)
-
-    if not os.path.exists(checkpoint_dir):
-      os.makedirs(checkpoint_dir)
-
-    self.saver.save(self.sess,
-            os.path.join(checkpoint_dir, model_name),
-            global_step=step)
+    """Snapshots every variable at `step`; the files are written in the background."""
+    if self.checkpointer is None:
+      self.checkpointer = AsyncCheckpointer(
+          os.path.join(checkpoint_dir, self.model_dir), "DCGAN.model")
+
+    extra = None
+    if getattr(self, 'batch_sampler', None) is not None:
+      extra = {'sampler.json': {'step': step, 'sampler': self.batch_sampler.state_dict()}}
+    self.checkpointer.save(self.sess, step, extra=extra)
+
+  def load_sampler_state(self, checkpoint_dir, step):
+    """Restores the epoch sampler position saved with checkpoint `step`."""
+    path = os.path.join(checkpoint_dir, self.model_dir, 'sampler.json')
+    if not os.path.exists(path):
+      return False
+    with open(path) as f:
+      state = json.load(f)
+    if state['step'] != step:
+      print(" [!] Sampler state is from step {}, not {}".format(state['step'], step))
+      return False
+    self.batch_sampler.load_state_dict(state['sampler'])
+    return True
 
   def load(self, checkpoint_dir):
     import re
@@ -610,7 +908,12 @@ class DCGAN(object):
     ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
     if ckpt and ckpt.model_checkpoint_path:
       ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-      self.saver.restore(self.sess, os.path.join(checkpoint_dir, ckpt_name))
+      ckpt_path = os.path.join(checkpoint_dir, ckpt_name)
+
+      # Older checkpoints have no optimizer slots; those keep their initial values
+      reader = tf.train.NewCheckpointReader(ckpt_path)
+      var_list = [var for var in tf.global_variables() if reader.has_tensor(var.op.name)]
+      tf.train.Saver(var_list).restore(self.sess, ckpt_path)
       counter = int(next(re.finditer("(\d+)(?!.*\d)",ckpt_name)).group(0))
       print(" [*] Success to read {}".format(ckpt_name))
       return True, counter
@@ -1,4 +1,5 @@
 import math
+import contextlib
 import numpy as np 
 import tensorflow as tf
 
@@ -19,6 +20,11 @@ except:
   merge_summary = tf.summary.merge
   SummaryWriter = tf.summary.FileWriter
 
+if "stack" in dir(tf):
+  stack = tf.stack
+else:
+  stack = tf.pack
+
 if "concat_v2" in dir(tf):
   def concat(tensors, axis, *args, **kwargs):
     return tf.concat_v2(tensors, axis, *args, **kwargs)
@@ -26,6 +32,84 @@ else:
   def concat(tensors, axis, *args, **kwargs):
     return tf.concat(tensors, axis, *args, **kwargs)
 
+# (kind, variable scope) of every conv2d/deconv2d/linear layer, for
+# per-layer cost summaries
+LAYER_COLLECTION = 'dcgan_layers'
+
+def _register_layer(kind):
+  tf.add_to_collection(LAYER_COLLECTION, (kind, tf.get_variable_scope().name))
+
+def sigmoid_cross_entropy_with_logits(x, y):
+  try:
+    return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, labels=y)
+  except:
+    return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, targets=y)
+
+def fresh_read_getter(getter, *args, **kwargs):
+  """Variable scope getter that re-reads trainable variables where used.
+
+  Reads made under `tf.control_dependencies` then see the values written by
+  the ops depended on, which lets several updates run in one `sess.run`.
+  Non-trainable variables (batch norm moving averages) are returned as is
+  so they can still be assigned to.
+  """
+  var = getter(*args, **kwargs)
+  if kwargs.get('trainable', True):
+    return var.read_value()
+  return var
+
+if "split_v" in dir(tf):
+  def split(value, num, axis):
+    return tf.split(axis, num, value)
+else:
+  def split(value, num, axis):
+    return tf.split(value, num, axis)
+
+_VARIABLE_OPS = ('Variable', 'VariableV2', 'VarHandleOp')
+
+def tower_device_setter(device, variable_device='/cpu:0'):
+  """Places a tower's ops on `device` and its variables on `variable_device`."""
+  def _assign(op):
+    node_def = op if isinstance(op, tf.NodeDef) else op.node_def
+    return variable_device if node_def.op in _VARIABLE_OPS else device
+  return _assign
+
+@contextlib.contextmanager
+def tower_scope(index, device):
+  """Device and name scope of data-parallel tower `index`.
+
+  A no-op when `device` is None, so a single-tower graph is built exactly as
+  without towers.
+  """
+  if device is None:
+    yield
+    return
+  with tf.device(tower_device_setter(device)):
+    with tf.name_scope('tower_{}'.format(index)):
+      yield
+
+def concat_towers(tensors):
+  """Joins per-tower batch slices back into one batch."""
+  if len(tensors) == 1:
+    return tensors[0]
+  return concat(list(tensors), 0)
+
+def average_towers(tensors):
+  if len(tensors) == 1:
+    return tensors[0]
+  return tf.add_n(list(tensors)) / float(len(tensors))
+
+def average_gradients(tower_grads):
+  """Averages (gradient, variable) lists from `compute_gradients` per tower."""
+  if len(tower_grads) == 1:
+    return tower_grads[0]
+  averaged = []
+  for grads_and_vars in zip(*tower_grads):
+    var = grads_and_vars[0][1]
+    grads = [grad for grad, _ in grads_and_vars if grad is not None]
+    averaged.append((average_towers(grads) if grads else None, var))
+  return averaged
+
 class batch_norm(object):
   def __init__(self, epsilon=1e-5, momentum = 0.9, name="batch_norm"):
     with tf.variable_scope(name):
@@ -34,6 +118,7 @@ class batch_norm(object):
       self.name = name
 
   def __call__(self, x, train=True):
+    """Batch statistics when `train`, moving averages otherwise."""
     return tf.contrib.layers.batch_norm(x,
                       decay=self.momentum, 
                       updates_collections=None,
@@ -43,22 +128,26 @@ class batch_norm(object):
                       scope=self.name)
 
 def conv_cond_concat(x, y):
-  """Concatenate conditioning vector on feature map axis."""
+  """Concatenate conditioning vector on feature map axis.
+
+  The batch dimension may be dynamic; the feature map size is static.
+  """
   x_shapes = x.get_shape()
   y_shapes = y.get_shape()
-  return concat([
-    x, y*tf.ones([x_shapes[0], x_shapes[1], x_shapes[2], y_shapes[3]])], 3)
+  ones = tf.ones(stack([tf.shape(x)[0], int(x_shapes[1]), int(x_shapes[2]), int(y_shapes[3])]))
+  return concat([x, y*ones], 3)
 
 def conv2d(input_, output_dim, 
        k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02,
        name="conv2d"):
   with tf.variable_scope(name):
+    _register_layer('conv2d')
     w = tf.get_variable('w', [k_h, k_w, input_.get_shape()[-1], output_dim],
               initializer=tf.truncated_normal_initializer(stddev=stddev))
     conv = tf.nn.conv2d(input_, w, strides=[1, d_h, d_w, 1], padding='SAME')
 
     biases = tf.get_variable('biases', [output_dim], initializer=tf.constant_initializer(0.0))
-    conv = tf.reshape(tf.nn.bias_add(conv, biases), conv.get_shape())
+    conv = tf.reshape(tf.nn.bias_add(conv, biases), [-1] + conv.get_shape().as_list()[1:])
 
     return conv
 
@@ -66,18 +155,24 @@ def conv2d(input_, output_dim,
 def deconv2d(input_, output_shape,
        k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02,
        name="deconv2d", with_w=False):
+  """Transposed convolution to `output_shape` = [batch, height, width, channels].
 
+  The batch size is taken from `input_` at run time, so the first entry of
+  `output_shape` is ignored and may be None.
+  """
   with tf.variable_scope(name):
+    _register_layer('deconv2d')
     # filter : [height, width, output_channels, in_channels]
     w = tf.get_variable('w', [k_h, k_w, output_shape[-1], input_.get_shape()[-1]],
               initializer=tf.random_normal_initializer(stddev=stddev))
     
     # Deconvolution
-    deconv = tf.nn.conv2d_transpose(input_, w, output_shape=output_shape,
+    batch_shape = stack([tf.shape(input_)[0]] + list(output_shape[1:]))
+    deconv = tf.nn.conv2d_transpose(input_, w, output_shape=batch_shape,
               strides=[1, d_h, d_w, 1])
 
     biases = tf.get_variable('biases', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
-    deconv = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
+    deconv = tf.reshape(tf.nn.bias_add(deconv, biases), [-1] + list(output_shape[1:]))
 
     if with_w:
       return deconv, w, biases
@@ -91,6 +186,7 @@ def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=
   shape = input_.get_shape().as_list()
 
   with tf.variable_scope(scope or "Linear"):
+    _register_layer('linear')
     matrix = tf.get_variable("Matrix", [shape[1], output_size], tf.float32,
                  tf.random_normal_initializer(stddev=stddev))
     bias = tf.get_variable("bias", [output_size],
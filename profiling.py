@@ -0,0 +1,194 @@
+"""
+Optional instrumentation of the DCGAN training loop: wall-clock timers per
+phase, full traces of chosen steps as Chrome timelines, and per-layer op
+costs from those traces. Everything is off unless asked for.
+"""
+import os
+import re
+import time
+import collections
+import numpy as np
+import tensorflow as tf
+
+from ops import LAYER_COLLECTION
+
+class _Phase(object):
+  __slots__ = ('durations', 'start')
+
+  def __init__(self, durations):
+    self.durations = durations
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, *exc_info):
+    self.durations.append(time.time() - self.start)
+
+class _NullPhase(object):
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc_info):
+    pass
+
+_NULL_PHASE = _NullPhase()
+
+class PhaseTimer(object):
+  """Wall-clock durations of the phases of a loop, e.g. data, step, sample.
+
+  `phase(name)` returns a context manager that records how long its block
+  took. When disabled it returns one shared no-op context and `iterate`
+  returns its argument, so the timer costs a method call per phase.
+
+  Args:
+    enabled: Record durations. [False]
+  """
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.durations = collections.OrderedDict()
+
+  def phase(self, name):
+    if not self.enabled:
+      return _NULL_PHASE
+    return _Phase(self.durations.setdefault(name, []))
+
+  def iterate(self, name, iterable):
+    """Yields from `iterable`, timing each wait for the next item as `name`."""
+    if not self.enabled:
+      return iterable
+    return self._timed(name, iter(iterable))
+
+  def _timed(self, name, iterator):
+    durations = self.durations.setdefault(name, [])
+    while True:
+      start = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      durations.append(time.time() - start)
+      yield item
+
+  def summary(self, percentiles=(50, 90, 99)):
+    """Per phase: count, total and mean seconds, and the given percentiles."""
+    rows = collections.OrderedDict()
+    for name, durations in self.durations.items():
+      if not durations:
+        continue
+      values = np.asarray(durations)
+      row = collections.OrderedDict([('count', len(values)), ('total', values.sum()),
+                                     ('mean', values.mean())])
+      for q, value in zip(percentiles, np.percentile(values, percentiles)):
+        row['p{}'.format(q)] = value
+      rows[name] = row
+    return rows
+
+  def format_summary(self, percentiles=(50, 90, 99)):
+    rows = self.summary(percentiles)
+    grand_total = sum(row['total'] for row in rows.values()) or 1.
+    columns = ['p{}'.format(q) for q in percentiles]
+    lines = ["{:<12} {:>8} {:>10} {:>7} {:>10}".format('phase', 'count', 'total (s)', 'share', 'mean (ms)') +
+             ''.join(" {:>10}".format(col + ' (ms)') for col in columns)]
+    for name, row in rows.items():
+      lines.append("{:<12} {:>8d} {:>10.2f} {:>6.1f}% {:>10.2f}".format(
+          name, row['count'], row['total'], 100. * row['total'] / grand_total, 1e3 * row['mean']) +
+          ''.join(" {:>10.2f}".format(1e3 * row[col]) for col in columns))
+    return '\n'.join(lines) + '\n'
+
+  def write(self, path):
+    if not self.durations:
+      return
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(self.format_summary())
+
+def _layer_path(node_name):
+  """(scope parts, backward) of an op name, without tower and reuse suffixes.
+
+  'tower_1/gradients/generator_2/g_h1/conv2d_transpose_grad/Conv2D' becomes
+  (['generator', 'g_h1', 'conv2d_transpose_grad', 'Conv2D'], True).
+  """
+  parts, backward = [], False
+  for part in node_name.split(':')[0].split('/'):
+    if re.match(r'^gradients(_\d+)?$', part):
+      backward = True
+    elif not re.match(r'^tower(_\d+)?$', part):
+      parts.append(re.sub(r'_\d+$', '', part))
+  return parts, backward
+
+def layer_costs(step_stats, layers):
+  """Op time per conv2d/deconv2d/linear layer of one traced step.
+
+  Args:
+    step_stats: `RunMetadata.step_stats` of a traced `sess.run`.
+    layers: Iterable of (kind, variable scope), see `ops.LAYER_COLLECTION`.
+
+  Returns:
+    List of (scope, kind, forward ms, backward ms, ops), slowest first,
+    with everything outside those layers in one ('other', '', ...) row.
+  """
+  kinds = dict((scope, kind) for kind, scope in layers)
+  # On GPUs, kernel times are in the stream:all device; skip the launches
+  streamed = set(dev.device.rsplit('/stream:', 1)[0] for dev in step_stats.dev_stats
+                 if dev.device.endswith('/stream:all'))
+  costs = {}
+  for dev in step_stats.dev_stats:
+    if ('/stream:' in dev.device and not dev.device.endswith('/stream:all')) or dev.device in streamed:
+      continue
+    for node in dev.node_stats:
+      parts, backward = _layer_path(node.node_name)
+      scope = 'other'
+      for end in range(len(parts), 0, -1):
+        if '/'.join(parts[:end]) in kinds:
+          scope = '/'.join(parts[:end])
+          break
+      cost = costs.setdefault(scope, [0., 0., 0])
+      cost[1 if backward else 0] += node.all_end_rel_micros / 1e3
+      cost[2] += 1
+  rows = [(scope, kinds.get(scope, ''), f, b, n) for scope, (f, b, n) in costs.items()]
+  return sorted(rows, key=lambda row: -(row[2] + row[3]))
+
+def format_layer_costs(rows):
+  total = sum(row[2] + row[3] for row in rows) or 1.
+  lines = ["{:<36} {:<9} {:>12} {:>13} {:>7} {:>6}".format(
+      'layer', 'kind', 'forward (ms)', 'backward (ms)', 'share', 'ops')]
+  for scope, kind, forward, backward, count in rows:
+    lines.append("{:<36} {:<9} {:>12.3f} {:>13.3f} {:>6.1f}% {:>6d}".format(
+        scope, kind, forward, backward, 100. * (forward + backward) / total, count))
+  return '\n'.join(lines) + '\n'
+
+class StepTracer(object):
+  """Captures full traces of chosen steps of `sess.run`.
+
+  For each step in `steps`, `trace` returns RunOptions and RunMetadata to
+  pass to `sess.run`; any other step gets (None, None), which runs
+  untraced. `export` writes the trace as a Chrome timeline
+  (chrome://tracing) and a per-layer cost table next to it.
+
+  Args:
+    steps: Steps to trace.
+    logdir: Directory for the traces.
+    prefix: (optional) File name prefix, e.g. to tell workers apart. ['']
+  """
+  def __init__(self, steps, logdir, prefix=''):
+    self.steps = set(steps)
+    self.logdir = logdir
+    self.prefix = prefix
+
+  def trace(self, step):
+    if step not in self.steps:
+      return None, None
+    return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+  def export(self, step, run_metadata):
+    from tensorflow.python.client import timeline
+    if not os.path.exists(self.logdir):
+      os.makedirs(self.logdir)
+    path = os.path.join(self.logdir, '{}timeline_step_{}.json'.format(self.prefix, step))
+    with open(path, 'w') as f:
+      f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+    rows = layer_costs(run_metadata.step_stats, tf.get_collection(LAYER_COLLECTION))
+    with open(os.path.join(self.logdir, '{}op_costs_step_{}.txt'.format(self.prefix, step)), 'w') as f:
+      f.write(format_layer_costs(rows))
+    print(" [*] Trace of step {} written to {}".format(step, path))
@@ -0,0 +1,237 @@
+"""
+Post-training quantization of an exported DCGAN generator for CPU serving.
+
+    $ python quantize.py --export_dir export/mnist --out_dir export/mnist_int8 --mode int8
+
+Reads the frozen graph written by `main.py --export_dir` and writes:
+
+- generator.pb / generator.json: the same graph with its weights stored as
+  int8 (symmetric, one scale per output channel) or float16 and cast back
+  to float32 when the graph is loaded. It loads with
+  `export.FrozenGenerator`.
+- generator.tflite, when TensorFlow Lite is available: weights and
+  activations in int8, with activation ranges calibrated on random z and
+  label vectors, or a float16 model.
+- quantization.json: size, images/sec and output error of every variant
+  against the float graph, on inputs other than the calibration set.
+"""
+
+from __future__ import print_function
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import tensor_util
+
+from export import FrozenGenerator, GRAPH_NAME, SIGNATURE_NAME
+
+TFLITE_NAME = 'generator.tflite'
+REPORT_NAME = 'quantization.json'
+
+parser = argparse.ArgumentParser(description='Quantize an exported DCGAN generator.')
+parser.add_argument('--export_dir', type=str, required=True,
+           help='directory written by main.py --export_dir')
+parser.add_argument('--out_dir', type=str, required=True,
+           help='directory for the quantized generator')
+parser.add_argument('--mode', type=str, default='int8', choices=['int8', 'float16'],
+           help='storage type of the quantized weights [int8]')
+parser.add_argument('--calibration_size', type=int, default=512,
+           help='number of random inputs used to calibrate activation ranges [512]')
+parser.add_argument('--eval_size', type=int, default=512,
+           help='number of random inputs used to measure the output error [512]')
+parser.add_argument('--batch_size', type=int, default=64,
+           help='rows per batch of the calibration, evaluation and benchmark inputs [64]')
+parser.add_argument('--benchmark_batches', type=int, default=20,
+           help='number of batches timed per variant [20]')
+parser.add_argument('--seed', type=int, default=0,
+           help='seed of the calibration and evaluation inputs [0]')
+parser.add_argument('--no_tflite', action='store_true',
+           help='do not convert to TensorFlow Lite')
+
+def random_inputs(signature, num, size, rng):
+  """Batches of `size` uniform z and one-hot labels, as (z, y or None) pairs."""
+  batches = []
+  for _ in range(max(1, -(-num // size))):
+    z = rng.uniform(-1, 1, [size, signature['z_dim']]).astype(np.float32)
+    y = None
+    if signature['y_dim']:
+      y = np.eye(signature['y_dim'], dtype=np.float32)[rng.randint(signature['y_dim'], size=size)]
+    batches.append((z, y))
+  return batches
+
+def quantize_array(value, mode, axis=None):
+  """(stored array, float32 scale or None) for a weight array.
+
+  int8 is symmetric with one scale per index of `axis`, or one for the
+  whole array if `axis` is None.
+  """
+  if mode == 'float16':
+    return value.astype(np.float16), None
+  reduce_axes = tuple(i for i in range(value.ndim) if i != axis) if axis is not None else None
+  scale = np.abs(value).max(axis=reduce_axes, keepdims=True) / 127.
+  scale[scale == 0] = 1.
+  quantized = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+  return quantized, scale.astype(np.float32)
+
+# Axis of the output channels of a weight, by the op consuming it
+_OUTPUT_AXIS = {'MatMul': 1, 'Conv2DBackpropInput': 2, 'Conv2D': 3}
+
+def quantize_graph_def(graph_def, output_name, mode, min_elements=1024):
+  """Frozen graph with its large float32 constants stored as int8 or float16.
+
+  Each weight is replaced by its stored copy, cast to float32 (and, for
+  int8, multiplied by its scales) inside the graph, so consumers are
+  unchanged. Constants with fewer than `min_elements` values, e.g.
+  biases, stay float32.
+  """
+  consumers = {}
+  for node in graph_def.node:
+    for name in node.input:
+      consumers.setdefault(name.lstrip('^').split(':')[0], []).append(node.op)
+
+  graph = tf.Graph()
+  with graph.as_default():
+    input_map = {}
+    for node in graph_def.node:
+      if node.op != 'Const' or node.attr['dtype'].type != tf.float32.as_datatype_enum:
+        continue
+      value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+      if value.size < min_elements:
+        continue
+      axes = set(_OUTPUT_AXIS.get(op) for op in consumers.get(node.name, []))
+      axis = axes.pop() if len(axes) == 1 else None
+      stored, scale = quantize_array(value, mode, axis)
+      with tf.name_scope(node.name + '_' + mode):
+        weight = tf.cast(tf.constant(stored, name='stored'), tf.float32)
+        if scale is not None:
+          weight = weight * tf.constant(scale, name='scale')
+      input_map[node.name + ':0'] = weight
+    tf.import_graph_def(graph_def, input_map=input_map, name='')
+  # The float32 originals are no longer reachable from the output
+  return tf.graph_util.extract_sub_graph(graph.as_graph_def(), [output_name])
+
+def _tflite():
+  lite = getattr(tf, 'lite', None)
+  if lite is None or not hasattr(lite, 'TFLiteConverter') or not hasattr(lite, 'Optimize'):
+    return None
+  return lite
+
+def convert_tflite(generator, mode, calibration):
+  """TensorFlow Lite model of `generator`; int8 is calibrated on `calibration`."""
+  lite = _tflite()
+  inputs = [generator.z] + ([generator.y] if generator.y is not None else [])
+  converter = lite.TFLiteConverter.from_session(generator.sess, inputs, [generator.output])
+  converter.optimizations = [lite.Optimize.DEFAULT]
+  if mode == 'float16':
+    converter.target_spec.supported_types = [tf.float16]
+  else:
+    def representative_dataset():
+      for z, y in calibration:
+        yield [z] if y is None else [z, y]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [lite.OpsSet.TFLITE_BUILTINS_INT8]
+  return converter.convert()
+
+class TFLiteGenerator(object):
+  """Samples from a TensorFlow Lite generator with the `FrozenGenerator` interface."""
+  def __init__(self, model_content, signature):
+    self.signature = signature
+    self.interpreter = _tflite().Interpreter(model_content=model_content)
+    self.interpreter.allocate_tensors()
+    details = dict((d['name'].split(':')[0], d['index']) for d in self.interpreter.get_input_details())
+    self.z_index = details['z']
+    self.y_index = details.get('y')
+    self.output_index = self.interpreter.get_output_details()[0]['index']
+
+  def sample(self, z, y=None):
+    # The converter fixes the batch dimension; resize when the batch changes
+    if self.interpreter.get_input_details()[0]['shape'][0] != len(z):
+      self.interpreter.resize_tensor_input(self.z_index, z.shape)
+      if self.y_index is not None:
+        self.interpreter.resize_tensor_input(self.y_index, y.shape)
+      self.interpreter.allocate_tensors()
+    self.interpreter.set_tensor(self.z_index, z)
+    if self.y_index is not None:
+      self.interpreter.set_tensor(self.y_index, y)
+    self.interpreter.invoke()
+    return self.interpreter.get_tensor(self.output_index)
+
+def measure(generator, reference, eval_batches, benchmark_batches):
+  """Output error against the float outputs `reference`, and images/sec."""
+  errors = [generator.sample(z, y) - expected for (z, y), expected in zip(eval_batches, reference)]
+  errors = np.concatenate(errors)
+  rmse = float(np.sqrt(np.mean(errors ** 2)))
+
+  z, y = eval_batches[0]
+  generator.sample(z, y)
+  start_time = time.time()
+  for _ in range(benchmark_batches):
+    generator.sample(z, y)
+  elapsed = time.time() - start_time
+  return {
+    'max_abs_error': float(np.abs(errors).max()),
+    'mean_abs_error': float(np.abs(errors).mean()),
+    # Images are in [-1, 1]
+    'psnr': float(20 * np.log10(2. / rmse)) if rmse > 0 else float('inf'),
+    'images_per_sec': benchmark_batches * len(z) / elapsed,
+  }
+
+def main():
+  args = parser.parse_args()
+  if not os.path.exists(args.out_dir):
+    os.makedirs(args.out_dir)
+
+  float_generator = FrozenGenerator(args.export_dir)
+  signature = float_generator.signature
+  output_name = float_generator.output.op.name
+  rng = np.random.RandomState(args.seed)
+  calibration = random_inputs(signature, args.calibration_size, args.batch_size, rng)
+  eval_batches = random_inputs(signature, args.eval_size, args.batch_size, rng)
+  reference = [float_generator.sample(z, y) for z, y in eval_batches]
+
+  report = {'mode': args.mode, 'variants': {}}
+  def add_variant(name, generator, path):
+    result = measure(generator, reference, eval_batches, args.benchmark_batches)
+    result['bytes'] = os.path.getsize(path)
+    report['variants'][name] = result
+
+  add_variant('float32', float_generator, os.path.join(args.export_dir, GRAPH_NAME))
+
+  # Weights stored quantized in a TF graph
+  graph_def = quantize_graph_def(float_generator.graph.as_graph_def(), output_name, args.mode)
+  tf.train.write_graph(graph_def, args.out_dir, GRAPH_NAME, as_text=False)
+  quantized_signature = dict(signature, quantization=args.mode)
+  with open(os.path.join(args.out_dir, SIGNATURE_NAME), 'w') as f:
+    json.dump(quantized_signature, f, indent=2)
+  quantized_generator = FrozenGenerator(args.out_dir)
+  add_variant('graph_' + args.mode, quantized_generator, os.path.join(args.out_dir, GRAPH_NAME))
+  quantized_generator.close()
+
+  # Integer kernels need TensorFlow Lite
+  if not args.no_tflite:
+    if _tflite() is None:
+      print(" [!] TensorFlow Lite with post-training quantization is not available; "
+            "only the weights are quantized")
+    else:
+      model_content = convert_tflite(float_generator, args.mode, calibration)
+      tflite_path = os.path.join(args.out_dir, TFLITE_NAME)
+      with open(tflite_path, 'wb') as f:
+        f.write(model_content)
+      add_variant('tflite_' + args.mode, TFLiteGenerator(model_content, signature), tflite_path)
+  float_generator.close()
+
+  with open(os.path.join(args.out_dir, REPORT_NAME), 'w') as f:
+    json.dump(report, f, indent=2)
+
+  base = report['variants']['float32']
+  print("{:<16} {:>10} {:>8} {:>12} {:>9} {:>14} {:>14}".format(
+      'variant', 'size (MB)', 'size', 'images/sec', 'speedup', 'max abs error', 'psnr (dB)'))
+  for name, result in sorted(report['variants'].items(), key=lambda item: -item[1]['bytes']):
+    print("{:<16} {:>10.2f} {:>7.0f}% {:>12.1f} {:>8.2f}x {:>14.4f} {:>14.1f}".format(
+        name, result['bytes'] / 1e6, 100. * result['bytes'] / base['bytes'], result['images_per_sec'],
+        result['images_per_sec'] / base['images_per_sec'], result['max_abs_error'], result['psnr']))
+
+if __name__ == '__main__':
+  main()
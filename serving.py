@@ -0,0 +1,302 @@
+"""
+Sampling from an exported DCGAN generator behind a request queue.
+
+`MicroBatcher` combines concurrent requests for a few images each into one
+generator call, which is where a GPU or a multi-core CPU gets its
+throughput. `web/app.py` serves it over HTTP.
+"""
+from __future__ import division
+import io
+import time
+import threading
+import collections
+import numpy as np
+from six.moves import queue
+
+from utils import tile_images, images_to_uint8
+
+class QueueFull(Exception):
+  """Raised by `MicroBatcher.submit` when `max_queue` requests are waiting."""
+
+def seeded_z(seeds, z_dim):
+  """float32 [len(seeds), z_dim] uniform z; a seed always gives the same row."""
+  return np.stack([np.random.RandomState(seed).uniform(-1, 1, z_dim) for seed in seeds]).astype(np.float32)
+
+def request_inputs(signature, num=None, seeds=None, labels=None, rng=np.random):
+  """(z, y or None) for a request of `num` images.
+
+  Args:
+    signature: Dict from generator.json, for z_dim and y_dim.
+    num: (optional) Number of images; defaults to the number of seeds. [None]
+    seeds: (optional) One seed per image; the same seed always gives the same z. [None]
+    labels: (optional) One class per image, or a single class for all of
+      them. Random when the generator is conditional and none are given. [None]
+    rng: (optional) Source of z without seeds and of random labels. [np.random]
+  """
+  if seeds is not None:
+    if num is not None and num != len(seeds):
+      raise ValueError("Got {} seeds for {} images".format(len(seeds), num))
+    num = len(seeds)
+    z = seeded_z(seeds, signature['z_dim'])
+  else:
+    if num is None:
+      raise ValueError("Either num or seeds is required")
+    z = rng.uniform(-1, 1, [num, signature['z_dim']])
+  z = z.astype(np.float32)
+
+  y_dim = signature['y_dim']
+  if not y_dim:
+    if labels is not None:
+      raise ValueError("The generator takes no labels")
+    return z, None
+  if labels is None:
+    labels = rng.randint(y_dim, size=num)
+  labels = np.broadcast_to(np.asarray(labels, dtype=np.int64), [num])
+  if labels.min() < 0 or labels.max() >= y_dim:
+    raise ValueError("Labels must be in [0, {})".format(y_dim))
+  return z, np.eye(y_dim, dtype=np.float32)[labels]
+
+def to_uint8(images):
+  """Generator outputs in [-1, 1] as uint8 pixels."""
+  return images_to_uint8(images)
+
+def png_grid(pixels):
+  """PNG bytes of a grid of uint8 [num, height, width, channels] images."""
+  from PIL import Image
+  columns = int(np.ceil(np.sqrt(len(pixels))))
+  rows = -(-len(pixels) // columns)
+  grid = tile_images(pixels, (rows, columns))
+  data = io.BytesIO()
+  Image.fromarray(np.uint8(np.squeeze(grid))).save(data, format='PNG')
+  return data.getvalue()
+
+def decode_png(data):
+  """uint8 [height, width, channels] pixels of PNG bytes."""
+  from PIL import Image
+  pixels = np.asarray(Image.open(io.BytesIO(data)))
+  return pixels[:, :, None] if pixels.ndim == 2 else pixels
+
+def encode_png(images):
+  """PNG bytes of a grid of generator outputs in [-1, 1]."""
+  return png_grid(to_uint8(images))
+
+def encode_npy(images):
+  """.npy bytes of a float32 [num, height, width, channels] array."""
+  data = io.BytesIO()
+  np.save(data, images.astype(np.float32))
+  return data.getvalue()
+
+def decode_npy(data):
+  return np.load(io.BytesIO(data))
+
+def cache_config(signature):
+  """The fields of a generator signature that change its outputs."""
+  return dict((name, signature.get(name)) for name in
+              ('model', 'imsize', 'c_dim', 'z_dim', 'y_dim', 'quantization'))
+
+class _Request(object):
+  __slots__ = ('z', 'y', 'enqueued', 'done', 'images', 'signature', 'error')
+
+  def __init__(self, z, y):
+    self.z, self.y = z, y
+    self.enqueued = time.time()
+    self.done = threading.Event()
+    self.images = self.signature = self.error = None
+
+class MicroBatcher(object):
+  """Runs queued sample requests in batches on one background thread.
+
+  The thread takes the oldest request and keeps adding requests until the
+  batch has `max_batch` rows or the oldest has waited `max_latency`
+  seconds, then makes one `generator.sample` call and hands every request
+  its rows. Under light load a request waits at most `max_latency`; under
+  heavy load batches fill up before the deadline.
+
+  Args:
+    generator: Object with `signature` and `sample(z, y)`, e.g. `export.FrozenGenerator`.
+    max_batch: Most rows per generator call. [256]
+    max_latency: Seconds the oldest request waits for others. [0.005]
+    max_queue: Waiting requests before `submit` raises `QueueFull`. [1024]
+    window: Number of recent requests and batches the metrics cover. [1000]
+  """
+  def __init__(self, generator, max_batch=256, max_latency=0.005, max_queue=1024, window=1000):
+    self.generator = generator
+    self.signature = generator.signature
+    self._generator_lock = threading.Lock()
+    self.max_batch = max_batch
+    self.max_latency = max_latency
+    self._queue = queue.Queue(maxsize=max_queue)
+    self._lock = threading.Lock()
+    self._queued_rows = 0
+    self._counts = collections.Counter()
+    self._waits = collections.deque(maxlen=window)
+    self._latencies = collections.deque(maxlen=window)
+    self._batch_rows = collections.deque(maxlen=window)
+    self._run_times = collections.deque(maxlen=window)
+    self._started = time.time()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def replace_generator(self, generator):
+    """Serves later batches from `generator`; returns the previous one, now idle."""
+    with self._generator_lock:
+      previous, self.generator = self.generator, generator
+      self.signature = generator.signature
+    return previous
+
+  def submit(self, z, y=None, timeout=None, return_signature=False):
+    """Images for one request; blocks until its batch has run.
+
+    With `return_signature`, returns (images, signature of the generator
+    that made them), which differs from `signature` after a reload.
+    """
+    if len(z) > self.max_batch:
+      raise ValueError("At most {} images per request, got {}".format(self.max_batch, len(z)))
+    request = _Request(z, y)
+    with self._lock:
+      try:
+        self._queue.put_nowait(request)
+      except queue.Full:
+        self._counts['rejected'] += 1
+        raise QueueFull("{} requests are waiting".format(self._queue.qsize()))
+      self._queued_rows += len(z)
+    if not request.done.wait(timeout):
+      raise RuntimeError("No result after {} seconds".format(timeout))
+    if request.error is not None:
+      raise request.error
+    if return_signature:
+      return request.images, request.signature
+    return request.images
+
+  def _next_batch(self, first):
+    batch, rows = [first], len(first.z)
+    deadline = first.enqueued + self.max_latency
+    while rows < self.max_batch:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      try:
+        request = self._queue.get(timeout=remaining)
+      except queue.Empty:
+        break
+      if request is None or rows + len(request.z) > self.max_batch:
+        # Starts the next batch, or stops the thread after this one
+        return batch, request
+      batch.append(request)
+      rows += len(request.z)
+    return batch, False
+
+  def _run(self):
+    carry = False
+    while True:
+      first = carry if carry is not False else self._queue.get()
+      if first is None:
+        return
+      batch, carry = self._next_batch(first)
+      rows = sum(len(request.z) for request in batch)
+      with self._lock:
+        self._queued_rows -= rows
+
+      start_time = time.time()
+      try:
+        z = np.concatenate([request.z for request in batch])
+        y = np.concatenate([request.y for request in batch]) if batch[0].y is not None else None
+        with self._generator_lock:
+          images = self.generator.sample(z, y)
+          signature = self.generator.signature
+      except Exception as error:
+        for request in batch:
+          request.error = error
+          request.done.set()
+        with self._lock:
+          self._counts['errors'] += len(batch)
+        continue
+      end_time = time.time()
+
+      offset = 0
+      for request in batch:
+        request.images = images[offset:offset + len(request.z)]
+        request.signature = signature
+        offset += len(request.z)
+        request.done.set()
+      with self._lock:
+        self._counts['requests'] += len(batch)
+        self._counts['images'] += rows
+        self._counts['batches'] += 1
+        self._batch_rows.append(rows)
+        self._run_times.append(end_time - start_time)
+        for request in batch:
+          self._waits.append(start_time - request.enqueued)
+          self._latencies.append(end_time - request.enqueued)
+
+  def metrics(self):
+    """Queue depth, counters, and batch size and latency percentiles in ms."""
+    def percentiles(values, scale=1e3):
+      if not values:
+        return None
+      p50, p90, p99 = np.percentile(np.asarray(values), [50, 90, 99]) * scale
+      return {'mean': float(np.mean(values) * scale), 'p50': float(p50), 'p90': float(p90),
+              'p99': float(p99), 'max': float(np.max(values) * scale)}
+    with self._lock:
+      return {
+        'queue_requests': self._queue.qsize(),
+        'queue_images': self._queued_rows,
+        'uptime_secs': time.time() - self._started,
+        'counts': dict(self._counts),
+        'batch_rows': percentiles(list(self._batch_rows), scale=1),
+        'queue_wait_ms': percentiles(list(self._waits)),
+        'run_ms': percentiles(list(self._run_times)),
+        'latency_ms': percentiles(list(self._latencies)),
+        'max_batch': self.max_batch,
+        'max_latency_ms': self.max_latency * 1e3,
+      }
+
+  def close(self):
+    """Stops the thread once the requests already queued have run."""
+    self._queue.put(None)
+    self._thread.join()
+
+class CachedSampler(object):
+  """Seeded sample requests through an `ImageCache`, one entry per image.
+
+  Only the images missing from the cache go to the batcher; each is
+  encoded on its own and cached. Responses of several images are
+  assembled from the per-image entries.
+
+  Args:
+    batcher: `MicroBatcher` of the generator.
+    cache: `cache.ImageCache`.
+  """
+  def __init__(self, batcher, cache):
+    self.batcher = batcher
+    self.cache = cache
+    self.bind()
+
+  def bind(self):
+    """Drops the cached images of any other generator than the batcher's."""
+    signature = self.batcher.signature
+    self.cache.bind(signature.get('step'), cache_config(signature))
+
+  def sample(self, seeds, labels=None, fmt='png'):
+    """Encoded response for one image per seed, with `labels` as in `request_inputs`."""
+    z, y = request_inputs(self.batcher.signature, seeds=seeds, labels=labels)
+    per_image = [None] * len(seeds) if y is None else [int(label) for label in y.argmax(axis=1)]
+    keys = [(int(seed), label, str(fmt)) for seed, label in zip(seeds, per_image)]
+    entries = [self.cache.get(key) for key in keys]
+
+    missing = [idx for idx, entry in enumerate(entries) if entry is None]
+    if missing:
+      images, used = self.batcher.submit(z[missing], None if y is None else y[missing],
+                                         return_signature=True)
+      # Dropped by the cache if it has been bound to a newer generator since
+      namespace = self.cache.namespace_of(used.get('step'), cache_config(used))
+      for idx, image in zip(missing, images):
+        entries[idx] = png_grid(to_uint8(image[None])) if fmt == 'png' else encode_npy(image[None])
+        self.cache.put(keys[idx], entries[idx], namespace)
+
+    if len(entries) == 1:
+      return entries[0]
+    if fmt == 'png':
+      return png_grid(np.stack([decode_png(entry) for entry in entries]))
+    return encode_npy(np.concatenate([decode_npy(entry) for entry in entries]))
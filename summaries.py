@@ -0,0 +1,164 @@
+"""
+Training statistics for DCGAN: TensorBoard summaries on per-kind cadences
+with a background writer, and buffered per-epoch metric logs.
+"""
+import os
+import sys
+import json
+import threading
+from six.moves import queue
+
+from ops import merge_summary, SummaryWriter
+
+class AsyncSummaryWriter(object):
+  """Writes serialized summaries to an event file from a background thread.
+
+  `add_summary` only enqueues the bytes returned by `sess.run`; parsing and
+  disk I/O happen on the writer thread. The queue holds at most `max_queue`
+  summaries, after which `add_summary` waits for the writer to catch up.
+
+  Args:
+    logdir: Directory for the event files.
+    graph: (optional) Graph to write for TensorBoard's graph view [None]
+    max_queue: Number of summaries buffered before blocking. [64]
+  """
+  def __init__(self, logdir, graph=None, max_queue=64):
+    self._writer = SummaryWriter(logdir, graph)
+    self._queue = queue.Queue(maxsize=max_queue)
+    self._error = None
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      try:
+        if item is None:
+          return
+        summary, step = item
+        if summary is None:
+          self._writer.flush()
+        else:
+          self._writer.add_summary(summary, step)
+      except Exception:
+        self._error = sys.exc_info()[1]
+      finally:
+        self._queue.task_done()
+
+  def add_summary(self, summary, step):
+    if self._error is not None:
+      raise self._error
+    self._queue.put((summary, step))
+
+  def flush(self):
+    """Blocks until every queued summary is written to disk."""
+    self._queue.put((None, None))
+    self._queue.join()
+
+  def close(self):
+    self.flush()
+    self._queue.put(None)
+    self._thread.join()
+    self._writer.close()
+
+class SummarySchedule(object):
+  """Decides which summary groups to fetch at a training step.
+
+  Each kind (e.g. scalars, histograms, images) is merged into one op with its
+  own cadence in steps; a cadence of 0 disables it. Steps with nothing due
+  get an empty fetch list, so they run exactly the training ops.
+
+  Args:
+    groups: Dict of kind -> (every, list of summary ops).
+  """
+  def __init__(self, groups):
+    self.groups = []
+    for kind, (every, summary_ops) in sorted(groups.items()):
+      if every and summary_ops:
+        self.groups.append((kind, every, merge_summary(summary_ops)))
+
+  def __bool__(self):
+    return bool(self.groups)
+  __nonzero__ = __bool__
+
+  def fetches(self, step):
+    return [op for _, every, op in self.groups if step % every == 0]
+
+class RunningMeans(object):
+  """Running means of a fixed list of per-step values, e.g. losses."""
+  def __init__(self, names):
+    self.names = list(names)
+    self.reset()
+
+  def reset(self):
+    self.sums = [0.] * len(self.names)
+    self.count = 0
+
+  def update(self, values):
+    for idx, value in enumerate(values):
+      self.sums[idx] += float(value)
+    self.count += 1
+
+  def means(self):
+    count = max(self.count, 1)
+    return dict((name, total / count) for name, total in zip(self.names, self.sums))
+
+class MetricsLog(object):
+  """Buffered CSV or JSON lines log with one row per call to `write`.
+
+  Rows are kept in memory and appended to `path` every `flush_every` rows
+  and on `close`, so the training loop does not touch the file each epoch.
+  With a `writer`, the appends run on its threads.
+
+  Args:
+    path: File to append to.
+    fields: Column names, in order.
+    fmt: Output format [csv, jsonl]. [csv]
+    flush_every: Number of rows buffered between writes. [10]
+    writer: (optional) `artifacts.ArtifactWriter` for the appends. [None]
+  """
+  def __init__(self, path, fields, fmt='csv', flush_every=10, writer=None):
+    if fmt not in ('csv', 'jsonl'):
+      raise ValueError("fmt must be csv or jsonl, got {}".format(fmt))
+    self.path = path
+    self.fields = list(fields)
+    self.fmt = fmt
+    self.flush_every = max(1, flush_every)
+    self.writer = writer
+    self._rows = []
+    self._has_header = False
+
+  def write(self, row):
+    self._rows.append(row)
+    if len(self._rows) >= self.flush_every:
+      self.flush()
+
+  def format_rows(self, rows):
+    """Text for `rows`, with a CSV header when `path` did not exist yet."""
+    lines = []
+    if self.fmt == 'csv':
+      # Checked once, since a background append may not have happened yet
+      if not self._has_header and (not os.path.exists(self.path) or os.path.getsize(self.path) == 0):
+        lines.append(','.join(self.fields))
+      self._has_header = True
+      for row in rows:
+        lines.append(','.join(str(row.get(field, '')) for field in self.fields))
+    else:
+      for row in rows:
+        lines.append(json.dumps(dict((field, row.get(field)) for field in self.fields)))
+    return ''.join(line + '\n' for line in lines)
+
+  def flush(self):
+    if not self._rows:
+      return
+    rows, self._rows = self._rows, []
+    text = self.format_rows(rows)
+    if self.writer is not None:
+      self.writer.append(self.path, text)
+    else:
+      with open(self.path, 'a') as f:
+        f.write(text)
+
+  def close(self):
+    self.flush()
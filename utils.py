@@ -6,6 +6,8 @@ import math
 import json
 import random
 import pprint
+import collections
+import threading
 import scipy.misc
 import numpy as np
 from time import gmtime, strftime
@@ -29,8 +31,25 @@ def get_image(image_path, input_height, input_width,
   return transform(image, input_height, input_width,
                    resize_height, resize_width, crop)
 
+# Per-thread grid canvas reused by save_images while the grid shape stays the same
+_grid_buffers = threading.local()
+
 def save_images(images, shape, image_path, column_size=None):
-  return imsave(inverse_transform(images), shape, image_path, column_size=column_size)
+  """Writes images in [-1, 1] as one grid, laid out as `merge` does.
+
+  Pixels are converted to uint8 once and tiled into a canvas that is
+  reused across calls, so nothing is rescaled on write.
+  """
+  pixels = images_to_uint8(images)
+  if pixels.shape[3] not in (1, 3, 4):
+    raise ValueError('in merge(images,size) images parameter '
+                     'must have dimensions: HxW or HxWx3 or HxWx4')
+  # Grayscale grids have no column layout, as in merge
+  column_size = column_size if pixels.shape[3] != 1 else None
+  grid = tile_images(pixels, shape, column_size, out=getattr(_grid_buffers, 'grid', None),
+                     background=255 if column_size else 0)
+  _grid_buffers.grid = grid
+  return scipy.misc.imsave(image_path, np.squeeze(grid))
 
 def imread(path, grayscale = False):
   if (grayscale):
@@ -42,38 +61,74 @@ def merge_images(images, size):
   return inverse_transform(images)
 
 
-def merge_color_images(images, size, column_size=None):
-  h, w = images.shape[1], images.shape[2]
-  c = images.shape[3]
-  
+def images_to_uint8(images, out=None):
+  """uint8 pixels of images in [-1, 1], rounded, computed in float32.
+
+  Args:
+    images: Array of any shape; uint8 arrays are returned as they are.
+    out: (optional) uint8 array of the same shape to write into. [None]
+  """
+  images = np.asarray(images)
+  if images.dtype == np.uint8:
+    return images
+  scaled = np.add(images, 1., dtype=np.float32)
+  scaled *= 127.5
+  scaled += .5
+  np.clip(scaled, 0, 255, out=scaled)
+  if out is None:
+    return scaled.astype(np.uint8)
+  out[...] = scaled
+  return out
+
+def tile_images(images, size, column_size=None, out=None, background=0):
+  """Tiles [num, h, w, c] images into one [height, width, c] grid.
+
+  With `column_size`, rows hold `column_size` images and each row is
+  followed by a one pixel gap; otherwise the grid is `size` = (rows,
+  columns). Images fill the grid row by row, and unused cells and gaps
+  are `background`. The grid is written through a reshaped view of the
+  canvas, with no Python loop over images and no intermediate copies.
+
+  Args:
+    images: [num, h, w, c] array; the grid has its dtype.
+    size: (rows, columns) of the grid, ignored with `column_size`.
+    column_size: (optional) Images per row of the gap layout. [None]
+    out: (optional) Canvas reused if it has the grid's shape and dtype,
+      e.g. the result of an earlier call. [None]
+    background: (optional) Value of unused cells and gaps. [0]
+
+  Returns:
+    The grid, which is `out` when it was reused.
+  """
+  num, h, w, c = images.shape
   if column_size:
-    num_images = images.shape[0]
-    n_rows = int(num_images/column_size)
-    img = np.ones((n_rows*(h+1),column_size*w, c))
-    row_idx = 0
-    col_idx = 0
-    for idx, image in enumerate(images):
-      img[row_idx * (h+1):row_idx*(h+1) + h, col_idx*w:col_idx*w + w] = image
-      col_idx += 1
-      if col_idx == column_size:
-        col_idx = 0
-        row_idx += 1
+    rows, columns, cell_h = -(-num // column_size), column_size, h + 1
   else:
-    img = np.zeros((h * size[0], w * size[1], c))
-    for idx, image in enumerate(images):
-      i = idx % size[1]
-      j = idx // size[1]
-      img[j * h:j * h + h, i * w:i * w + w, :] = image
-  return img
+    rows, columns, cell_h = int(size[0]), int(size[1]), h
+    if num > rows * columns:
+      raise ValueError("{} images do not fit a {}x{} grid".format(num, rows, columns))
+  shape = (rows * cell_h, columns * w, c)
+  if out is None or out.shape != shape or out.dtype != images.dtype or not out.flags.c_contiguous:
+    out = np.empty(shape, dtype=images.dtype)
+
+  # cells[row, y, column, x] is pixel (y, x) of the image at (row, column)
+  cells = out.reshape(rows, cell_h, columns, w, c)
+  full_rows = num // columns
+  cells[:full_rows, :h] = images[:full_rows * columns].reshape(full_rows, columns, h, w, c).transpose(0, 2, 1, 3, 4)
+  remainder = num - full_rows * columns
+  if remainder:
+    cells[full_rows, :h, :remainder] = images[full_rows * columns:].transpose(1, 0, 2, 3)
+    cells[full_rows, :h, remainder:] = background
+  cells[full_rows + (1 if remainder else 0):, :h] = background
+  cells[:, h:] = background
+  return out
+
+def merge_color_images(images, size, column_size=None):
+  # Gaps and unused cells of the column layout are white
+  return tile_images(images, size, column_size, background=1 if column_size else 0)
 
 def merge_grayscale_images(images, size):
-  h, w = images.shape[1], images.shape[2]
-  img = np.zeros((h * size[0], w * size[1]))
-  for idx, image in enumerate(images):
-    i = idx % size[1]
-    j = idx // size[1]
-    img[j * h:j * h + h, i * w:i * w + w] = image[:,:,0]
-  return img
+  return tile_images(images, size)[:, :, 0]
 
 def merge(images, size, column_size=None):
   if (images.shape[3] in (3,4)):
@@ -117,6 +172,102 @@ def transform(image, input_height, input_width,
     cropped_image = scipy.misc.imresize(image, [resize_height, resize_width])
   return np.array(cropped_image)/127.5 - 1.
 
+# Read-only resize weights by (output size, input size), shared by all threads
+_resize_weights_cache = {}
+# Per-thread scratch arrays reused by resize_batch while the batch shape stays the same
+_resize_buffers = threading.local()
+
+def _resize_weights(out_size, in_size):
+  """(out_size, in_size) float32 weights of an antialiased bilinear resize.
+
+  A triangle filter widened by the downscale factor, renormalized at the
+  borders, as PIL's BILINEAR (and so `scipy.misc.imresize`) resamples.
+  """
+  key = (out_size, in_size)
+  weights = _resize_weights_cache.get(key)
+  if weights is None:
+    scale = in_size / out_size
+    support = max(scale, 1.)
+    centers = (np.arange(out_size) + .5) * scale
+    taps = np.arange(in_size) + .5
+    weights = np.maximum(0., 1. - np.abs(taps[None, :] - centers[:, None]) / support)
+    weights = (weights / weights.sum(axis=1, keepdims=True)).astype(np.float32)
+    weights.flags.writeable = False
+    _resize_weights_cache[key] = weights
+  return weights
+
+def _resize_buffer(name, shape):
+  buffer = getattr(_resize_buffers, name, None)
+  if buffer is None or buffer.shape != shape:
+    buffer = np.empty(shape, dtype=np.float32)
+    setattr(_resize_buffers, name, buffer)
+  return buffer
+
+def resize_batch(images, input_height, input_width=None,
+                 resize_height=64, resize_width=64, crop=True,
+                 random_flip=False, out=None, rng=np.random):
+  """Center crops and resizes a uint8 batch to float32 pixels in [0, 255].
+
+  Each axis is resampled by one matrix product with antialiased bilinear
+  weights, so downscales average every source pixel as `imresize` does.
+  Intermediate arrays are per-thread buffers reused across calls.
+
+  Args:
+    images: uint8 array of shape (N, H, W, C) or (N, H, W), or a list of
+      HxWxC arrays of the same shape.
+    input_height: Crop height when `crop` is set.
+    input_width: (optional) Crop width. If None, same value as input_height [None]
+    resize_height: Output height. [64]
+    resize_width: Output width. [64]
+    crop: Crop a centered input_height x input_width window before resizing. [True]
+    random_flip: Mirror each image horizontally with probability 0.5. [False]
+    out: (optional) float32 (N, resize_height, resize_width, C) array to write into. [None]
+    rng: Random state for flips. [np.random]
+  """
+  if isinstance(images, np.ndarray) and images.ndim == 3:
+    images = images[:, :, :, None]
+  n = len(images)
+  h, w, c = images[0].shape
+  if input_width is None:
+    input_width = input_height
+  crop_h, crop_w = (input_height, input_width) if crop else (h, w)
+  top, left = int(round((h - crop_h)/2.)), int(round((w - crop_w)/2.))
+  if out is None:
+    out = np.empty((n, resize_height, resize_width, c), dtype=np.float32)
+
+  pixels = _resize_buffer('pixels', (n, crop_h, crop_w, c))
+  if isinstance(images, np.ndarray):
+    pixels[...] = images[:, top:top + crop_h, left:left + crop_w]
+  else:
+    for idx, image in enumerate(images):
+      pixels[idx] = image[top:top + crop_h, left:left + crop_w]
+
+  rows = _resize_buffer('rows', (n, resize_height, crop_w * c))
+  np.matmul(_resize_weights(resize_height, crop_h), pixels.reshape(n, crop_h, crop_w * c), out=rows)
+  cols = _resize_weights(resize_width, crop_w)
+  if random_flip:
+    # A mirrored output reads the source columns in reverse order
+    flipped = _resize_buffer('cols', (n, 1, resize_width, crop_w))
+    flipped[...] = cols
+    flipped[rng.random_sample(n) < 0.5] = cols[::-1]
+    cols = flipped
+  np.matmul(cols, rows.reshape(n, resize_height, crop_w, c), out=out)
+  return out
+
+def transform_batch(images, input_height, input_width=None,
+                    resize_height=64, resize_width=64, crop=True,
+                    random_flip=False, out=None, rng=np.random):
+  """Crops, resizes and scales a whole uint8 batch to float32 in [-1, 1].
+
+  Vectorized counterpart of `transform`, resampled by `resize_batch`.
+  Takes the same arguments.
+  """
+  out = resize_batch(images, input_height, input_width, resize_height, resize_width,
+                     crop=crop, random_flip=random_flip, out=out, rng=rng)
+  out *= np.float32(1/127.5)
+  out -= np.float32(1.)
+  return out
+
 def inverse_transform(images):
   return (images+1.)/2.
 
@@ -184,94 +335,170 @@ def to_json(output_path, *layers):
     layer_f.write(" ".join(lines.replace("'","").split()))
 
 def make_gif(images, fname, duration=2, true_image=False):
-  import moviepy.editor as mpy
-
-  def make_frame(t):
-    try:
-      x = images[int(len(images)/duration*t)]
-    except:
-      x = images[-1]
-
-    if true_image:
-      return x.astype(np.uint8)
-    else:
-      return ((x+1)/2*255).astype(np.uint8)
-
-  clip = mpy.VideoClip(make_frame, duration=duration)
-  clip.write_gif(fname, fps = len(images) / duration)
-
-def visualize(sess, dcgan, config, option):
+  """Writes `images` as an animation lasting `duration` seconds.
+
+  `images` are frames in [-1, 1], or uint8 with `true_image`; they are
+  encoded one at a time, see `animation.AnimationWriter`.
+  """
+  from animation import AnimationWriter
+
+  with AnimationWriter(fname, fps=len(images) / duration) as writer:
+    for image in images:
+      writer.add(image.astype(np.uint8) if true_image else image)
+
+def lerp(a, b, steps):
+  """`steps` points on the line from `a` to `b`.
+
+  `a` and `b` are [..., z_dim]; the result is [..., steps, z_dim].
+  """
+  a, b = np.asarray(a, dtype=np.float64)[..., None, :], np.asarray(b, dtype=np.float64)[..., None, :]
+  t = np.linspace(0., 1., steps)[:, None]
+  return a + t * (b - a)
+
+def slerp(a, b, steps):
+  """`steps` points on the great circle from `a` to `b`, shaped as in `lerp`.
+
+  Points keep the norm of uniform or normal z better than `lerp`, which
+  cuts through the low-density middle of the space. Nearly parallel pairs
+  fall back to `lerp`.
+  """
+  a, b = np.asarray(a, dtype=np.float64)[..., None, :], np.asarray(b, dtype=np.float64)[..., None, :]
+  t = np.linspace(0., 1., steps)[:, None]
+  norms = np.maximum(np.linalg.norm(a, axis=-1, keepdims=True) * np.linalg.norm(b, axis=-1, keepdims=True), 1e-12)
+  omega = np.arccos(np.clip(np.sum(a * b, axis=-1, keepdims=True) / norms, -1., 1.))
+  sin_omega = np.sin(omega)
+  curved = sin_omega > 1e-6
+  sin_omega = np.where(curved, sin_omega, 1.)
+  weight_a = np.where(curved, np.sin((1. - t) * omega) / sin_omega, 1. - t)
+  weight_b = np.where(curved, np.sin(t * omega) / sin_omega, t)
+  return weight_a * a + weight_b * b
+
+def traversal_z(base, dims, values):
+  """z sweeping dimension `dims[i]` of `base` over `values`, for every i.
+
+  Args:
+    base: Starting z, as [z_dim] for all traversals, [len(dims), z_dim]
+      per traversal, or [len(dims), len(values), z_dim] per row.
+    dims: Dimension swept by each traversal.
+    values: Values each swept dimension takes, one per row.
+
+  Returns:
+    [len(dims), len(values), z_dim] array.
+  """
+  base, dims, values = np.asarray(base), np.asarray(dims), np.asarray(values)
+  if base.ndim == 2:
+    base = base[:, None, :]
+  z = np.empty((len(dims), len(values), base.shape[-1]))
+  z[...] = base
+  z[np.arange(len(dims))[:, None], np.arange(len(values))[None, :], dims[:, None]] = values[None, :]
+  return z
+
+def random_labels(shape, y_dim):
+  """Random one-hot labels of `shape` + [y_dim], or None without labels."""
+  if not y_dim:
+    return None
+  return np.eye(y_dim)[np.random.randint(y_dim, size=shape)]
+
+def traverse(sess, dcgan, z, y=None, max_rows=4096):
+  """Samples of every group of a [groups, rows, z_dim] z, in order.
+
+  Groups are packed into sampler runs of up to `max_rows` rows, rounded
+  down to whole groups, and each is yielded as (group index, samples) as
+  soon as its run finishes, so callers can write it out straight away.
+  """
+  groups, rows = z.shape[:2]
+  per_run = max(1, max_rows // rows)
+  flat_z = z.reshape(-1, z.shape[-1])
+  flat_y = y.reshape(-1, y.shape[-1]) if y is not None else None
+  for first in xrange(0, groups, per_run):
+    start, end = first * rows, min(groups, first + per_run) * rows
+    feed_dict = {dcgan.z: flat_z[start:end]}
+    if flat_y is not None:
+      feed_dict[dcgan.y] = flat_y[start:end]
+    samples = sess.run(dcgan.sampler, feed_dict=feed_dict)
+    for idx in xrange(len(samples) // rows):
+      yield first + idx, samples[idx * rows:(idx + 1) * rows]
+
+def visualize(sess, dcgan, config, option, max_rows=4096, writer=None):
+  """Writes sample grids, latent traversals and interpolations to ./samples.
+
+  Options: 0 a grid of random samples; 1 one grid per z dimension swept
+  from 0 to 1 around random z; 2 GIFs of random dimensions swept around
+  small random z; 3 GIFs of each dimension swept from z = 0; 4 as 3, plus
+  an animation of all the traversals side by side, played forth and back,
+  as MP4 when ffmpeg is available; 5 grids of linear and
+  spherical interpolations between random pairs of z. Traversals share
+  sampler runs of up to `max_rows` rows. With an `artifacts.ArtifactWriter`
+  as `writer`, images and GIFs are encoded and written on its threads.
+  """
+  write_images = writer.save_images if writer is not None else save_images
+  write_gif = writer.make_gif if writer is not None else make_gif
   image_frame_dim = int(math.ceil(config.batch_size**.5))
+  size, z_dim, y_dim = config.batch_size, dcgan.z_dim, dcgan.y_dim
+  values = np.arange(0, 1, 1./size)
   if option == 0:
-    z_sample = np.random.uniform(-0.5, 0.5, size=(config.batch_size, dcgan.z_dim))
-    samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample})
-    save_images(samples, [image_frame_dim, image_frame_dim], './samples/test_%s.png' % strftime("%Y-%m-%d-%H-%M-%S", gmtime()))
+    z_sample = np.random.uniform(-0.5, 0.5, size=(1, size, z_dim))
+    for _, samples in traverse(sess, dcgan, z_sample, random_labels((1, size), y_dim), max_rows):
+      write_images(samples, [image_frame_dim, image_frame_dim], './samples/test_%s.png' % strftime("%Y-%m-%d-%H-%M-%S", gmtime()))
   elif option == 1:
-    values = np.arange(0, 1, 1./config.batch_size)
-    for idx in xrange(dcgan.z_dim):
+    z_sample = traversal_z(np.random.uniform(-1, 1, size=(z_dim, size, z_dim)), np.arange(z_dim), values)
+    for idx, samples in traverse(sess, dcgan, z_sample, random_labels((z_dim, size), y_dim), max_rows):
       print(" [*] %d" % idx)
-      z_sample = np.random.uniform(-1, 1, size=(config.batch_size , dcgan.z_dim))
-      for kdx, z in enumerate(z_sample):
-        z[idx] = values[kdx]
-
-      if config.dataset == "mnist":
-        y = np.random.choice(10, config.batch_size)
-        y_one_hot = np.zeros((config.batch_size, 10))
-        y_one_hot[np.arange(config.batch_size), y] = 1
-
-        samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample, dcgan.y: y_one_hot})
-      else:
-        samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample})
-
-      save_images(samples, [image_frame_dim, image_frame_dim], './samples/test_arange_%s.png' % (idx))
+      write_images(samples, [image_frame_dim, image_frame_dim], './samples/test_arange_%s.png' % (idx))
   elif option == 2:
-    values = np.arange(0, 1, 1./config.batch_size)
-    for idx in [random.randint(0, dcgan.z_dim - 1) for _ in xrange(dcgan.z_dim)]:
+    dims = np.array([random.randint(0, z_dim - 1) for _ in xrange(z_dim)])
+    z_sample = traversal_z(np.random.uniform(-0.2, 0.2, size=(len(dims), z_dim)), dims, values)
+    for kdx, samples in traverse(sess, dcgan, z_sample, random_labels((len(dims), size), y_dim), max_rows):
+      print(" [*] %d" % dims[kdx])
+      write_gif(samples, './samples/test_gif_%s.gif' % (dims[kdx]))
+  elif option in (3, 4):
+    z_sample = traversal_z(np.zeros(z_dim), np.arange(z_dim), values)
+    y_sample = random_labels((z_dim, size), y_dim)
+    for idx, samples in traverse(sess, dcgan, z_sample, y_sample, max_rows):
       print(" [*] %d" % idx)
-      z = np.random.uniform(-0.2, 0.2, size=(dcgan.z_dim))
-      z_sample = np.tile(z, (config.batch_size, 1))
-      #z_sample = np.zeros([config.batch_size, dcgan.z_dim])
-      for kdx, z in enumerate(z_sample):
-        z[idx] = values[kdx]
-
-      if config.dataset == "mnist":
-        y = np.random.choice(10, config.batch_size)
-        y_one_hot = np.zeros((config.batch_size, 10))
-        y_one_hot[np.arange(config.batch_size), y] = 1
-
-        samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample, dcgan.y: y_one_hot})
+      write_gif(samples, './samples/test_gif_%s.gif' % (idx))
+    if option == 4:
+      # Sampled frame by frame, so each frame is tiled and encoded as soon as
+      # its run finishes. Only the frames of about one sampler run are kept:
+      # they start the way back, and the rest of it is sampled again
+      from animation import AnimationWriter, animation_path
+      # Frame k tiles step k of every traversal, with the labels of its GIF
+      frame_z = z_sample.transpose(1, 0, 2)
+      frame_y = y_sample.transpose(1, 0, 2) if y_sample is not None else None
+      grid = (int(math.floor(z_dim**.5)), int(math.ceil(z_dim / math.floor(z_dim**.5))))
+      animation = AnimationWriter(animation_path('./samples/test_merged'), fps=2 * size / 8.)
+      add_frame = animation.add
+      if writer is not None:
+        add_frame = lambda frame: writer.submit(animation.add, frame, key=animation.path)
+      window = collections.deque(maxlen=max(1, max_rows // z_dim))
+      for _, samples in traverse(sess, dcgan, frame_z, frame_y, max_rows):
+        window.append(tile_images(images_to_uint8(samples), grid))
+        add_frame(window[-1])
+      for frame in reversed(window):
+        add_frame(frame)
+      back = np.arange(size - len(window) - 1, -1, -1)
+      if len(back):
+        for _, samples in traverse(sess, dcgan, frame_z[back],
+                                   frame_y[back] if frame_y is not None else None, max_rows):
+          add_frame(tile_images(images_to_uint8(samples), grid))
+      if writer is not None:
+        writer.submit(animation.close, key=animation.path)
       else:
-        samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample})
-
-      try:
-        make_gif(samples, './samples/test_gif_%s.gif' % (idx))
-      except:
-        save_images(samples, [image_frame_dim, image_frame_dim], './samples/test_%s.png' % strftime("%Y-%m-%d-%H-%M-%S", gmtime()))
-  elif option == 3:
-    values = np.arange(0, 1, 1./config.batch_size)
-    for idx in xrange(dcgan.z_dim):
-      print(" [*] %d" % idx)
-      z_sample = np.zeros([config.batch_size, dcgan.z_dim])
-      for kdx, z in enumerate(z_sample):
-        z[idx] = values[kdx]
-
-      samples = sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample})
-      make_gif(samples, './samples/test_gif_%s.gif' % (idx))
-  elif option == 4:
-    image_set = []
-    values = np.arange(0, 1, 1./config.batch_size)
-
-    for idx in xrange(dcgan.z_dim):
-      print(" [*] %d" % idx)
-      z_sample = np.zeros([config.batch_size, dcgan.z_dim])
-      for kdx, z in enumerate(z_sample): z[idx] = values[kdx]
-
-      image_set.append(sess.run(dcgan.sampler, feed_dict={dcgan.z: z_sample}))
-      make_gif(image_set[-1], './samples/test_gif_%s.gif' % (idx))
-
-    new_image_set = [merge(np.array([images[idx] for images in image_set]), [10, 10]) \
-        for idx in range(64) + range(63, -1, -1)]
-    make_gif(new_image_set, './samples/test_gif_merged.gif', duration=8)
+        animation.close()
+  elif option == 5:
+    # Both kinds of path between the same pairs, in one sampler run
+    start, end = np.random.uniform(-1, 1, size=(2, image_frame_dim, z_dim))
+    z_sample = np.stack([lerp(start, end, image_frame_dim), slerp(start, end, image_frame_dim)])
+    z_sample = z_sample.reshape(2, image_frame_dim * image_frame_dim, z_dim)
+    y_sample = None
+    if y_dim:
+      # One label per pair
+      y_sample = np.eye(y_dim)[np.repeat(np.random.randint(y_dim, size=image_frame_dim), image_frame_dim)]
+      y_sample = np.stack([y_sample, y_sample])
+    stamp = strftime("%Y-%m-%d-%H-%M-%S", gmtime())
+    for idx, samples in traverse(sess, dcgan, z_sample, y_sample, max_rows):
+      write_images(samples, [image_frame_dim, image_frame_dim],
+                   './samples/test_%s_%s.png' % (('lerp', 'slerp')[idx], stamp))
 
 
 def image_manifold_size(num_images):
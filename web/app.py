@@ -1,12 +1,165 @@
-from flask import Flask
+"""
+Demo page and, given an export, an HTTP sampling service.
+
+    $ python web/app.py --export_dir export/mnist
+
+GET or POST /sample takes `n` (number of images), `seed` (one per image,
+instead of `n`), `label` (one per image, or one for all of them) and
+`format` (png for an image grid, npy for a float32 array in [-1, 1]), as
+query arguments or a JSON body. Concurrent requests run together in one
+`sess.run`; GET /metrics reports queue depth, batch sizes and latencies.
+
+Seeded requests go through a memory and disk cache of encoded images,
+which is dropped whenever a new export replaces the generator.
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import six
+from flask import Flask, Response, jsonify, request
 from flask import render_template
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
 app = Flask(__name__, template_folder="./", static_folder='./', static_url_path='')
+batcher = None
+sampler = None
+
+parser = argparse.ArgumentParser(description='DCGAN demo and sampling service.')
+parser.add_argument('--export_dir', type=str, default=None,
+           help='generator exported with main.py --export_dir; without it only the demo is served')
+parser.add_argument('--host', type=str, default='0.0.0.0', help='address to listen on [0.0.0.0]')
+parser.add_argument('--port', type=int, default=5000, help='port to listen on [5000]')
+parser.add_argument('--max_batch', type=int, default=256,
+           help='most images per generator call, and per request [256]')
+parser.add_argument('--max_latency_ms', type=float, default=5.,
+           help='milliseconds a request waits for others to batch with [5]')
+parser.add_argument('--max_queue', type=int, default=1024,
+           help='waiting requests before new ones get 503 [1024]')
+parser.add_argument('--cache_mb', type=float, default=256.,
+           help='megabytes of encoded images cached in memory; 0 disables the cache [256]')
+parser.add_argument('--cache_dir', type=str, default=None,
+           help='directory of the on-disk image cache; none without it [None]')
+parser.add_argument('--cache_disk_mb', type=float, default=1024.,
+           help='megabytes of encoded images cached on disk [1024]')
+parser.add_argument('--reload_secs', type=float, default=30.,
+           help='seconds between checks of export_dir for a newer export; 0 disables them [30]')
+parser.add_argument('--debug', action='store_true', help='run Flask in debug mode')
 
 @app.route('/')
 def index():
   return render_template('index.html')
 
+def _int_list(value):
+  if value is None:
+    return None
+  if isinstance(value, (list, tuple)):
+    return [int(v) for v in value]
+  if isinstance(value, six.string_types) and ',' in value:
+    return [int(v) for v in value.split(',') if v]
+  return int(value)
+
+def _request_args():
+  args = dict(request.args.items())
+  if request.method == 'POST':
+    args.update(request.get_json(silent=True) or {})
+  num = args.get('n')
+  seeds = _int_list(args.get('seed', args.get('seeds')))
+  if seeds is not None and not isinstance(seeds, list):
+    seeds = [seeds]
+  labels = _int_list(args.get('label', args.get('labels')))
+  return (int(num) if num is not None else None), seeds, labels, args.get('format', 'png')
+
+@app.route('/sample', methods=['GET', 'POST'])
+def sample():
+  from serving import QueueFull, request_inputs, encode_png, encode_npy
+  if batcher is None:
+    return jsonify(error='No generator loaded; start with --export_dir'), 404
+  try:
+    num, seeds, labels, fmt = _request_args()
+    if fmt not in ('png', 'npy'):
+      raise ValueError("format must be png or npy")
+    if num is None and seeds is None:
+      num = 1
+    mimetype = 'image/png' if fmt == 'png' else 'application/octet-stream'
+    # Only seeded images can be served again
+    if sampler is not None and seeds is not None and (labels is not None or not batcher.signature['y_dim']):
+      if num is not None and num != len(seeds):
+        raise ValueError("Got {} seeds for {} images".format(len(seeds), num))
+      return Response(sampler.sample(seeds, labels, fmt), mimetype=mimetype)
+    z, y = request_inputs(batcher.signature, num, seeds, labels)
+    images = batcher.submit(z, y)
+  except QueueFull as error:
+    return jsonify(error=str(error)), 503
+  except ValueError as error:
+    return jsonify(error=str(error)), 400
+  if fmt == 'png':
+    return Response(encode_png(images), mimetype=mimetype)
+  return Response(encode_npy(images), mimetype=mimetype)
+
+@app.route('/metrics')
+def metrics():
+  if batcher is None:
+    return jsonify(error='No generator loaded; start with --export_dir'), 404
+  result = batcher.metrics()
+  result['step'] = batcher.signature.get('step')
+  if sampler is not None:
+    result['cache'] = sampler.cache.stats()
+  return jsonify(result)
+
+def _signature_mtime(export_dir):
+  from export import SIGNATURE_NAME
+  try:
+    return os.path.getmtime(os.path.join(export_dir, SIGNATURE_NAME))
+  except OSError:
+    return None
+
+def watch_export(export_dir, every_secs):
+  """Swaps in the generator of export_dir whenever its generator.json changes."""
+  from export import FrozenGenerator
+  last_mtime = _signature_mtime(export_dir)
+  while True:
+    time.sleep(every_secs)
+    mtime = _signature_mtime(export_dir)
+    if mtime is None or mtime == last_mtime:
+      continue
+    try:
+      generator = FrozenGenerator(export_dir)
+    except Exception as error:
+      # Possibly caught halfway through an export; retried next time
+      print(" [!] Could not load {}: {}".format(export_dir, error))
+      continue
+    last_mtime = mtime
+    batcher.replace_generator(generator).close()
+    if sampler is not None:
+      sampler.bind()
+    print(" [*] Now serving the generator of step {}".format(generator.signature['step']))
+
+def main():
+  global batcher, sampler
+  args = parser.parse_args()
+  if args.export_dir:
+    from export import FrozenGenerator
+    from serving import MicroBatcher
+    generator = FrozenGenerator(args.export_dir)
+    print(" [*] Loaded the generator of step {} in {:.2f}s".format(
+        generator.signature['step'], generator.load_time))
+    batcher = MicroBatcher(generator, max_batch=args.max_batch,
+                           max_latency=args.max_latency_ms / 1e3, max_queue=args.max_queue)
+    if args.cache_mb > 0:
+      from cache import ImageCache
+      from serving import CachedSampler
+      sampler = CachedSampler(batcher, ImageCache(int(args.cache_mb * 2 ** 20), args.cache_dir,
+                                                  int(args.cache_disk_mb * 2 ** 20)))
+    if args.reload_secs > 0:
+      watcher = threading.Thread(target=watch_export, args=(args.export_dir, args.reload_secs))
+      watcher.daemon = True
+      watcher.start()
+  app.debug = args.debug
+  # The reloader would load the generator twice
+  app.run(host=args.host, port=args.port, threaded=True, use_reloader=False)
+
 if __name__ == '__main__':
-  app.debug=True
-  app.run(host='0.0.0.0')
+  main()
@@ -0,0 +1,86 @@
+"""
+Synthetic load for the sampling service in app.py.
+
+    $ python web/app.py --export_dir export/mnist &
+    $ python web/load_test.py --clients 1,8,32 --images 4 --duration 10
+
+Each client sends requests back to back for `--duration` seconds. Per
+client count it prints requests/sec, images/sec, latency percentiles, and
+the mean batch size the server ran them in.
+"""
+from __future__ import print_function
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from six.moves import urllib
+
+parser = argparse.ArgumentParser(description='Load test the DCGAN sampling service.')
+parser.add_argument('--url', type=str, default='http://localhost:5000',
+           help='address of the service [http://localhost:5000]')
+parser.add_argument('--clients', type=str, default='1,8,32',
+           help='comma separated numbers of concurrent clients to run in turn [1,8,32]')
+parser.add_argument('--images', type=int, default=4, help='images per request [4]')
+parser.add_argument('--format', type=str, default='npy', choices=['png', 'npy'],
+           help='response format [npy]')
+parser.add_argument('--duration', type=float, default=10., help='seconds per client count [10]')
+parser.add_argument('--seeded', action='store_true',
+           help='send one random seed per image instead of a count')
+
+def fetch_json(url):
+  return json.loads(urllib.request.urlopen(url).read().decode('utf-8'))
+
+def client(args, deadline, rng, latencies, errors):
+  while time.time() < deadline:
+    query = {'format': args.format}
+    if args.seeded:
+      query['seed'] = ','.join(str(seed) for seed in rng.randint(2 ** 31, size=args.images))
+    else:
+      query['n'] = args.images
+    start_time = time.time()
+    try:
+      urllib.request.urlopen('{}/sample?{}'.format(args.url, urllib.parse.urlencode(query))).read()
+    except Exception:
+      errors.append(time.time() - start_time)
+      continue
+    latencies.append(time.time() - start_time)
+
+def run(args, num_clients):
+  before = fetch_json(args.url + '/metrics')['counts']
+  latencies, errors = [], []
+  deadline = time.time() + args.duration
+  threads = [threading.Thread(target=client, args=(args, deadline, np.random.RandomState(idx), latencies, errors))
+             for idx in range(num_clients)]
+  start_time = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start_time
+  after = fetch_json(args.url + '/metrics')['counts']
+
+  batches = after.get('batches', 0) - before.get('batches', 0)
+  images = after.get('images', 0) - before.get('images', 0)
+  p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3 if latencies else (0., 0., 0.)
+  return {
+    'clients': num_clients,
+    'requests_per_sec': len(latencies) / elapsed,
+    'images_per_sec': len(latencies) * args.images / elapsed,
+    'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99,
+    'errors': len(errors),
+    'mean_batch': images / float(batches) if batches else 0.,
+  }
+
+def main():
+  args = parser.parse_args()
+  print("{:>8} {:>13} {:>11} {:>9} {:>9} {:>9} {:>11} {:>7}".format(
+      'clients', 'requests/sec', 'images/sec', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'mean batch', 'errors'))
+  for num_clients in [int(n) for n in args.clients.split(',') if n]:
+    result = run(args, num_clients)
+    print("{clients:>8d} {requests_per_sec:>13.1f} {images_per_sec:>11.1f} {p50_ms:>9.1f} "
+          "{p90_ms:>9.1f} {p99_ms:>9.1f} {mean_batch:>11.1f} {errors:>7d}".format(**result))
+  print(json.dumps(fetch_json(args.url + '/metrics'), indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+  main()